@@ -0,0 +1,141 @@
+"""
+Cross-device de-duplication: one spoken command, heard by the intercoms of the neighbouring rooms, is processed once.
+
+Every utterance (v1 [101], v2 WAKE, or a hands-free wake word) is registered with begin(). The utterances of the
+other devices starting within WINDOW_SEC of the first one are a group: the same command, heard by several devices.
+At the end of speech, end() decides: the utterance of the group with the best signal (the VAD snr(), computed while
+capturing) is processed (decode -> the intent action -> the TTS response). The others with the same Rhino result
+(intent and slots), or with no result, are duplicates: answered with the device stored ACK_FILE ('OK.'), no action,
+no synthesis, no mp3 transfer. An utterance with another result is another command (ak. spoken in the next room
+at the same time): processed too.
+
+~ note: an utterance alone (the usual case) is decided at once. In a group, end() waits for the other utterances to
+        end too, max DECIDE_WAIT_SEC after the first end. An utterance ending after the decision is a duplicate.
+~ note: the v1 device id is its IP address (several connections from one address are not grouped).
+"""
+import threading
+import time
+
+
+class Utterance:
+    """ An utterance of a device, registered by UtteranceArbiter.begin(). """
+    def __init__(self, group, device, started):
+        self.group = group
+        self.device = device
+        self.started = started
+        self.ended = None       # time of the end of speech (or cancel)
+        self.quality = None     # the VAD snr (dB), None if no speech
+        self.result = None      # the Rhino result: (intent, slots), None if not understood
+        self.cancelled = False
+
+
+class _Group:
+    def __init__(self, started):
+        self.started = started
+        self.members = []
+        self.first_end = None
+        self.winner = None
+        self.decided = False
+
+
+class UtteranceArbiter:
+    WINDOW_SEC = 0.6        # utterances of different devices starting this close: the same spoken command.
+    DECIDE_WAIT_SEC = 0.5   # after the first end of a group, max wait for the others, before deciding.
+    ACK_FILE = "/ok.mp3"    # the duplicates answer, on the devices SPIFFS (a filler, see filler.FillerPolicy)
+
+    def __init__(self, enabled=True, window=None, wait=None):
+        self.enabled = enabled
+        self.window = UtteranceArbiter.WINDOW_SEC if window is None else window
+        self.wait = UtteranceArbiter.DECIDE_WAIT_SEC if wait is None else wait
+        self._open = []     # the groups still open to new utterances (or not decided yet)
+        self._cond = threading.Condition()
+        self.stats = {"utterances": 0, "groups": 0, "duplicates": 0, "distinct": 0, "waited_sec": 0.0}
+
+    def begin(self, device):
+        """ A new utterance of the device -> Utterance, to be given to end() (or cancel()). """
+        now = time.monotonic()
+        with self._cond:
+            self.stats["utterances"] += 1
+            group = None
+            if self.enabled:
+                for candidate in self._open:
+                    if (candidate.first_end is None and now - candidate.started <= self.window
+                            and all(u.device != device for u in candidate.members)):
+                        group = candidate
+                        break
+            if group is None:
+                group = _Group(now)
+                self._open.append(group)
+            elif len(group.members) == 1:
+                self.stats["groups"] += 1
+            utterance = Utterance(group, device, now)
+            group.members.append(utterance)
+            return utterance
+
+    def end(self, utterance, quality, result=None):
+        """
+        The end of speech of the utterance, with its signal quality (the VAD snr(), None if unknown)
+        and its Rhino result ((intent, slots), None if not understood).
+        Blocks while the other utterances of its group are still being heard (max DECIDE_WAIT_SEC).
+
+        Returns:
+            bool: True -> process it. False -> a duplicate (the same command, or nothing understood),
+                  heard better by another device: acknowledge only.
+        """
+        group = utterance.group
+        start = time.monotonic()
+        with self._cond:
+            utterance.quality = quality
+            utterance.result = result
+            self._ended(utterance, start)
+            while not group.decided:
+                remaining = group.first_end + self.wait - time.monotonic()
+                if remaining <= 0:
+                    self._decide(group)
+                    break
+                self._cond.wait(remaining)
+            waited = time.monotonic() - start
+            self.stats["waited_sec"] += waited
+            winner = group.winner
+            distinct = winner is not None and winner is not utterance and result is not None and result != winner.result
+            duplicate = winner is not None and winner is not utterance and not distinct
+            self.stats["duplicates"] += duplicate
+            self.stats["distinct"] += distinct
+        if distinct:
+            print(f"Utterance of {utterance.device}: another command than {winner.device} heard at the same time. "
+                  "Processed too.")
+        elif duplicate:
+            print(f"Duplicate utterance of {utterance.device} (snr {quality}), "
+                  f"the same command heard by {group.winner.device} (snr {group.winner.quality}).")
+        elif waited > 0.001:
+            print(f"Utterance of {utterance.device} (snr {quality}) chosen, of {len(group.members)} devices "
+                  f"[{waited * 1000:.0f} ms].")
+        return not duplicate
+
+    def cancel(self, utterance):
+        """ The utterance is not processed (no audio, no recognizer, the client left): never the one chosen. """
+        with self._cond:
+            utterance.cancelled = True
+            self._ended(utterance, time.monotonic())
+
+    def _ended(self, utterance, now):
+        group = utterance.group
+        utterance.ended = now
+        if group.first_end is None:
+            group.first_end = now
+        if not group.decided and all(u.ended is not None for u in group.members):
+            self._decide(group)
+
+    def _decide(self, group):
+        """ The best signal of the ended utterances, an understood one first (the first ended, if equal). """
+        candidates = [u for u in group.members if u.ended is not None and not u.cancelled]
+        if candidates:
+            group.winner = max(candidates, key=lambda u: (u.result is not None, u.quality is not None,
+                                                          u.quality or 0.0, -u.ended))
+        group.decided = True
+        self._open.remove(group)
+        self._cond.notify_all()
+
+    def report(self):
+        with self._cond:
+            return {**self.stats, "waited_sec": round(self.stats["waited_sec"], 3), "open": len(self._open)}
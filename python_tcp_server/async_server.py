@@ -0,0 +1,438 @@
+import asyncio
+import os
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import protocol
+import handshake
+from metrics import METRICS, span
+from recorder import RECORDER
+from engines import EnginePool
+from connections import ConnectionRegistry
+from device_manifest import PendingAnswer
+
+
+class AsyncTCPServer(threading.Thread):
+    """
+    asyncio version of the TCPServer.
+    All the client connections are served by one event loop (one thread), instead of a thread per client.
+    The CPU-bound recognition and the TTS are executed in thread pool executors.
+
+    Uses the same wire protocol as the TCPServer / Client:
+        - [101] wake-up-call from the client -> [202] 'ready' answer from the server
+        - raw 16-bit audio in 512 bytes chunks, ended by the client stopping the transmission
+        - 29 bytes 'server-call' (the mp3 file name) -> [11] 'I have it' / [22] 'send it' -> the mp3 data
+        - or the framed protocol v2, when the client opens with protocol.MAGIC (see protocol.py)
+
+    ~ note: the class has the same start() / stop() / clients interface as TCPServer, so main.py can use any of them.
+    """
+    HOST = "172.16.1.160"  # Your Raspberry Pi's IP address
+    PORT = 5000  # TCP Port
+    MAX_CLIENTS = 10
+    LISTEN_BACKLOG = 32  # connections waiting for accept(). See TCPServer.LISTEN_BACKLOG
+
+    RECOGNITION_WORKERS = os.cpu_count() or 4   # threads for the recognition (CPU-bound).
+    TTS_WORKERS = 16                            # threads for the TTS (blocking on the network / disk, not on the CPU).
+
+    def __init__(self, host=None, port=None, engines=None, connections=None):
+        super().__init__(daemon=True)
+
+        self.host = host or AsyncTCPServer.HOST
+        self.port = port or AsyncTCPServer.PORT
+        self.engines = engines or EnginePool()
+
+        if connections is None:
+            connections = ConnectionRegistry(max_clients=self.MAX_CLIENTS, backlog=self.engines.backlog)
+        self.clients = connections
+        self.engines.captures.reserve(min(self.engines.size, connections.max_clients))
+        # ~ note: the AsyncClient instances, with the admission control. See connections.py
+        self.running = True
+
+        self.loop = None
+        self.executor = ThreadPoolExecutor(max_workers=self.RECOGNITION_WORKERS, thread_name_prefix="recognition")
+        self.tts_executor = ThreadPoolExecutor(max_workers=self.TTS_WORKERS, thread_name_prefix="tts")
+        self._stop_event = None
+        self.ready = threading.Event()  # set when the server is listening.
+
+    def run(self):
+        """ Runs the event loop ~ overrides the threading running method. Calling on AsyncTCPServer.start() """
+        try:
+            asyncio.run(self._serve())
+        except Exception as e:
+            print(f"ERR in the asyncio server loop -> {e}")
+        finally:
+            self.executor.shutdown(wait=False)
+            self.tts_executor.shutdown(wait=False)
+            self.engines.close()
+            self.ready.set()  # release anyone waiting, even on failure.
+
+        print("Server SHUTDOWN successful!")
+
+    async def _serve(self):
+        self.loop = asyncio.get_running_loop()
+        self._stop_event = asyncio.Event()
+
+        server = await asyncio.start_server(self._on_connect, self.host, self.port,
+                                            reuse_address=True, backlog=self.LISTEN_BACKLOG)
+
+        # Enable TCP Keepalive, same settings as the TCPServer.
+        for server_socket in server.sockets:
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            if hasattr(socket, "TCP_KEEPIDLE") and hasattr(socket, "TCP_KEEPINTVL") and hasattr(socket, "TCP_KEEPCNT"):
+                server_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 30)
+                server_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 5)
+                server_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)
+
+        print(f"Server (asyncio) running on {self.host}:{self.port}")
+        self.engines.start()
+        self.ready.set()
+
+        sweeper = asyncio.create_task(self._sweep_idle())
+        async with server:
+            await self._stop_event.wait()
+            # ~ note: no polling. The stop event wakes the loop immediately.
+            sweeper.cancel()
+            server.close()
+            for client in list(self.clients):
+                client.close()
+            tasks = [client.task for client in self.clients if client.task]
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _on_connect(self, reader, writer):
+        address = writer.get_extra_info("peername")
+        client_socket = writer.get_extra_info("socket")
+        if client_socket is not None:
+            client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+
+        print(f"New connection from {address}")
+
+        client = AsyncClient(reader, writer, address, self)
+        client.task = asyncio.current_task()
+        refused, to_close = self.clients.admit(client)
+        self._close_clients(to_close, "replaced")
+        if refused:
+            print(f"Connection from {address} refused: {refused}.")
+            client.close()
+            return
+        print(f"Total connections: {len(self.clients)}")
+
+        try:
+            await client.run()
+        finally:
+            self.remove_client(client)
+
+    def remove_client(self, client):
+        """ Removes a client from the active list -> True if it was there. """
+        return self.clients.remove(client)
+
+    def identify(self, client, device):
+        """ A client told its device id (the v2 HELLO, on an executor thread): an older session of the device is closed. """
+        old = self.clients.identify(client, device)
+        if old:
+            self.loop.call_soon_threadsafe(self._close_clients, old, "replaced")
+
+    @staticmethod
+    def _close_clients(clients, reason):
+        for client in clients:
+            print(f"Closing client {client.address} ({reason}).")
+            client.close()
+
+    async def _sweep_idle(self):
+        while True:
+            await asyncio.sleep(ConnectionRegistry.SWEEP_INTERVAL)
+            self._close_clients(self.clients.sweep(), "idle")
+
+    def stop(self):
+        """Stop the server and disconnect clients. Thread-safe, returns immediately."""
+        print("[*] Stopping server...")
+        self.running = False
+        if self.loop is not None and self._stop_event is not None:
+            self.loop.call_soon_threadsafe(self._stop_event.set)
+
+
+class AsyncClient:
+    """ One client connection of the AsyncTCPServer. Same logic as the tcp_client.Client thread, but as a coroutine. """
+    AUDIO_TIMEOUT = 1.0     # end of the client audio transmission, when nothing is received for this long (seconds).
+    DRAIN_TIMEOUT = 0.15    # after an early stop (Rhino finalized), wait this long for the rest of the audio stream.
+    STREAMING = True
+    VAD = True              # end the recording on the server-side VAD end-of-speech. See tcp_client.Client.VAD
+
+    def __init__(self, reader, writer, address, server):
+        self.reader = reader
+        self.writer = writer
+        self.address = address
+        self.server = server
+        self.task = None
+        self.engines = server.engines
+        from vad import VoiceActivityDetector  # ~ note: numpy, imported by the first client, not on the server start.
+        self.vad = VoiceActivityDetector() if self.VAD else None
+        self.device = address[0] if address else None
+        self._pending = None
+
+    async def _in_executor(self, func, *args):
+        return await self.server.loop.run_in_executor(self.server.executor, func, *args)
+
+    async def run(self):
+        print(f"[+] New client connected and running -> {self.address}")
+        try:
+            while self.server.running:
+                data = await self.reader.read(1)
+                if not data:
+                    print(f"Client {self.address} has disconnected.")
+                    break
+                self.server.clients.touch(self)
+
+                if data[0] in (11, 22) and self._pending is not None:
+                    # the late answer to a not waited server-call (device manifest).
+                    pending, self._pending = self._pending, None
+                    if not pending.expired:
+                        await self._run(handshake.complete_pending(self.engines.speaker, pending, data[0]))
+
+                elif data[0] == 101:
+                    # wake-up-call received: answer [202] 'I am ready', and receive the audio.
+                    self._pending = None
+                    if not self.engines.ready.is_set():
+                        # the engines are still warming up (see EnginePool.start()): a 'connecting' reply.
+                        self.writer.write(bytes([202]))
+                        await self._reply_starting()
+                        continue
+
+                    trace = METRICS.new_trace(self.device)
+                    self.writer.write(bytes([202]))
+                    await self.writer.drain()
+                    print("Ready signal sent. The client should start sending audio data")
+
+                    await self._handle_command(trace)
+
+                elif data[0] == protocol.MAGIC:
+                    await self._run_v2()
+                    break
+
+        except (ConnectionError, asyncio.IncompleteReadError) as e:
+            print(f"Client {self.address} disconnected unexpectedly ({e}).")
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            print(f"ERR in client {self.address} -> {e}")
+        finally:
+            self.close()
+            print(f"[-] Client {self.address} disconnected | Client task stopped.")
+
+    async def _handle_command(self, trace=None):
+        """ Receive the audio, recognize it (with a recognizer leased from the server EnginePool), and answer back. """
+        utterances = self.engines.utterances
+        utterance = utterances.begin(self.device)  # ~ note: the same command heard by other devices? see arbiter.py
+        try:
+            # ~ note: the lease may block (waiting for a free recognizer), so it runs in the loop default executor.
+            with span(trace, "lease"):
+                recognizer = await self.server.loop.run_in_executor(None, self.engines.acquire)
+        except Exception as e:
+            utterances.cancel(utterance)
+            print(f"ERR: in audio processing -> no recognizer available ({e}). Dropping the audio...")
+            await self._reply_busy(trace)
+            return
+
+        try:
+            capture = await self.server.loop.run_in_executor(None, self.engines.captures.acquire)
+        except Exception as e:
+            utterances.cancel(utterance)
+            self.engines.release(recognizer)
+            print(f"ERR: in audio processing -> no capture buffer available ({e}). Dropping the audio...")
+            await self._reply_busy(trace)
+            return
+
+        if RECORDER.enabled:
+            capture.keep_raw()
+        try:
+            result, audio_size, stopped_early = await self._record(recognizer, capture, trace)
+            recording = RECORDER.take(capture)
+        except BaseException:
+            utterances.cancel(utterance)  # ~ note: also on the task cancel (the server stop).
+            raise
+        finally:
+            self.engines.captures.release(capture)
+            self.engines.release(recognizer)
+
+        if not audio_size:
+            utterances.cancel(utterance)
+            print("ERR: audio_data is empty!")
+            return
+
+        # ~ note: end() waits for the other devices of a group to end, so it runs in the loop default executor.
+        quality = self.vad.snr() if self.vad else None
+        if not await self.server.loop.run_in_executor(None, utterances.end, utterance, quality, result):
+            # the same command, heard better by another device: only a short acknowledgement, no action.
+            if stopped_early:
+                await self._drain_audio()
+            await self._run(handshake.send_filler(self.engines.speaker, utterances.ACK_FILE, self.device, trace))
+            if trace is not None:
+                trace.finish()
+            return
+
+        with span(trace, "decode"):
+            decoder_respond = self.engines.decoder.decode_rhino(pvRhino_result=result, device=self.device)
+
+        # The audio (cached or synthesized) is prepared while the rest of the client stream is drained.
+        audio_future = self.engines.speaker.prepare_audio(decoder_respond, trace=trace)
+        if stopped_early:
+            with span(trace, "drain"):
+                await self._drain_audio()
+
+        # a filler ('On it.') first, while a not cached response is still being synthesized. See handshake.transmit()
+        answer = await self._run(handshake.transmit(self.engines.speaker, decoder_respond, self.device,
+                                                    audio_future=audio_future, trace=trace))
+        if isinstance(answer, PendingAnswer):
+            self._pending = answer
+        print(answer)
+        if trace is not None:
+            trace.finish()
+        RECORDER.record(self.device, recording, result, decoder_respond, trace)
+
+    async def _record(self, recognizer, capture, trace=None):
+        """ Receive the client audio into the capture buffer, decoding it on real time if STREAMING
+            -> (result, audio size, stopped early)
+            ~ note: the asyncio streams have no recv_into(), the chunks are copied into the capture buffer.
+        """
+        stopped_early = False
+        streaming = self.STREAMING
+
+        if streaming:
+            recognizer.start_stream()
+        if self.vad:
+            self.vad.reset()
+
+        print("Start recording...")
+        receive_start = time.perf_counter()
+        while self.server.running:
+            if capture.full:
+                print(f"Max utterance length reached [{capture.size} bytes]. Stop recording.")
+                capture.truncated = True
+                stopped_early = True
+                break
+            try:
+                chunk = await asyncio.wait_for(self.reader.read(min(512, capture.free)), self.AUDIO_TIMEOUT)
+            except asyncio.TimeoutError:
+                print("The client audio transmission ended.")
+                break
+
+            if not chunk:
+                print("Connection closed unexpectedly")
+                break
+
+            capture.put(chunk)
+            chunk = capture.last
+            if self.vad:
+                chunk = self.vad.process(chunk)
+            chunk = capture.commit(chunk)
+
+            if streaming and chunk and await self._in_executor(recognizer.process_chunk, chunk):
+                print("Rhino finalized while receiving. Stop recording.")
+                stopped_early = True
+                break
+
+            if self.vad and self.vad.ended:
+                print("End of speech detected (VAD). Stop recording.")
+                stopped_early = True
+                break
+
+        if trace is not None:
+            trace.add("receive", time.perf_counter() - receive_start)
+
+        if not capture.received:
+            return None, 0, False
+
+        print(f"Data Ready, [{capture.length} of {capture.received} bytes]. PROCESSING...")
+        if streaming:
+            with span(trace, "finish"):
+                result = await self._in_executor(recognizer.finish_stream)
+            if trace is not None:
+                trace.add("rhino", recognizer.stream_rhino_time)
+        else:
+            result = await self._in_executor(recognizer.process_audio_data, capture.audio, None, 1.0, 'split', trace)
+
+        return result, capture.received, stopped_early
+
+    async def _run_v2(self):
+        """ Framed protocol v2 (see protocol.py): negotiate the version, then serve the frames until disconnect. """
+        version = await self.reader.readexactly(1)
+        used = protocol.negotiate(version[0])
+        self.writer.write(bytes([protocol.MAGIC, used]))
+        await self.writer.drain()
+        print(f"Client {self.address} uses the framed protocol v{used}.")
+
+        loop = self.server.loop
+        session = protocol.V2Session(self.engines, lambda data: loop.call_soon_threadsafe(self.writer.write, data),
+                                     self.device, vad=self.vad, streaming=self.STREAMING,
+                                     on_hello=lambda device: self.server.identify(self, device))
+        try:
+            while self.server.running:
+                data = await self.reader.read(4096)
+                if not data:
+                    print(f"Client {self.address} has disconnected.")
+                    break
+                self.server.clients.touch(self)
+                # ~ note: the session may lease a recognizer and synthesize (blocking), so it runs in the TTS executor.
+                await loop.run_in_executor(self.server.tts_executor, session.on_data, data)
+                await self.writer.drain()
+        finally:
+            session.close()
+
+    async def _reply_starting(self):
+        """ The command received before the engines are ready: the 'connecting' call (see handshake.starting_reply()). """
+        await self._run(handshake.starting_reply(self.engines))
+
+    async def _reply_busy(self, trace=None):
+        """ The command could not be processed: the BUSY response (see handshake.busy_reply()). """
+        answer = await self._run(handshake.busy_reply(self.engines, self.device, trace))
+        if isinstance(answer, PendingAnswer):
+            self._pending = answer
+        if trace is not None:
+            trace.finish()
+
+    async def _drain_audio(self, first_timeout=None):
+        await self._run(handshake.drain(first_timeout, self.DRAIN_TIMEOUT))
+
+    async def _run(self, steps):
+        """ Run the v1 protocol steps (see handshake.py) on the asyncio streams -> their result. """
+        result, error = None, None
+        while True:
+            try:
+                op = steps.throw(error) if error is not None else steps.send(result)
+            except StopIteration as stop:
+                return stop.value
+            result, error = None, None
+            try:
+                result = await self._execute(op)
+            except Exception as e:
+                error = e
+
+    async def _execute(self, op):
+        kind = op[0]
+        loop = self.server.loop
+        if kind == "call":
+            return await loop.run_in_executor(self.server.tts_executor, op[1], *op[2:])
+        if kind == "wait":
+            return await asyncio.wrap_future(op[1])
+        if kind == "sleep":
+            await asyncio.sleep(op[1])
+            return None
+        if kind == "send":
+            self.writer.write(op[1])
+            await asyncio.wait_for(self.writer.drain(), op[2])
+            return None
+        if kind == "sendfile":
+            # ~ note: os.sendfile when the transport supports it, else read and written in parts by the loop.
+            return await asyncio.wait_for(loop.sendfile(self.writer.transport, op[1], op[2], op[3]), op[4])
+        if kind == "recv":
+            try:
+                return await asyncio.wait_for(self.reader.read(op[1]), op[2])
+            except asyncio.TimeoutError:
+                return None
+        raise ValueError(f"Unknown IO step: {kind}")
+
+    def close(self):
+        if not self.writer.is_closing():
+            self.writer.close()
@@ -0,0 +1,108 @@
+"""
+Micro-benchmark: Recognizer.process_audio_data(), before and after the zero-copy NumPy audio path.
+
+    before: _amplify_audio() + _quieting_audio_end() + struct.unpack() to a tuple + tuple slices per frame
+    after:  process_audio_data() -> one preallocated int16 buffer, in-place gain / clip, frame views to Rhino
+
+Time (best of --repeat) and peak allocation (tracemalloc) for 1 - 10 sec utterances.
+The Rhino handle is replaced by NullRhino, which does the same per-frame conversion as pvrhino, but no recognition,
+so only the audio path is measured. Run from the python_tcp_server/ directory:
+    python bench_audio.py --seconds 1 2 5 10
+"""
+import argparse
+import contextlib
+import ctypes
+import io
+import struct
+import time
+import tracemalloc
+
+import numpy as np
+
+from recognizer import Recognizer
+
+
+class NullRhino:
+    """ pvrhino-like handle: converts the frames to ctypes exactly like Rhino.process(), never finalizes. """
+    frame_length = 512
+
+    def __init__(self):
+        self._handle = None
+
+    def process(self, pcm):
+        result = ctypes.c_bool()
+        self._process_func(self._handle, (ctypes.c_short * len(pcm))(*pcm), ctypes.byref(result))
+        return result.value
+
+    @staticmethod
+    def _process_func(handle, pcm, result):
+        return 0
+
+    def get_inference(self):
+        raise RuntimeError("NullRhino never finalizes")
+
+    def delete(self):
+        ...
+
+
+class BenchRecognizer(Recognizer):
+    def __init__(self):
+        self.rhino = NullRhino()
+        self._init_buffers()
+        self._native_process = self.rhino._process_func  # ~ note: as with a checked pvrhino version (no version here).
+        self.start_stream()
+
+
+def legacy_process(recognizer, audio_data):
+    """ The process_audio_data() pipeline before the zero-copy path. """
+    audio_data_amplified = recognizer._amplify_audio(audio_data, recognizer.GAIN_FACTOR)
+    recognizer._quieting_audio_end(audio_data_amplified, 1.0)
+    audio_frames = struct.unpack('<' + 'h' * (len(audio_data_amplified) // 2), audio_data_amplified)
+
+    frame_length = recognizer.rhino.frame_length
+    for i in range(len(audio_frames) // frame_length):
+        frame = audio_frames[i * frame_length:(i + 1) * frame_length]
+        if recognizer.rhino.process(frame):
+            return recognizer._inference_result()
+
+
+def measure(func, repeat):
+    best = float('inf')
+    with contextlib.redirect_stdout(io.StringIO()):
+        func()  # warm-up (also grows the preallocated buffers to their size).
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func()
+            best = min(best, time.perf_counter() - start)
+
+        tracemalloc.start()
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return best, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--seconds", type=float, nargs="+", default=[1, 2, 5, 10])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    recognizer = BenchRecognizer()
+    rng = np.random.default_rng(0)
+
+    print(f"{'audio sec':>9}{'before ms':>12}{'after ms':>12}{'speed-up':>10}{'before peak KB':>16}{'after peak KB':>15}")
+    for seconds in args.seconds:
+        samples = rng.integers(-3000, 3000, int(Recognizer.SAMPLE_RATE * seconds), dtype=np.int16)
+        audio_data = bytearray(samples.tobytes())
+
+        before, before_peak = measure(lambda: legacy_process(recognizer, bytearray(audio_data)), args.repeat)
+        after, after_peak = measure(lambda: recognizer.process_audio_data(audio_data, gain_factor=recognizer.GAIN_FACTOR),
+                                    args.repeat)  # ~ note: the fixed gain, as the legacy path (the AGC: bench_dsp.py)
+
+        print(f"{seconds:>9.1f}{before * 1000:>12.2f}{after * 1000:>12.2f}{before / after:>9.1f}x"
+              f"{before_peak / 1024:>16.1f}{after_peak / 1024:>15.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+Micro-benchmark: the per frame cost of the AudioDSP (dsp.py) vs the fixed gain amplification (Recognizer._amplify_into).
+
+For every frame of 512 samples (0.032 sec of audio) the real-time budget is 32 ms per stream.
+Reported: microseconds per frame, the part of the real-time budget used by one stream, and how many streams
+one core can condition. Also the clipped / limited samples, for a quiet, a normal and a loud speaker.
+Run on the target (ak. the Raspberry Pi), from the python_tcp_server/ directory:
+    python bench_dsp.py --seconds 10
+"""
+import argparse
+import time
+
+import numpy as np
+
+from dsp import AudioDSP
+from recognizer import Recognizer
+from bench_audio import BenchRecognizer
+
+FRAME = AudioDSP.FRAME_LENGTH
+FRAME_SEC = FRAME / AudioDSP.SAMPLE_RATE
+
+
+def speech_like(seconds, level, rng):
+    """ Noisy 'syllables' (amplitude modulated noise + a DC offset), at the given peak level. """
+    n = int(AudioDSP.SAMPLE_RATE * seconds)
+    t = np.arange(n) / AudioDSP.SAMPLE_RATE
+    envelope = np.clip(np.sin(2 * np.pi * 3 * t), 0, None) ** 2
+    signal = rng.standard_normal(n) * envelope * level / 3 + 150
+    return np.clip(signal, -32768, 32767).astype(np.int16)
+
+
+def per_frame(func, samples, repeat):
+    """ Best of repeat: seconds per frame. """
+    frames = len(samples) // FRAME
+    out = np.empty(FRAME, dtype=np.int16)
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for i in range(frames):
+            func(samples[i * FRAME:(i + 1) * FRAME], out)
+        best = min(best, (time.perf_counter() - start) / frames)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    recognizer = BenchRecognizer()
+    dsp = AudioDSP()
+
+    print(f"{'speaker':<8}{'stage':<8}{'us/frame':>10}{'budget %':>10}{'streams/core':>14}{'clipped':>10}{'out RMS':>10}")
+    for name, level in (("quiet", 300), ("normal", 2000), ("loud", 12000)):
+        samples = speech_like(args.seconds, level, rng)
+
+        fixed = lambda src, dst: recognizer._amplify_into(src, dst, Recognizer.GAIN_FACTOR)
+        dsp.reset()
+        agc = dsp.process
+
+        for stage, func in (("fixed", fixed), ("agc", agc)):
+            cost = per_frame(func, samples, args.repeat)
+
+            out = np.empty_like(samples)
+            dsp.reset()
+            func(samples, out) if stage == "agc" else recognizer._amplify_into(samples, out, Recognizer.GAIN_FACTOR)
+            clipped = int(np.count_nonzero(np.abs(out.astype(np.int32)) >= 32767)) if stage == "fixed" else dsp.limited
+            rms = float(np.sqrt(np.mean(out.astype(np.float64) ** 2)))
+
+            print(f"{name:<8}{stage:<8}{cost * 1e6:>10.1f}{cost / FRAME_SEC * 100:>10.3f}{FRAME_SEC / cost:>14.0f}"
+                  f"{clipped:>10}{rms:>10.0f}")
+    print("clipped: samples at full scale (fixed), or soft limited (agc).")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+"""
+Benchmark: the bytes on the wire and the transfer time of the mp3 responses, as synthesized vs packed (mp3pack.pack()).
+
+For each mp3 file: the size, the frames dropped (tags, silent head / tail), the play time, and the transfer time:
+    - estimated, at the --rates WiFi throughputs (the intercoms get ~ 0.5 - 2 Mbit/s of goodput at a weak signal).
+    - measured, over a loopback TCP connection (sendall() to a reading thread, best of --repeat).
+--pad SEC adds an ID3 tag and SEC seconds of silent frames at both ends, like a raw TTS response
+(the mp3s kept in the tts/offline_audio/ may be already trimmed).
+--check: checks that pack() drops the Info header frame, as written by LAME (Google TTS: MPEG 2, 24 kHz, mono),
+in front of the frames of every file, and keeps all the audio frames. Run from the python_tcp_server/ directory:
+    python bench_mp3.py                          # all the tts/offline_audio/*.mp3
+    python bench_mp3.py --pad 0.3 some.mp3
+    python bench_mp3.py --check
+"""
+import argparse
+import glob
+import os
+import socket
+import threading
+import time
+
+import mp3pack
+
+
+def padded(data, seconds):
+    """ The mp3 data with an ID3v2 tag, and `seconds` of silent frames (copies of its first header) at both ends. """
+    frames, _ = mp3pack.frames(data)
+    if not frames:
+        return data
+    first = frames[0]
+    header = bytes(data[first.offset:first.offset + 4])
+    silent = header + bytes(first.length - 4)   # ~ note: zero side info -> part2_3_length 0: a silent frame.
+    count = max(1, round(seconds / (mp3pack.duration(data) / len(frames))))
+    id3 = b"ID3\x04\x00\x00\x00\x00\x08\x00" + bytes(1024)  # 1 KB of tag (a cover, a comment...)
+    return id3 + silent * count + data + silent * count
+
+
+def info_tagged(data):
+    """ The mp3 data with a LAME Info header frame in front (the frame count, the bytes, the seek table). """
+    frames, _ = mp3pack.frames(data)
+    if not frames:
+        return data
+    first = frames[0]
+    header = bytes(data[first.offset:first.offset + 4])
+    b1, b3 = header[1], header[3]
+    version = mp3pack._VERSIONS[(b1 >> 3) & 0b11]
+    channels = 1 if (b3 >> 6) == 0b11 else 2
+    side_info = (0 if b1 & 1 else 2) + mp3pack._side_info_size(version, channels)
+    tag = (b"Info" + (0x0F).to_bytes(4, "big") + len(frames).to_bytes(4, "big") + len(data).to_bytes(4, "big")
+           + bytes(range(0, 200, 2)) + (57).to_bytes(4, "big") + b"LAME3.100")
+    frame = (header + bytes(side_info) + tag)[:first.length].ljust(first.length, b"\x00")
+    return frame + data
+
+
+def check(files):
+    """ pack() of the Info tagged files: the Info frame dropped, the same audio frames kept. -> True if all passed. """
+    passed = True
+    for path in files:
+        with open(path, "rb") as f:
+            data = f.read()
+        tagged = info_tagged(data)
+        result, expected = mp3pack.pack(tagged, trim_silence=False), mp3pack.pack(data, trim_silence=False)
+        info_bytes = len(tagged) - len(data)
+        ok = result.audio == expected.audio and result.tags_bytes == expected.tags_bytes + info_bytes
+        passed = passed and ok
+        print(f"{'ok' if ok else 'FAIL':<5} {os.path.basename(path):<28} Info frame {info_bytes} bytes, "
+              f"dropped {result.tags_bytes - expected.tags_bytes}, frames {result.frames}/{expected.frames}")
+    return passed
+
+
+def loopback_send(data, repeat):
+    """ Best time (sec) of sendall() of the data to a reading thread, over a loopback TCP connection. """
+    server = socket.create_server(("127.0.0.1", 0))
+    port = server.getsockname()[1]
+    best = None
+    for _ in range(repeat):
+        sender = socket.create_connection(("127.0.0.1", port))
+        receiver, _ = server.accept()
+        done = threading.Event()
+
+        def read():
+            remaining = len(data)
+            while remaining:
+                chunk = receiver.recv(65536)
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+            done.set()
+
+        reader = threading.Thread(target=read)
+        reader.start()
+        start = time.perf_counter()
+        sender.sendall(data)
+        done.wait()
+        elapsed = time.perf_counter() - start
+        reader.join()
+        sender.close()
+        receiver.close()
+        best = elapsed if best is None else min(best, elapsed)
+    server.close()
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("files", nargs="*", help="mp3 files (default: tts/offline_audio/*.mp3)")
+    parser.add_argument("--pad", type=float, default=0.0, help="seconds of silence (+ an ID3 tag) added at both ends")
+    parser.add_argument("--rates", type=float, nargs="+", default=[0.5, 1.0, 2.0], help="WiFi goodput, Mbit/s")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--check", action="store_true", help="check the Info header frame is dropped, see above")
+    args = parser.parse_args()
+
+    files = args.files or sorted(glob.glob("tts/offline_audio/*.mp3"))
+    if not files:
+        print("No mp3 files.")
+        return
+    if args.check:
+        raise SystemExit(0 if check(files) else 1)
+
+    rates = "".join(f" {f'@{r:g}M ms':>10}" for r in args.rates)
+    print(f"{'file':<28} {'bytes':>7} {'packed':>7} {'saved':>6} {'tags':>5} {'head':>4} {'tail':>4} {'play s':>6}"
+          f"{rates} {'loop us':>8}")
+    totals = [0, 0]
+    for path in files:
+        with open(path, "rb") as f:
+            data = f.read()
+        if args.pad:
+            data = padded(data, args.pad)
+        result = mp3pack.pack(data)
+        totals[0] += result.original_size
+        totals[1] += len(result.audio)
+
+        name = os.path.basename(path)[:28]
+        for label, audio in ((name, data), ("  packed", result.audio)):
+            times = "".join(f" {len(audio) * 8 / (rate * 1e6) * 1000:>10.1f}" for rate in args.rates)
+            loop = loopback_send(audio, args.repeat) * 1e6
+            if audio is data:
+                saved = 1 - len(result.audio) / max(len(data), 1)
+                print(f"{label:<28} {len(data):>7} {len(result.audio):>7} {saved:>6.1%} {result.tags_bytes:>5} "
+                      f"{result.silent_head:>4} {result.silent_tail:>4} {mp3pack.duration(data):>6.2f}{times} {loop:>8.0f}")
+            else:
+                print(f"{label:<28} {'':>7} {'':>7} {'':>6} {'':>5} {'':>4} {'':>4} "
+                      f"{mp3pack.duration(audio):>6.2f}{times} {loop:>8.0f}")
+
+    print(f"\nTotal: {totals[0]} -> {totals[1]} bytes on the wire ({1 - totals[1] / max(totals[0], 1):.1%} saved).")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+"""
+Benchmark: threaded TCPServer vs asyncio AsyncTCPServer.
+
+Measures, for 1, 10 and 100 simulated clients (by default):
+    - idle CPU usage of the server process, with all the clients connected and silent
+    - per-command latency: from the client stopping its audio transmission, to the server-call received
+    - shutdown time: from server.stop() to the server thread finished
+
+The servers run in a child process with the stub engines (stubs.py), so no Picovoice model or TTS account is needed.
+Run from the python_tcp_server/ directory:
+    python bench_server.py --clients 1 10 100 --idle 5 --commands 2
+
+Recognition in worker processes (recognition_workers.py) vs in the server threads, with a simulated CPU cost per frame:
+    python bench_server.py --impl threaded --clients 1 2 4 --idle 1 --frame-cost 0.01 --processes 0 1
+"""
+import argparse
+import multiprocessing
+import socket
+import struct
+import threading
+import time
+
+HOST = "127.0.0.1"
+SIM_MAX_CLIENTS = 10000   # the server connection limit, in the simulations
+
+SPEECH_SEC = 0.5        # loud audio sent on every command
+SILENCE_SEC = 1.0       # quiet audio sent after the speech (the ESP silence_timeout)
+CHUNK_SIZE = 512        # bytes per chunk, same as the ESP
+CHUNK_SEC = CHUNK_SIZE / 2 / 16000   # 0.016 sec of 16 kHz 16-bit audio
+
+
+def _free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind((HOST, 0))
+        return s.getsockname()[1]
+
+
+def _run_server(impl, port, n_engines, conn, frame_cost=0.0, processes=False):
+    """ Child process: run the server with stub engines, and answer the parent commands ('cpu', 'stop'). """
+    from stubs import create_stub_pool
+
+    engines = create_stub_pool(size=n_engines, frame_cost=frame_cost, processes=processes)
+    from connections import ConnectionRegistry
+    connections = ConnectionRegistry(max_clients=SIM_MAX_CLIENTS, device_limits=False)
+    # ~ note: the simulated clients share one IP (the v1 device id), and are not shed: the server load is measured.
+    if impl == "asyncio":
+        from async_server import AsyncTCPServer
+        server = AsyncTCPServer(host=HOST, port=port, engines=engines, connections=connections)
+        server.start()
+        server.ready.wait()
+    else:
+        from tcp_server import TCPServer
+        server = TCPServer(host=HOST, port=port, engines=engines, connections=connections)
+        server.start()
+        time.sleep(0.5)
+
+    conn.send("ready")
+    while True:
+        cmd = conn.recv()
+        if cmd == "cpu":
+            conn.send(time.process_time())
+        elif cmd == "stop":
+            start = time.perf_counter()
+            server.stop()
+            server.join(timeout=10)
+            conn.send(time.perf_counter() - start)
+            return
+
+
+class SimClient:
+    """ Minimal simulated ESP32: 101 -> 202 -> real-time audio -> server-call -> 11. """
+    def __init__(self, port):
+        self.sock = socket.create_connection((HOST, port))
+        self.latencies = []
+        self.errors = 0
+
+    def command(self):
+        loud = struct.pack('<256h', *([3000, -3000] * 128))
+        quiet = bytes(CHUNK_SIZE)
+        try:
+            self.sock.settimeout(5)
+            self.sock.sendall(bytes([101]))
+            if self.sock.recv(1) != bytes([202]):
+                self.errors += 1
+                return
+
+            next_send = time.perf_counter()
+            for i in range(int((SPEECH_SEC + SILENCE_SEC) / CHUNK_SEC)):
+                self.sock.sendall(loud if i * CHUNK_SEC < SPEECH_SEC else quiet)
+                next_send += CHUNK_SEC
+                time.sleep(max(0.0, next_send - time.perf_counter()))
+            stopped = time.perf_counter()
+
+            call = b''
+            while len(call) < 29:
+                data = self.sock.recv(29 - len(call))
+                if not data:
+                    raise ConnectionError("server closed the connection")
+                call += data
+            self.latencies.append(time.perf_counter() - stopped)
+            self.sock.sendall(bytes([11]))   # 'I have it', no transfer.
+        except Exception as e:
+            print(f"client error: {e}")
+            self.errors += 1
+
+    def close(self):
+        self.sock.close()
+
+
+def bench(impl, n_clients, idle_sec, commands, n_engines=None, frame_cost=0.0, processes=False):
+    port = _free_port()
+    parent_conn, child_conn = multiprocessing.Pipe()
+    n_engines = n_engines or n_clients
+    proc = multiprocessing.Process(target=_run_server, args=(impl, port, n_engines, child_conn, frame_cost, processes),
+                                   daemon=not processes)  # ~ note: a daemon process can not start the recognition workers.
+    proc.start()
+    parent_conn.recv()
+
+    clients = [SimClient(port) for _ in range(n_clients)]
+    time.sleep(1.0)  # let the server settle all the connections.
+
+    parent_conn.send("cpu")
+    cpu0 = parent_conn.recv()
+    time.sleep(idle_sec)
+    parent_conn.send("cpu")
+    cpu1 = parent_conn.recv()
+    idle_cpu = (cpu1 - cpu0) / idle_sec * 100
+
+    for _ in range(commands):
+        threads = [threading.Thread(target=c.command) for c in clients]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        time.sleep(0.3)
+
+    parent_conn.send("stop")
+    shutdown = parent_conn.recv()
+    for c in clients:
+        c.close()
+    proc.join(timeout=5)
+
+    latencies = sorted(l for c in clients for l in c.latencies)
+    errors = sum(c.errors for c in clients)
+    return idle_cpu, latencies, errors, shutdown
+
+
+def _pct(values, p):
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, nargs="+", default=[1, 10, 100])
+    parser.add_argument("--impl", choices=["threaded", "asyncio"], nargs="+", default=["threaded", "asyncio"])
+    parser.add_argument("--idle", type=float, default=5.0, help="idle measure window (seconds)")
+    parser.add_argument("--commands", type=int, default=2, help="commands per client")
+    parser.add_argument("--engines", type=int, default=None, help="engine pool size (default: same as the clients)")
+    parser.add_argument("--frame-cost", type=float, default=0.0, help="simulated recognition CPU time per frame (seconds)")
+    parser.add_argument("--processes", type=int, nargs="+", default=[0], choices=[0, 1],
+                        help="1 -> the recognition in worker processes, 0 -> in the server threads")
+    args = parser.parse_args()
+
+    rows = []
+    for n in args.clients:
+        for impl in args.impl:
+            for processes in args.processes:
+                label = impl + ("+proc" if processes else "")
+                print(f"--> {label}, {n} clients...")
+                idle_cpu, latencies, errors, shutdown = bench(impl, n, args.idle, args.commands, args.engines,
+                                                              args.frame_cost, bool(processes))
+                rows.append((label, n, idle_cpu, _pct(latencies, 50), _pct(latencies, 95), errors, shutdown))
+
+    print("")
+    print(f"{'server':<15}{'clients':>8}{'idle CPU %':>12}{'p50 ms':>10}{'p95 ms':>10}{'errors':>8}{'stop ms':>10}")
+    for label, n, idle_cpu, p50, p95, errors, shutdown in rows:
+        print(f"{label:<15}{n:>8}{idle_cpu:>12.2f}{p50 * 1000:>10.1f}{p95 * 1000:>10.1f}{errors:>8}{shutdown * 1000:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
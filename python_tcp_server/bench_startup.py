@@ -0,0 +1,168 @@
+"""
+Startup benchmark: from the server process start to the listening socket accepting, and to the first answered command.
+
+The server runs in a fresh child process (so the imports are measured), in two modes:
+    eager   the EnginePool is built before the server binds (the imports, the Rhino model and the TTS client first).
+    fast    main.py --fast-start: EnginePool(background=True), the engines warm up after the server is listening.
+A simulated ESP32 connects as soon as it can, and sends commands (101 -> 202 -> audio -> server-call -> [11])
+until one is answered with a real response (not the EnginePool.STARTING_FILE 'connecting' reply).
+
+--engine stub (default): the stub engines (stubs.py), with the Rhino model load and the TTS client init simulated
+by --model-load / --tts-init seconds. --engine real: the Picovoice model and the TTS account (on the Pi).
+Run from the python_tcp_server/ directory:
+    python bench_startup.py
+    python bench_startup.py --engine real --repeat 3
+"""
+import argparse
+import json
+import socket
+import struct
+import subprocess
+import sys
+import time
+
+HOST = "127.0.0.1"
+CHUNK_SIZE = 512
+CHUNK_SEC = CHUNK_SIZE / 2 / 16000
+SPEECH_SEC = 0.5
+SILENCE_SEC = 1.0
+MARK = "@@startup "     # the child events on its stdout
+
+
+def _event(name):
+    print(f"{MARK}{json.dumps([name, time.time()])}", flush=True)
+
+
+def _child(args):
+    """ The server process: prints the startup events, serves until its stdin is closed. """
+    _event("start")
+    import threading
+    from tcp_server import TCPServer
+    from engines import EnginePool
+    _event("imported")
+
+    factories = {}
+    if args.engine == "stub":
+        def recognizer_factory():
+            from stubs import stub_recognizer
+            time.sleep(args.model_load)
+            return stub_recognizer()
+
+        def speaker_factory():
+            from stubs import StubSpeaker
+            time.sleep(args.tts_init)
+            return StubSpeaker(synth_delay=0.05)
+
+        factories = {"recognizer_factory": recognizer_factory, "speaker_factory": speaker_factory}
+
+    engines = EnginePool(background=args.mode == "fast", **factories)
+    _event("engines")
+    threading.Thread(target=lambda: (engines.ready.wait(), _event("ready")), daemon=True).start()
+
+    server = TCPServer(host=HOST, port=args.port, engines=engines)
+    server.start()
+    sys.stdin.read()
+    server.stop()
+    server.join(timeout=10)
+
+
+def _command(sock):
+    """ One simulated ESP32 command -> the server-call file name. """
+    loud = struct.pack('<256h', *([3000, -3000] * 128))
+    quiet = bytes(CHUNK_SIZE)
+    sock.sendall(bytes([101]))
+    if sock.recv(1) != bytes([202]):
+        raise ConnectionError("no [202] ready answer")
+    next_send = time.perf_counter()
+    for i in range(int((SPEECH_SEC + SILENCE_SEC) / CHUNK_SEC)):
+        sock.sendall(loud if i * CHUNK_SEC < SPEECH_SEC else quiet)
+        next_send += CHUNK_SEC
+        time.sleep(max(0.0, next_send - time.perf_counter()))
+    call = b''
+    while len(call) < 29:
+        data = sock.recv(29 - len(call))
+        if not data:
+            raise ConnectionError("server closed the connection")
+        call += data
+    sock.sendall(bytes([11]))  # 'I have it', no transfer.
+    time.sleep(0.2)
+    return call.rstrip(b'\x00').decode('utf-8', errors='replace')
+
+
+def run(mode, args):
+    """ -> {measure name: seconds from the process launch} """
+    with socket.socket() as s:
+        s.bind((HOST, 0))
+        port = s.getsockname()[1]
+    command = [sys.executable, __file__, "--child", "--mode", mode, "--port", str(port), "--engine", args.engine,
+               "--model-load", str(args.model_load), "--tts-init", str(args.tts_init)]
+    launched = time.time()
+    child = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True, bufsize=1)
+
+    result = {}
+    try:
+        deadline = time.time() + args.timeout
+        while True:
+            try:
+                sock = socket.create_connection((HOST, port), timeout=0.05)
+                break
+            except OSError:
+                if time.time() > deadline or child.poll() is not None:
+                    raise RuntimeError(f"the {mode} server did not start")
+                time.sleep(0.005)
+        result["accepting"] = time.time() - launched
+
+        sock.settimeout(args.timeout)
+        from engines import EnginePool
+        starting = 0
+        while time.time() < deadline:
+            filename = _command(sock)
+            if filename != EnginePool.STARTING_FILE:
+                result["answered"] = time.time() - launched
+                break
+            starting += 1
+            result.setdefault("first reply", time.time() - launched)
+        result["starting replies"] = starting
+        sock.close()
+    finally:
+        child.stdin.close()
+        output = child.stdout.read()
+        child.wait(timeout=15)
+
+    for line in output.splitlines():
+        if line.startswith(MARK):
+            name, when = json.loads(line[len(MARK):])
+            result[name] = when - launched
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modes", nargs="+", choices=["eager", "fast"], default=["eager", "fast"])
+    parser.add_argument("--engine", choices=["stub", "real"], default="stub")
+    parser.add_argument("--model-load", type=float, default=2.0, help="stub: simulated Rhino model load (seconds)")
+    parser.add_argument("--tts-init", type=float, default=1.0, help="stub: simulated TTS client init (seconds)")
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--mode", default="fast", help=argparse.SUPPRESS)
+    parser.add_argument("--port", type=int, default=0, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        _child(args)
+        return
+
+    columns = ["start", "imported", "engines", "accepting", "first reply", "ready", "answered"]
+    print(f"{'mode':<8}" + "".join(f"{c + ' s':>14}" for c in columns) + f"{'connecting':>12}")
+    for mode in args.modes:
+        for _ in range(args.repeat):
+            result = run(mode, args)
+            print(f"{mode:<8}" + "".join(f"{result[c]:>14.3f}" if c in result else f"{'-':>14}" for c in columns)
+                  + f"{result.get('starting replies', 0):>12}")
+    print("\nSeconds from the server process launch. 'first reply': the first command answered with the "
+          "'connecting' file, 'answered': the first command answered with its response.")
+
+
+if __name__ == "__main__":
+    main()
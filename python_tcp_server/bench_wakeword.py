@@ -0,0 +1,122 @@
+"""
+Wake word benchmark: the hands-free detection cost (wakeword.WakeWordScheduler) for N simultaneous device streams.
+
+One feeder thread streams the audio of all the simulated devices at the real-time pace (512 byte chunks, as the
+devices send them): mostly quiet, with a wake word burst every --every seconds (at a different phase per device).
+Reported per streams count:
+    cpu/stream   the process CPU time per second of audio, per stream (the feeder included: it is the client
+                 threads' work in the server), and the detector time alone ('detect').
+    detected     the detections / the wake words sent, and the detection latency (from the end of the burst).
+    dropped      the frames dropped by the scheduler, lagging more than MAX_LAG_SEC (the workers cannot keep up).
+
+--engine stub (default): stubs.StubWakeWord, with --frame-cost seconds of CPU per frame (Porcupine on a Pi 4:
+~0.0003). --engine porcupine: the real detector (the Recognizer access key and keyword file); the audio is
+synthetic, so expect no detections, only the CPU cost.
+Run from the python_tcp_server/ directory:
+    python bench_wakeword.py
+    python bench_wakeword.py --streams 1 10 50 100 --frame-cost 0.0003 --workers 1 2
+"""
+import argparse
+import struct
+import threading
+import time
+
+from wakeword import WakeWordScheduler
+
+CHUNK_SIZE = 512
+CHUNK_SEC = CHUNK_SIZE / 2 / WakeWordScheduler.SAMPLE_RATE
+BURST_SEC = 0.3
+
+
+def run(streams, workers, args):
+    if args.engine == "stub":
+        from stubs import StubWakeWord
+        detector_factory = lambda: StubWakeWord(frame_cost=args.frame_cost)
+    else:
+        from wakeword import porcupine_detector
+        detector_factory = porcupine_detector
+    scheduler = WakeWordScheduler(detector_factory=detector_factory, workers=workers)
+    devices = [scheduler.open(f"esp-{i}") for i in range(streams)]
+
+    loud = struct.pack('<256h', *([3000, -3000] * 128))
+    quiet = bytes(CHUNK_SIZE)
+    chunks = int(args.seconds / CHUNK_SEC)
+    period = int(args.every / CHUNK_SEC)
+    burst = int(BURST_SEC / CHUNK_SEC)
+    phases = [i * period // max(streams, 1) for i in range(streams)]
+    sent = [0] * streams
+    burst_end = [None] * streams
+    latencies = []
+
+    stop = threading.Event()
+
+    def watch():
+        """ The session side: takes the detections, resumes the detection. """
+        while not stop.is_set():
+            for i, stream in enumerate(devices):
+                if stream.detected is not None:
+                    if burst_end[i] is not None:
+                        latencies.append(time.perf_counter() - burst_end[i])
+                        burst_end[i] = None
+                    stream.take()
+                    stream.resume()
+            time.sleep(0.002)
+
+    watcher = threading.Thread(target=watch, daemon=True)
+    watcher.start()
+
+    cpu_start, wall_start = time.process_time(), time.perf_counter()
+    next_send = wall_start
+    for n in range(chunks):
+        for i, stream in enumerate(devices):
+            position = (n + phases[i]) % period
+            stream.feed(loud if 0 < position <= burst else quiet)
+            if position == burst + 1 and burst < n < chunks - 4:  # ~ note: a burst cut by the stream start / end is not a word.
+                sent[i] += 1
+                burst_end[i] = time.perf_counter()
+        next_send += CHUNK_SEC
+        time.sleep(max(0.0, next_send - time.perf_counter()))
+    time.sleep(0.2)  # the last frames, and the last detections.
+    cpu = time.process_time() - cpu_start
+    audio_sec = chunks * CHUNK_SEC * streams
+    stop.set()
+    watcher.join()
+
+    report = scheduler.report()
+    for stream in devices:
+        stream.close()
+    scheduler.close()
+    latencies.sort()
+    return {
+        "cpu": cpu / audio_sec * 100 if audio_sec else 0.0,
+        "detect": report["detect_sec"] / report["audio_sec"] * 100 if report["audio_sec"] else 0.0,
+        "detected": len(latencies), "sent": sum(sent), "dropped": report["dropped"],
+        "p50": latencies[len(latencies) // 2] * 1000 if latencies else None,
+        "max": latencies[-1] * 1000 if latencies else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--streams", type=int, nargs="+", default=[1, 10, 50])
+    parser.add_argument("--workers", type=int, nargs="+", default=[WakeWordScheduler.WORKERS])
+    parser.add_argument("--engine", choices=["stub", "porcupine"], default="stub")
+    parser.add_argument("--frame-cost", type=float, default=0.0003, help="stub: simulated CPU seconds per frame")
+    parser.add_argument("--seconds", type=float, default=10.0, help="audio streamed by each device")
+    parser.add_argument("--every", type=float, default=3.0, help="a wake word every N seconds, per device")
+    args = parser.parse_args()
+
+    print(f"{'streams':>8}{'workers':>8}{'cpu/stream':>12}{'detect':>10}{'detected':>12}"
+          f"{'p50 ms':>9}{'max ms':>9}{'dropped':>9}")
+    for workers in args.workers:
+        for streams in args.streams:
+            r = run(streams, workers, args)
+            latency = f"{r['p50']:>9.1f}{r['max']:>9.1f}" if r["p50"] is not None else f"{'-':>9}{'-':>9}"
+            print(f"{streams:>8}{workers:>8}{r['cpu']:>11.2f}%{r['detect']:>9.2f}%"
+                  f"{r['detected']:>6}/{r['sent']:<5}{latency}{r['dropped']:>9}")
+    print("\ncpu/stream: the process CPU per second of audio, per stream. "
+          "detect: the detector alone. Latency: from the end of the wake word.")
+
+
+if __name__ == "__main__":
+    main()
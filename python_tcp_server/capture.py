@@ -0,0 +1,170 @@
+import queue
+import threading
+
+
+class CaptureBuffer:
+    """
+    Preallocated arena for the audio of one utterance (max `size` bytes), reused for every utterance.
+    The chunks are received straight into it with socket.recv_into(): no bytes object per chunk, no growing bytearray.
+
+        capture.recv_into(sock, 512)                # the chunk lands after the kept audio
+        chunk = capture.commit(vad.process(capture.last))
+        recognizer.process_chunk(chunk)             # a view of the arena, no copy
+        recognizer.process_audio_data(capture.audio)
+
+    commit() keeps the last chunk in place, or the audio given instead (the VAD output: the pre-roll, or nothing).
+    The audio over the size is dropped (truncated), the caller stops recording when full.
+    keep_raw() -> all the received audio is copied to `raw` too, before the VAD (for the session recorder).
+    """
+    def __init__(self, size):
+        self.size = size
+        self._arena = bytearray(size)
+        self._view = memoryview(self._arena)
+        self.clear()
+
+    def clear(self):
+        """ Prepare for a new utterance. """
+        self.length = 0         # bytes of audio kept
+        self.received = 0       # bytes received (kept or not)
+        self.truncated = False  # True if audio was dropped, over the size
+        self._last = 0          # bytes of the last chunk, not committed yet
+        self.raw = None         # the received audio, if keep_raw()
+
+    def keep_raw(self):
+        """ Keep a copy of all the received audio, for this utterance. Max 2 x size (the VAD trims up to a few sec). """
+        self.raw = bytearray()
+
+    def _tap(self):
+        if self.raw is not None and len(self.raw) < 2 * self.size:
+            self.raw += self.last
+
+    @property
+    def free(self):
+        return self.size - self.length
+
+    @property
+    def full(self):
+        return self.length >= self.size
+
+    @property
+    def last(self):
+        """ The view of the last received chunk. """
+        return self._view[self.length:self.length + self._last]
+
+    @property
+    def audio(self):
+        """ The view of the kept audio. """
+        return self._view[:self.length]
+
+    def recv_into(self, sock, nbytes):
+        """ Receive max nbytes after the kept audio -> the bytes received (0: the connection closed, or full). """
+        nbytes = min(nbytes, self.free)
+        if nbytes <= 0:
+            self.truncated = True
+            return 0
+        self._last = sock.recv_into(self._view[self.length:self.length + nbytes])
+        self.received += self._last
+        self._tap()
+        return self._last
+
+    def put(self, data):
+        """ Same as recv_into(), for the audio already received (ak. the asyncio streams, the v2 frames). """
+        n = min(len(data), self.free)
+        self.truncated |= n < len(data)
+        self._view[self.length:self.length + n] = memoryview(data)[:n]
+        self._last = n
+        self.received += len(data)
+        self._tap()
+        return n
+
+    def commit(self, output=None):
+        """
+        Keep the last chunk (output None / the last chunk itself), or the given audio instead of it.
+        Returns:
+            memoryview: the audio kept (empty if nothing).
+        """
+        start = self.length
+        if output is None:
+            self.length += self._last
+        elif len(output):
+            if not (isinstance(output, memoryview) and output.obj is self._arena):
+                # ~ note: the pre-roll includes the last chunk, so it overwrites it.
+                n = min(len(output), self.free)
+                self.truncated |= n < len(output)
+                self._view[start:start + n] = memoryview(output)[:n]
+                self.length += n
+            else:
+                self.length += len(output)
+        self._last = 0
+        return self._view[start:self.length]
+
+
+class CapturePool:
+    """
+    Server-wide pool of the capture buffers (see CaptureBuffer), one leased per utterance being received.
+
+    The buffers are created on demand, and reused. Their memory is fixed: MAX_UTTERANCE_SEC of audio each, and
+    max MEMORY_BUDGET for all of them. So a stuck button, or a noisy microphone, or many long utterances at once,
+    can not grow the server memory: the utterance is cut at the max length, and over the budget the audio is dropped.
+
+    ~ note: a buffer is leased with a recognizer (EnginePool), so the servers reserve() one per possible recognizer
+            lease: min(the engine pool size, the max clients). Over MEMORY_BUDGET if needed: a command with
+            a recognizer always gets a buffer.
+    """
+    MAX_UTTERANCE_SEC = 10.0            # longer utterances are cut (the recording stops).
+    MEMORY_BUDGET = 4 * 1024 * 1024     # bytes for all the capture buffers (~13 utterances of 10 sec).
+    LEASE_TIMEOUT = 1.0                 # seconds to wait for a free buffer, when the budget is used.
+    SAMPLE_RATE = 16000
+    SAMPLE_WIDTH = 2
+
+    def __init__(self, max_utterance_sec=None, memory_budget=None):
+        self.max_utterance_sec = max_utterance_sec or CapturePool.MAX_UTTERANCE_SEC
+        self.buffer_size = int(self.max_utterance_sec * self.SAMPLE_RATE) * self.SAMPLE_WIDTH
+        self.capacity = max(1, (memory_budget or CapturePool.MEMORY_BUDGET) // self.buffer_size)
+
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._created = 0
+        self.truncated = 0  # utterances cut at the max length
+
+    def acquire(self, timeout=None):
+        """
+        Lease a (cleared) capture buffer. Must be given back with release().
+
+        Raises:
+            TimeoutError: the memory budget is used, and no buffer became free in `timeout` seconds.
+        """
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            create = self._created < self.capacity
+            if create:
+                self._created += 1
+        if create:
+            return CaptureBuffer(self.buffer_size)
+
+        try:
+            return self._idle.get(timeout=self.LEASE_TIMEOUT if timeout is None else timeout)
+        except queue.Empty:
+            raise TimeoutError(f"No free capture buffer (budget: {self.capacity} x {self.buffer_size // 1024} KB).")
+
+    def reserve(self, buffers):
+        """ At least `buffers` buffers can be created (the concurrent utterances, see the class note). """
+        with self._lock:
+            if buffers > self.capacity:
+                print(f"Capture buffers: {buffers} x {self.buffer_size // 1024} KB reserved "
+                      f"(over the {self.capacity} of the memory budget).")
+                self.capacity = buffers
+
+    def release(self, capture):
+        if capture.truncated:
+            self.truncated += 1
+        capture.clear()
+        self._idle.put(capture)
+
+    def stats(self):
+        return {"buffer_kb": self.buffer_size // 1024, "capacity": self.capacity, "created": self._created,
+                "idle": self._idle.qsize(), "truncated": self.truncated}
@@ -0,0 +1,164 @@
+import threading
+import time
+from collections import deque
+
+
+class ConnectionRegistry:
+    """
+    The client connections of a server, keyed by address and by device id (O(1) add / remove / lookup). Thread-safe.
+
+    Admission control, on every new connection (admit()):
+        - one session per device: a new connection of a device replaces its old one (ak. a half-open socket
+          after a WiFi blip, or a v2 device reconnecting). The old client is returned, to be closed.
+        - max MAX_RECONNECTS connections of a device per RECONNECT_WINDOW: a reconnect-looping device is refused,
+          so it can not keep the others busy with its connections and lease requests.
+        - load shedding: refused while more than MAX_BACKLOG utterances wait for a recognizer (the backlog function).
+        - max MAX_CLIENTS connections: at the limit, the new one is refused. A connected client is never evicted:
+          an intercom is silent until someone speaks, and an evicted one reconnects within seconds (with its error
+          beep), evicting the next one, in a loop when there are more devices than MAX_CLIENTS.
+    The dead connections end by themselves: the TCP keepalive (see TCPServer.run()) fails their reads.
+    sweep() returns the clients idle for IDLE_TIMEOUT (no data received), to be closed. See touch().
+    ~ note: IDLE_TIMEOUT is None by default: the keepalive probes are not data, a quiet device is not a dead one.
+
+    The server closes the returned clients (the registry does no socket IO), and removes the ended ones (remove()).
+
+    ~ note: the v1 device id is the IP address. The simulated clients (loadgen.py, bench_server.py) share one IP,
+            so they use device_limits=False (no single session / reconnect limit per device).
+    """
+    MAX_CLIENTS = 10
+    MAX_BACKLOG = 8             # utterances waiting for a recognizer. More -> the new connections are refused.
+    IDLE_TIMEOUT = None         # seconds with no data from a client -> closed (None: never, see the class note).
+    SWEEP_INTERVAL = 5.0        # seconds between the idle sweeps.
+    RECONNECT_WINDOW = 10.0     # seconds
+    MAX_RECONNECTS = 5          # connections of one device per RECONNECT_WINDOW. More -> refused.
+
+    def __init__(self, max_clients=None, backlog=None, device_limits=True):
+        """
+        Args:
+            backlog: function() -> the utterances waiting for a recognizer (ak. EnginePool.backlog). None: no shedding.
+        """
+        self.max_clients = max_clients or ConnectionRegistry.MAX_CLIENTS
+        self.backlog = backlog
+        self.device_limits = device_limits
+        self._lock = threading.Lock()
+        self._clients = {}      # address -> client
+        self._devices = {}      # device -> client
+        self._connects = {}     # device -> deque of the connection times (in the RECONNECT_WINDOW)
+        self._last_sweep = time.monotonic()
+        self.stats = {"admitted": 0, "replaced": 0, "idle_closed": 0,
+                      "refused_full": 0, "refused_backlog": 0, "refused_reconnects": 0}
+
+    def admit(self, client):
+        """
+        -> (refused reason or None, [the clients to close]). A refused client is not registered: close it.
+        The client needs `address` and `device` attributes.
+        """
+        now = time.monotonic()
+        with self._lock:
+            if self.device_limits and self._reconnecting(client.device, now):
+                return self._refuse("refused_reconnects",
+                                    f"more than {self.MAX_RECONNECTS} connections in {self.RECONNECT_WINDOW} sec")
+
+            if self.backlog is not None and self.backlog() > self.MAX_BACKLOG:
+                return self._refuse("refused_backlog", f"more than {self.MAX_BACKLOG} utterances waiting")
+
+            to_close = []
+            old = self._devices.get(client.device) if self.device_limits else None
+            if old is not None:
+                self._remove(old)
+                self.stats["replaced"] += 1
+                to_close.append(old)
+
+            if len(self._clients) >= self.max_clients:
+                return self._refuse("refused_full", f"{self.max_clients} clients connected", to_close)
+
+            client.last_active = now
+            self._clients[client.address] = client
+            self._devices[client.device] = client
+            self.stats["admitted"] += 1
+            return None, to_close
+
+    def _reconnecting(self, device, now):
+        connects = self._connects.setdefault(device, deque())
+        while connects and now - connects[0] > self.RECONNECT_WINDOW:
+            connects.popleft()
+        connects.append(now)
+        return len(connects) > self.MAX_RECONNECTS
+
+    def _refuse(self, key, reason, to_close=()):
+        self.stats[key] += 1
+        return reason, list(to_close)
+
+    def identify(self, client, device):
+        """ The device id of a connected client is known (ak. the v2 HELLO) -> [the old session of the device, to close]. """
+        with self._lock:
+            if self._clients.get(client.address) is not client:
+                client.device = device
+                return []
+            if self._devices.get(client.device) is client:
+                del self._devices[client.device]
+            client.device = device
+            old = self._devices.get(device) if self.device_limits else None
+            self._devices[device] = client
+            if old is None or old is client:
+                return []
+            self._clients.pop(old.address, None)
+            self.stats["replaced"] += 1
+            return [old]
+
+    def remove(self, client):
+        """ -> True if the client was registered. Can be called more than once. """
+        with self._lock:
+            return self._remove(client)
+
+    def _remove(self, client):
+        if self._clients.get(client.address) is not client:
+            return False
+        del self._clients[client.address]
+        if self._devices.get(client.device) is client:
+            del self._devices[client.device]
+        return True
+
+    def touch(self, client):
+        """ Data received from the client. """
+        client.last_active = time.monotonic()
+
+    def sweep(self):
+        """ -> [the clients idle for IDLE_TIMEOUT, removed: to close (none, if IDLE_TIMEOUT is None)].
+            Does nothing more often than SWEEP_INTERVAL.
+        """
+        now = time.monotonic()
+        if now - self._last_sweep < self.SWEEP_INTERVAL:
+            return []
+        self._last_sweep = now
+        with self._lock:
+            idle = []
+            if self.IDLE_TIMEOUT is not None:
+                idle = [client for client in self._clients.values()
+                        if now - self._last_active(client) > self.IDLE_TIMEOUT]
+            for client in idle:
+                self._remove(client)
+            self.stats["idle_closed"] += len(idle)
+            for device in [d for d, times in self._connects.items() if not times or now - times[-1] > self.RECONNECT_WINDOW]:
+                del self._connects[device]  # ~ note: the devices gone for long, not to grow forever.
+        return idle
+
+    @staticmethod
+    def _last_active(client):
+        return getattr(client, "last_active", 0.0)
+
+    def get(self, device):
+        return self._devices.get(device)
+
+    def __contains__(self, client):
+        return self._clients.get(client.address) is client
+
+    def __len__(self):
+        return len(self._clients)
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._clients.values()))  # ~ note: a snapshot, the clients may be removed meanwhile.
+
+    def report(self):
+        return {"connected": len(self._clients), "max": self.max_clients, **self.stats}
@@ -0,0 +1,95 @@
+import json
+import os
+import threading
+import time
+
+
+class DeviceManifest:
+    """
+    Server-side record of the mp3 files stored in the SPIFFS of each intercom, keyed by the device identity
+    (the device IP address for the v1 protocol devices).
+
+    Filled from the devices answers to the server-calls: [11] 'I have it', and [22] 'send it' + the transfer
+    (the ESP32 saves every received file, except the '/mp3respond.mp3').
+    When a file is known to be on the device, the server does not wait for the answer (see Speach.speak_transmit()).
+    A device which lost its files (ak. SPIFFS wiped, or a new device on the same IP) answers [22], and the file is sent anyway.
+    """
+    FILE = "tts/device_manifest.json"
+    NOT_STORED = ("/mp3respond.mp3",)  # files the ESP32 never keeps.
+
+    def __init__(self, path=FILE):
+        """ path=None -> memory only manifest. """
+        self.path = path
+        self._lock = threading.Lock()
+        self._devices = {}  # device -> {filename: last confirmed time}
+
+        if self.path:
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    self._devices = json.load(f)
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                print(f"ERR reading the device manifest, starting empty -> {e}")
+
+    def has(self, device, filename):
+        """ True if the device is known to have the file. """
+        if device is None:
+            return False
+        with self._lock:
+            return filename in self._devices.get(str(device), {})
+
+    def record(self, device, filename, stored=True):
+        """ Record a device answer: stored=True -> the device has the file (11, or 22 + sent), False -> it does not. """
+        if device is None or filename in self.NOT_STORED:
+            return
+        device = str(device)
+        with self._lock:
+            files = self._devices.setdefault(device, {})
+            changed = stored != (filename in files)
+            if stored:
+                files[filename] = time.time()
+            else:
+                files.pop(filename, None)
+            if changed:
+                self._save()
+
+    def forget_device(self, device):
+        with self._lock:
+            if self._devices.pop(str(device), None) is not None:
+                self._save()
+
+    def files(self, device):
+        with self._lock:
+            return sorted(self._devices.get(str(device), {}))
+
+    def _save(self):
+        """ Atomic save (a temp file, then rename). Called with the lock. """
+        if not self.path:
+            return
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self._devices, f, indent=1)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            print(f"ERR saving the device manifest -> {e}")
+
+
+class PendingAnswer:
+    """ A server-call sent without waiting for the device answer. The answer is handled by the client loop, when it comes. """
+    TIMEOUT = 5.0   # seconds. After this, a late answer is not expected anymore.
+
+    def __init__(self, device, filename, audio_content, path=None):
+        self.device = device
+        self.filename = filename
+        self.audio_content = audio_content
+        self.path = path    # the cache file of the audio, if on disk (sent with sendfile)
+        self.deadline = time.time() + self.TIMEOUT
+
+    @property
+    def expired(self):
+        return time.time() > self.deadline
+
+    def __repr__(self):
+        return f"PendingAnswer({self.device}, '{self.filename}')"
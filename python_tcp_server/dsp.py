@@ -0,0 +1,115 @@
+import math
+
+import numpy as np
+
+
+class AudioDSP:
+    """
+    Single pass, frame by frame audio conditioning for the recognizer, replacing the fixed GAIN_FACTOR amplification:
+
+    1. DC removal: the tracked mean of the signal (the ESP I2S microphones have an offset) is subtracted.
+    2. AGC: the gain follows the frame RMS level to TARGET_RMS, between MIN_GAIN and MAX_GAIN.
+       Fast attack (the voice gets louder -> the gain drops quickly, no clipping),
+       slow release (the voice gets quieter -> the gain rises slowly, the noise between the words is not pumped).
+       The gain is held on the frames below NOISE_GATE_RMS (silence is not amplified up to the target).
+       Inside a frame, the gain is ramped from the last gain to the new one (no steps between the frames).
+    3. Soft limiter: the samples over LIMITER_KNEE are compressed smoothly (tanh) under full scale, instead of clipped.
+
+    Works on any length (streaming chunks, or the full utterance in the batch mode), in blocks of FRAME_LENGTH samples.
+    All the state and the work buffers are preallocated: process() does not allocate (only numpy scalars).
+    """
+    SAMPLE_RATE = 16000
+    FRAME_LENGTH = 512      # samples. Same as the Rhino frame (0.032 sec).
+
+    TARGET_RMS = 3000.0     # the speech level for the recognizer (~ -21 dBFS)
+    MAX_GAIN = 30.0
+    MIN_GAIN = 0.5
+    INITIAL_GAIN = 10.0     # the old fixed GAIN_FACTOR, until the first speech frames.
+    NOISE_GATE_RMS = 40.0   # raw RMS under this -> the gain is held (the ESP silence level is ~76 in 16-bit)
+    ATTACK_SEC = 0.01
+    RELEASE_SEC = 0.5
+    DC_SEC = 0.5            # time constant of the DC (mean) tracking
+    LIMITER_KNEE = 24000.0  # samples over this are soft limited, to max 32767.
+
+    def __init__(self, sample_rate=None, frame_length=None, **params):
+        self.sample_rate = sample_rate or AudioDSP.SAMPLE_RATE
+        self.frame_length = frame_length or AudioDSP.FRAME_LENGTH
+        for name, value in params.items():
+            if not hasattr(AudioDSP, name.upper()):
+                raise ValueError(f"Unknown DSP parameter: {name}")
+            setattr(self, name.upper(), value)
+
+        frame_sec = self.frame_length / self.sample_rate
+        self._attack = math.exp(-frame_sec / self.ATTACK_SEC)
+        self._release = math.exp(-frame_sec / self.RELEASE_SEC)
+        self._dc_alpha = 1.0 - math.exp(-frame_sec / self.DC_SEC)
+
+        self._work = np.empty(self.frame_length, dtype=np.float32)
+        self._gains = np.empty(self.frame_length, dtype=np.float32)
+        self._magnitude = np.empty(self.frame_length, dtype=np.float32)
+        self._excess = np.empty(self.frame_length, dtype=np.float32)
+        self._over = np.empty(self.frame_length, dtype=bool)
+        self._steps = np.arange(1, self.frame_length + 1, dtype=np.float32)
+        # ~ note: the gain ramp of a frame of n samples: last gain + steps[:n] * (gain - last gain) / n
+        self.reset()
+
+    def reset(self):
+        """ Prepare for a new utterance. """
+        self.gain = float(self.INITIAL_GAIN)
+        self._dc = None
+        self.limited = 0    # samples soft limited, since the reset.
+
+    def process(self, src, dst):
+        """ src: int16 samples -> dst: int16 samples (same length, may be the same array). """
+        for start in range(0, len(src), self.frame_length):
+            end = min(start + self.frame_length, len(src))
+            self._process_frame(src[start:end], dst[start:end])
+
+    def _process_frame(self, src, dst):
+        n = len(src)
+        work = self._work[:n]
+        work[:] = src
+
+        # 1. DC removal
+        mean = float(work.mean())
+        self._dc = mean if self._dc is None else self._dc + self._dc_alpha * (mean - self._dc)
+        work -= self._dc
+
+        # 2. AGC
+        rms = math.sqrt(float(np.dot(work, work)) / n) if n else 0.0
+        last_gain = self.gain
+        if rms >= self.NOISE_GATE_RMS:
+            wanted = min(self.MAX_GAIN, max(self.MIN_GAIN, self.TARGET_RMS / rms))
+            coefficient = self._attack if wanted < last_gain else self._release
+            self.gain = wanted + coefficient * (last_gain - wanted)
+
+        if self.gain == last_gain:
+            work *= self.gain
+        else:
+            gains = self._gains[:n]
+            np.multiply(self._steps[:n], (self.gain - last_gain) / n, out=gains)
+            gains += last_gain
+            work *= gains
+
+        # 3. soft limiter
+        magnitude = self._magnitude[:n]
+        np.abs(work, out=magnitude)
+        peak = float(magnitude.max()) if n else 0.0
+        if peak > self.LIMITER_KNEE:
+            # |sample| over the knee -> knee + headroom * tanh(excess / headroom). The samples under it: excess 0.
+            headroom = 32767.0 - self.LIMITER_KNEE
+            over = self._over[:n]
+            np.greater(magnitude, self.LIMITER_KNEE, out=over)
+            self.limited += int(np.count_nonzero(over))
+            excess = self._excess[:n]
+            np.subtract(magnitude, self.LIMITER_KNEE, out=excess)
+            np.maximum(excess, 0.0, out=excess)
+            np.divide(excess, headroom, out=magnitude)  # ~ note: the magnitudes are not needed anymore.
+            np.tanh(magnitude, out=magnitude)
+            magnitude *= headroom
+            excess -= magnitude                         # the reduction of every sample magnitude
+            np.copysign(excess, work, out=excess)
+            work -= excess
+
+        np.clip(work, -32768, 32767, out=work)
+        dst[:] = work  # ~ note: float32 -> int16 (truncated)
@@ -0,0 +1,209 @@
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+
+from prerender import Prerenderer
+from capture import CapturePool
+from wakeword import WakeWordScheduler
+from arbiter import UtteranceArbiter
+
+
+def _recognizer():
+    from recognizer import Recognizer  # ~ note: pvrhino + numpy. Imported on the first use, not on the server start.
+    return Recognizer()
+
+
+def _decoder():
+    from recognizer import Decoder
+    return Decoder()
+
+
+def _speaker():
+    from speaker import Speach
+    return Speach()
+
+
+class EnginePool:
+    """
+    Server-wide pool of the voice engines, shared by all the client connections.
+
+    - Recognizers (a pvRhino model each) are created on demand, up to `size`, and then reused.
+      A client leases one for the time of an utterance and returns it, with the Rhino state reset.
+    - The Decoder and the Speach (one TTS client) are thread-safe and shared by all the clients.
+    - The capture buffers (the received audio of an utterance) are leased from `captures`, see capture.CapturePool
+    - The wake word detection of the hands-free streams runs on `wakeword`, see wakeword.WakeWordScheduler
+    - The same command heard by several devices is processed once, see `utterances` (arbiter.UtteranceArbiter)
+
+    ~ note: this way, a reconnect storm (ak. after a WiFi blip) does not load the model again for every connection,
+            and the memory stays the same, no matter of the connections count.
+
+    Fast start (background=True): the decoder, the speaker and the first recognizer are not created here,
+    but by start() in the background, after the server is listening (the imports, the Rhino model and the TTS client
+    take seconds on a Pi). `state` is 'starting' -> 'warming' -> 'ready' (or 'failed'), `ready` is set when 'ready'.
+    Until then, the clients answer the commands with the device stored STARTING_FILE (see starting_reply()).
+    """
+    SIZE = 4                # max recognizers (Rhino models) loaded. Also the max simultaneous speakers.
+    LEASE_TIMEOUT = 5.0     # seconds to wait for a free recognizer, before giving up.
+
+    STARTING_FILE = "/connecting0.mp3"      # on the device SPIFFS (the intercom firmware 'connecting' sound).
+    STARTING_AUDIO = "tts/offline_audio/not_connected2.mp3"  # sent, if a device answers it does not have the file.
+
+    def __init__(self, size=None, recognizer_factory=None, decoder_factory=None, speaker_factory=None,
+                 capture_factory=CapturePool, wakeword_factory=WakeWordScheduler, arbiter_factory=UtteranceArbiter,
+                 background=False, warm=1):
+        self.size = size or EnginePool.SIZE
+        self.warm = min(warm, self.size)  # recognizers loaded by the warm-up (ak. all the worker processes)
+        self._recognizer_factory = recognizer_factory or _recognizer
+        self._decoder_factory = decoder_factory or _decoder
+        self._speaker_factory = speaker_factory or _speaker
+
+        self._idle = queue.LifoQueue()  # ~ note: LIFO -> the last used (warm) recognizer is leased first.
+        self._created = []
+        self._lock = threading.Lock()
+        self._closed = False
+        self._waiting = 0  # acquire() calls waiting for a free recognizer: the recognition backlog.
+        self._starting_audio = None
+
+        self.state = "starting"
+        self.ready = threading.Event()
+        self.decoder = self.speaker = self.prerenderer = None
+        self.captures = capture_factory()
+        self.wakeword = wakeword_factory()  # ~ note: no detector loaded, until a device turns the hands-free mode on.
+        self.utterances = arbiter_factory()
+        if not background:
+            self._build()
+            self._set_state("ready")
+
+    def _build(self):
+        self.decoder = self._decoder_factory()
+        self.speaker = self._speaker_factory()
+        self.prerenderer = Prerenderer(self.speaker, self.decoder.known_responses() + self.speaker.fillers.texts())
+        self.speaker.keep_legacy_names(self.decoder.known_responses())
+
+    def _set_state(self, state):
+        self.state = state
+        if state == "ready":
+            self.ready.set()
+
+    def start(self):
+        """ Called on the server start, when it is listening: the warm-up (if background), then the pre-render. """
+        if self.ready.is_set():
+            self.start_prerender()
+        else:
+            threading.Thread(target=self._warm_up, name="engines-warm-up", daemon=True).start()
+
+    def _warm_up(self):
+        start = time.perf_counter()
+        self._set_state("warming")
+        try:
+            self._build()
+            # ~ note: the first Rhino model(s), loaded now, not by the first commands.
+            recognizers = [self.acquire() for _ in range(self.warm)]
+            for recognizer in recognizers:
+                self.release(recognizer)
+            for text in self.prerenderer.texts:
+                self.speaker.cache.get(text)  # the cached known responses, to the memory tier.
+        except Exception as e:
+            print(f"ERR warming up the engines -> {e}")
+            self._set_state("failed")
+            return
+        self._set_state("ready")
+        print(f"Engines ready in {time.perf_counter() - start:.2f} sec.")
+        self.start_prerender()
+
+    def starting_reply(self):
+        """ -> (the device file name, its audio or None): said to the commands received before the engines are ready. """
+        if self._starting_audio is None and os.path.exists(self.STARTING_AUDIO):
+            with open(self.STARTING_AUDIO, 'rb') as f:
+                self._starting_audio = f.read()
+        return self.STARTING_FILE, self._starting_audio
+
+    def start_prerender(self):
+        """ Start the background pre-render of the known responses (see prerender.Prerenderer). Called on the server start. """
+        self.prerenderer.start()
+
+    def acquire(self, timeout=None):
+        """
+        Lease a recognizer. Creates a new one, if all the created are in use and the pool is not full yet.
+        Must be given back with release().
+
+        Raises:
+            TimeoutError: no recognizer became free in `timeout` seconds (default: LEASE_TIMEOUT).
+        """
+        if self._closed:
+            raise RuntimeError("Engine pool is closed.")
+
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            create = len(self._created) < self.size
+            if create:
+                self._created.append(None)  # reserve the place, the model loads outside the lock.
+
+        if create:
+            try:
+                recognizer = self._recognizer_factory()
+            except Exception:
+                with self._lock:
+                    self._created.remove(None)
+                raise
+            with self._lock:
+                self._created[self._created.index(None)] = recognizer
+            print(f"Engine pool: recognizer created [{len(self._created)}/{self.size}].")
+            return recognizer
+
+        with self._lock:
+            self._waiting += 1
+        try:
+            return self._idle.get(timeout=self.LEASE_TIMEOUT if timeout is None else timeout)
+        except queue.Empty:
+            raise TimeoutError(f"No free recognizer in the engine pool (size={self.size}).")
+        finally:
+            with self._lock:
+                self._waiting -= 1
+
+    def release(self, recognizer):
+        """ Give back a leased recognizer. Its Rhino state is reset, ready for the next utterance. """
+        try:
+            recognizer.reset()
+        except Exception as e:
+            print(f"ERR resetting the recognizer -> {e}")
+
+        if self._closed:
+            recognizer.clear_res()
+        else:
+            self._idle.put(recognizer)
+
+    @contextmanager
+    def recognizer(self, timeout=None):
+        """ with pool.recognizer() as recognizer: ... -> lease a recognizer for one utterance. """
+        recognizer = self.acquire(timeout)
+        try:
+            yield recognizer
+        finally:
+            self.release(recognizer)
+
+    def backlog(self):
+        """ The utterances waiting for a free recognizer. See connections.ConnectionRegistry (load shedding). """
+        return self._waiting
+
+    def stats(self):
+        return {"size": self.size, "created": len(self._created), "idle": self._idle.qsize(), "waiting": self._waiting}
+
+    def close(self):
+        """ Free all the Rhino resources. The leased recognizers are freed when released. """
+        self._closed = True
+        while True:
+            try:
+                self._idle.get_nowait().clear_res()
+            except queue.Empty:
+                break
+        self.wakeword.close()
+        if self.decoder is not None:  # ~ note: None, if closed before the warm-up built them.
+            self.decoder.close()
+            self.speaker.close()
@@ -0,0 +1,187 @@
+"""
+Offline evaluation of the recognizer, over a corpus of labelled wav files and a grid of parameters.
+
+Every wav file of the corpus (16 kHz, 16-bit, mono) is recognized with Recognizer.process_audio_data(),
+for every combination of the parameters:
+    --gain          GAIN_FACTOR, or 'agc' (the AudioDSP automatic gain, see dsp.py)
+    --sensitivity   pvRhino sensitivity
+    --endpoint      pvRhino endpoint_duration_sec
+    --quiet-mode    the quiet end insert mode: 'split', 'extend', 'replace'
+    --quiet         the quiet end duration (seconds)
+The work runs on a process pool, one recognizer per worker (and per sensitivity / endpoint pair).
+Reported for each combination: accuracy, false understandings, frames processed and latency per utterance.
+
+Labels: the name of the wav parent directory is the expected intent ('none' -> must not be understood),
+    or a labels.csv in the corpus directory:  file,intent[,slot=value;slot=value]
+
+Engines (--engine):
+    rhino   -> the Picovoice model (Recognizer), needs the API key and the .rhn model in sr/.
+    stub    -> the deterministic stand-in (stubs.StubRhino): 'changeLightState' for any utterance with enough
+               loud frames. Checks the harness and the padding / gain effects, not the model.
+    module:function -> a custom engine factory: function(sensitivity, endpoint_duration_sec) -> a Recognizer.
+
+Run from the python_tcp_server/ directory:
+    python evaluate.py sr/corpus --engine stub --gain 5 10 20 --quiet-mode split extend replace
+"""
+import argparse
+import csv
+import importlib
+import itertools
+import os
+import sys
+import time
+from multiprocessing import Pool
+
+from loadgen import load_wav
+
+
+def rhino_engine(sensitivity, endpoint_duration_sec):
+    from recognizer import Recognizer
+    return Recognizer(sensitivity=sensitivity, endpoint_duration_sec=endpoint_duration_sec)
+
+
+def stub_engine(sensitivity, endpoint_duration_sec):
+    """ The stand-in: a higher sensitivity -> a lower speech level needed. """
+    from stubs import StubRecognizer, StubRhino
+    rhino = StubRhino(speech_threshold=int(2000 * (1.0 - sensitivity)),
+                      endpoint_frames=max(1, round(endpoint_duration_sec / 0.032)))
+    return StubRecognizer(rhino=rhino)
+
+
+ENGINES = {"rhino": rhino_engine, "stub": stub_engine}
+
+
+def engine_factory(name):
+    if name in ENGINES:
+        return ENGINES[name]
+    module_name, _, function_name = name.partition(":")
+    if not function_name:
+        raise ValueError(f"Unknown engine '{name}'. Use {', '.join(ENGINES)} or module:function.")
+    return getattr(importlib.import_module(module_name), function_name)
+
+
+def load_corpus(directory):
+    """ -> [(wav path, expected intent or None, expected slots or None), ...] """
+    labels_file = os.path.join(directory, "labels.csv")
+    corpus = []
+    if os.path.exists(labels_file):
+        with open(labels_file, newline="", encoding="utf-8") as f:
+            for row in csv.reader(f):
+                if not row or row[0].startswith("#") or row[0] == "file":
+                    continue
+                intent = row[1].strip() if len(row) > 1 else ""
+                slots = None
+                if len(row) > 2 and row[2].strip():
+                    slots = dict(pair.split("=", 1) for pair in row[2].strip().split(";"))
+                corpus.append((os.path.join(directory, row[0]), None if intent in ("", "none") else intent, slots))
+        return corpus
+
+    for root, _, files in sorted(os.walk(directory)):
+        for name in sorted(files):
+            if name.lower().endswith(".wav"):
+                intent = os.path.basename(root)
+                corpus.append((os.path.join(root, name), None if intent == "none" else intent, None))
+    return corpus
+
+
+# --- the worker processes ---
+
+_engine = None
+_recognizers = {}   # (sensitivity, endpoint) -> recognizer, of this worker
+_audio = {}         # wav path -> audio bytes, of this worker
+
+
+def _init_worker(engine_name, quiet):
+    global _engine
+    _engine = engine_factory(engine_name)
+    if quiet:
+        sys.stdout = open(os.devnull, "w")  # ~ note: the recognizer prints a lot on every utterance.
+
+
+def _evaluate(task):
+    """ One utterance, with one parameter set -> (params, correct, understood, frames, latency) """
+    params, path, intent, slots = task
+    gain, sensitivity, endpoint, quiet_mode, quiet_duration = params
+
+    recognizer = _recognizers.get((sensitivity, endpoint))
+    if recognizer is None:
+        recognizer = _recognizers[(sensitivity, endpoint)] = _engine(sensitivity, endpoint)
+    audio = _audio.get(path)
+    if audio is None:
+        audio = _audio[path] = load_wav(path)
+
+    recognizer.reset()
+    start = time.perf_counter()
+    result = recognizer.process_audio_data(audio, gain_factor=None if gain == "agc" else gain,
+                                           quiet_duration=quiet_duration, insert_mode=quiet_mode)
+    latency = time.perf_counter() - start
+
+    if result is None:
+        correct = intent is None
+    else:
+        correct = result[0] == intent and (slots is None or dict(result[1]) == slots)
+    return params, correct, result is not None, recognizer.frames_processed, latency
+
+
+def evaluate(corpus, grid, engine="stub", workers=None, quiet=True):
+    """ -> {params: {"n", "correct", "false_accepts", "frames", "latencies"}} """
+    tasks = [(params, path, intent, slots) for params in grid for path, intent, slots in corpus]
+    stats = {params: {"n": 0, "correct": 0, "false_accepts": 0, "frames": 0, "latencies": []} for params in grid}
+    expected = {path: intent for path, intent, _ in corpus}
+
+    with Pool(processes=workers, initializer=_init_worker, initargs=(engine, quiet)) as pool:
+        for (params, correct, understood, frames, latency), task in zip(pool.imap(_evaluate, tasks, chunksize=4), tasks):
+            s = stats[params]
+            s["n"] += 1
+            s["correct"] += correct
+            s["false_accepts"] += understood and expected[task[1]] is None
+            s["frames"] += frames
+            s["latencies"].append(latency)
+    return stats
+
+
+def report(stats):
+    def pct(values, p):
+        values = sorted(values)
+        return values[min(len(values) - 1, int(len(values) * p / 100))] if values else float('nan')
+
+    lines = [f"{'gain':>6}{'sens':>7}{'endp':>7}{'mode':>9}{'quiet':>7}{'accuracy':>10}{'false acc':>11}"
+             f"{'frames':>9}{'p50 ms':>9}{'p95 ms':>9}"]
+    ranked = sorted(stats.items(), key=lambda item: (-item[1]["correct"], item[1]["frames"]))
+    for (gain, sensitivity, endpoint, quiet_mode, quiet_duration), s in ranked:
+        n = max(s["n"], 1)
+        lines.append(f"{gain:>6}{sensitivity:>7.2f}{endpoint:>7.2f}{quiet_mode:>9}{quiet_duration:>7.2f}"
+                     f"{s['correct'] / n * 100:>9.1f}%{s['false_accepts']:>11}{s['frames'] / n:>9.1f}"
+                     f"{pct(s['latencies'], 50) * 1000:>9.2f}{pct(s['latencies'], 95) * 1000:>9.2f}")
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("corpus", help="directory of the labelled wav files")
+    parser.add_argument("--engine", default="stub", help="'rhino', 'stub' or module:function")
+    parser.add_argument("--gain", type=lambda value: value if value == "agc" else int(value), nargs="+", default=["agc"])
+    parser.add_argument("--sensitivity", type=float, nargs="+", default=[0.35])
+    parser.add_argument("--endpoint", type=float, nargs="+", default=[0.8])
+    parser.add_argument("--quiet-mode", nargs="+", default=["split"], choices=["split", "extend", "replace"])
+    parser.add_argument("--quiet", type=float, nargs="+", default=[1.0], help="quiet end duration (seconds)")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: the CPU count)")
+    parser.add_argument("--verbose", action="store_true", help="show the recognizer output of the workers")
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.corpus)
+    if not corpus:
+        print(f"No wav files found in {args.corpus}")
+        return
+    grid = list(itertools.product(args.gain, args.sensitivity, args.endpoint, args.quiet_mode, args.quiet))
+    print(f"Corpus: {len(corpus)} utterances, {sum(1 for _, intent, _ in corpus if intent is None)} negatives. "
+          f"Grid: {len(grid)} parameter sets. Engine: {args.engine}")
+
+    start = time.perf_counter()
+    stats = evaluate(corpus, grid, engine=args.engine, workers=args.workers, quiet=not args.verbose)
+    print(report(stats))
+    print(f"{len(corpus) * len(grid)} recognitions in {time.perf_counter() - start:.1f} sec")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+import itertools
+import threading
+
+from metrics import Histogram
+
+
+class FillerPolicy:
+    """
+    Latency hiding: when the response is not in the cache (a TTS synthesis is needed), the device is first called with
+    a short filler phrase it keeps in its SPIFFS ('On it.'), answered [11] -> no audio sent, played at once.
+    The real response is synthesized meanwhile, and called after.
+
+    The filler is said only if the synthesis is expected to take longer than MIN_WAIT_SEC (still to go):
+    expected = SYNTH_BASE_SEC + the per character time, learned from the measured syntheses (learn()),
+    and not less than the median of the measured synthesis times (a network TTS: mostly a fixed round-trip).
+    ~ note: the known responses pre-rendered on the server start are the first measures (see prerender.py).
+
+    ~ note: the v1 firmware waits 1 sec for the audio data after its [11] / [22] answer, reading anything received,
+            and it only reads a server-call when exactly 29 bytes are available. So the next server-call must come
+            after the device wait (next_call_at()): the filler pays off for the long syntheses only (MIN_WAIT_SEC).
+    """
+    FILLERS = {             # device file name -> text (the audio sent, if the device does not have the file)
+        "/onit.mp3": "On it.",
+        "/rightaway.mp3": "Right away.",
+        "/sure.mp3": "Sure.",
+        "/ok.mp3": "OK.",
+    }
+    MIN_WAIT_SEC = 0.8          # expected synthesis time still to go, to say a filler.
+    # ~ note: the response is called DEVICE_WAIT_SEC + DEVICE_MARGIN_SEC after the filler answer: max 0.4 sec later.
+    SYNTH_BASE_SEC = 0.3        # the synthesis time estimate: SYNTH_BASE_SEC + len(text) x the per char time.
+    SYNTH_PER_CHAR_SEC = 0.01   # initial per char time, until measured.
+    ALPHA = 0.2                 # the per char time tracking speed (exponential average).
+    MIN_MEASURED = 3            # measured syntheses, before their median is used.
+    DEVICE_WAIT_SEC = 1.0       # the firmware wait for the audio data, after its answer.
+    DEVICE_MARGIN_SEC = 0.2
+    MP3_BITRATE = 64000         # bits per second: the device plays a received filler this long.
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.per_char = self.SYNTH_PER_CHAR_SEC
+        self.synth = Histogram()    # the measured synthesis times. See learn()
+        self._cycle = itertools.cycle(self.FILLERS)
+        self._lock = threading.Lock()
+        self.sent = 0
+        self.skipped = 0    # not cached responses, expected to be synthesized fast enough
+
+    def expected(self, text):
+        """ The expected synthesis time of the text (seconds). """
+        expected = self.SYNTH_BASE_SEC + self.per_char * len(text)
+        if self.synth.count >= self.MIN_MEASURED:
+            expected = max(expected, self.synth.percentile(50))
+        return expected
+
+    def learn(self, text, seconds):
+        """ A measured synthesis time. """
+        with self._lock:
+            self.synth.record(seconds)
+        if text:
+            per_char = max(0.0, seconds - self.SYNTH_BASE_SEC) / len(text)
+            self.per_char += self.ALPHA * (per_char - self.per_char)
+
+    def choose(self, text, elapsed=0.0):
+        """ -> the filler device file name to say now, or None. elapsed: the synthesis time already gone. """
+        if not self.enabled:
+            return None
+        if self.expected(text) - elapsed < self.MIN_WAIT_SEC:
+            with self._lock:
+                self.skipped += 1
+            return None
+        with self._lock:
+            self.sent += 1
+            return next(self._cycle)
+
+    def text(self, filename):
+        return self.FILLERS[filename]
+
+    def texts(self):
+        """ The filler texts, pre-rendered on the server start (sent if a device answers [22]). """
+        return list(self.FILLERS.values())
+
+    def next_call_at(self, done, sent_bytes=0):
+        """ The earliest time (perf_counter) for the next server-call, after the filler call was done at `done`. """
+        wait = 0.1 if sent_bytes else self.DEVICE_WAIT_SEC  # ~ note: after the last received data, the device waits 0.1 sec.
+        return done + wait + self.DEVICE_MARGIN_SEC + sent_bytes * 8 / self.MP3_BITRATE
+
+    def stats(self):
+        return {"sent": self.sent, "skipped": self.skipped, "per_char_ms": round(self.per_char * 1000, 2),
+                "synth_p50_ms": round(self.synth.percentile(50) * 1000, 1)}
@@ -0,0 +1,289 @@
+"""
+The v1 protocol steps after the audio (sans-IO), shared by the threaded (tcp_client.Client) and the asyncio
+(async_server.AsyncClient) servers:
+    - transmit()          the response: a filler while it is synthesized, the server-call, the [11] / [22] answer,
+                          the mp3 transfer. A device known to have the file is not waited for (PendingAnswer).
+    - send_filler()       a call with a device stored filler file (see filler.FillerPolicy)
+    - complete_pending()  the late answer to a not waited server-call
+    - send_audio()        the mp3 transfer: from the cache file (sendfile) or from memory, in TRANSFER_CHUNK parts
+    - starting_reply()    the 'connecting' call, to a command received before the engines are ready
+    - busy_reply()        the BUSY response, to a command with no free recognizer (or capture buffer)
+    - drain()             drop the rest of the device audio stream
+
+The steps are generators: they yield the IO they need, and get its result back:
+    ("send", data, timeout)                    -> None              write all the data
+    ("sendfile", file, offset, count, timeout) -> the bytes sent    send a part of a file (os.sendfile when possible)
+    ("recv", size, timeout)                    -> bytes, b'' (closed) or None (timed out)
+    ("call", func, *args)                      -> func(*args)       a blocking call (the TTS / the disk)
+    ("wait", future)                           -> the future result
+    ("sleep", seconds)                         -> None
+The IO errors are thrown into the generator. run() is the driver on a blocking socket, the asyncio one is
+AsyncClient._run().
+"""
+import os
+import time
+
+from device_manifest import PendingAnswer
+from metrics import span
+
+CALL_SIZE = 29          # the server-call: the device file name, zero padded.
+ANSWER_TIMEOUT = 1.0    # waiting for the [11] / [22] answer, after a server-call.
+ANSWER_ATTEMPTS = 3
+DRAIN_TIMEOUT = 0.15    # after an early stop, the rest of the device audio stream ends when nothing comes this long.
+
+
+def server_call(filename):
+    """ The 29 bytes server-call of the device file. """
+    return filename.encode('utf-8').ljust(CALL_SIZE, b'\x00')
+
+
+def drain(first_timeout=None, timeout=DRAIN_TIMEOUT):
+    """ Consume (and drop) the rest of the device audio stream -> the bytes dropped.
+        ~ note: done as soon as the device stops sending for `timeout` seconds (first_timeout for the first data).
+    """
+    drained = 0
+    try:
+        wait = first_timeout or timeout
+        while True:
+            chunk = yield ("recv", 4096, wait)
+            if not chunk:
+                break
+            drained += len(chunk)
+            wait = timeout
+    except Exception as e:
+        print(f"[ERR] while draining the audio stream: {e}")
+    print(f"Audio stream drained [{drained} bytes dropped].")
+    return drained
+
+
+def send_audio(speaker, audio_content, path=None, trace=None, progress=None):
+    """
+    The mp3 transfer. From the cache file (path) with sendfile (no copy through Python), else from memory.
+    In TRANSFER_CHUNK parts, with progress(sent, total) after each, TRANSFER_TIMEOUT seconds for the whole transfer.
+    Accounted in speaker.transfers -> the bytes sent.
+
+    Raises:
+        TimeoutError, OSError: the transfer did not complete.
+    """
+    audio_file = None
+    if path:
+        try:
+            audio_file = open(path, 'rb')
+            total = os.fstat(audio_file.fileno()).st_size
+        except OSError:
+            audio_file = None  # ~ note: evicted from the disk meanwhile. Sent from memory.
+    if audio_file is None:
+        total = len(audio_content)
+        view = memoryview(audio_content)
+
+    start = time.perf_counter()
+    deadline = start + speaker.TRANSFER_TIMEOUT
+    sent = 0
+    try:
+        with span(trace, "send"):
+            while sent < total:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    raise TimeoutError(f"mp3 transfer timed out ({sent} of {total} bytes sent)")
+                count = min(speaker.TRANSFER_CHUNK, total - sent)
+                if audio_file is not None:
+                    done = yield ("sendfile", audio_file, sent, count, remaining)
+                else:
+                    yield ("send", view[sent:sent + count], remaining)
+                    done = count
+                if not done:
+                    raise ConnectionError(f"mp3 transfer interrupted ({sent} of {total} bytes sent)")
+                sent += done
+                if progress is not None:
+                    progress(sent, total)
+    except Exception:
+        speaker.transfers["errors"] += 1
+        raise
+    finally:
+        if audio_file is not None:
+            audio_file.close()
+
+    speaker.transfers["count"] += 1
+    speaker.transfers["bytes"] += sent
+    speaker.transfers["sendfile"] += audio_file is not None
+    print(f"Audio data sent [{sent} bytes, {'sendfile' if audio_file is not None else 'memory'}] "
+          f"in {(time.perf_counter() - start) * 1000:.1f} ms.")
+    return sent
+
+
+def on_answer(speaker, answer, device, filename, audio_content, trace=None, path=None):
+    """ The [11] / [22] answer of the device to a server-call. Recorded in the device manifest. """
+    if answer == 22:
+        print("ESP32 ready to receive audio data...")
+        print(f"Streaming audio [{len(audio_content)} bytes] --TCP--> to ESP32...")
+        yield from send_audio(speaker, audio_content, path=path, trace=trace)
+    else:
+        print("ESP32 has the audio data pre-recorded. Do not send.")
+    speaker.manifest.record(device, filename, stored=True)  # ~ note: the ESP saves every received file.
+    return True
+
+
+def complete_pending(speaker, pending, answer):
+    """ The late answer to a not waited server-call (see transmit()). """
+    if answer == 22:
+        print(f"ESP32 does not have '{pending.filename}' anymore (SPIFFS wiped?). Sending it...")
+        speaker.manifest.record(pending.device, pending.filename, stored=False)
+    return (yield from on_answer(speaker, answer, pending.device, pending.filename, pending.audio_content,
+                                 path=pending.path))
+
+
+def call(speaker, filename, audio_content, device=None, trace=None, path=None):
+    """
+    Call the device with the file, and send the mp3 data if it does not have it.
+    Returns:
+        True if done, PendingAnswer if not waited for the answer (the manifest says the device has the file),
+        False on error.
+    """
+    try:
+        handshake_start = time.perf_counter()
+        yield ("send", server_call(filename), None)
+        print("Server-Call signal sent")
+
+        if speaker.manifest.has(device, filename):
+            # the device has the file (known from its past answers). It will answer [11] and play it.
+            # ~ note: no WiFi round-trip wait. The answer is read later by the client loop.
+            print(f"ESP32 has '{filename}' (device manifest). Not waiting for the answer.")
+            return PendingAnswer(device, filename, audio_content, path=path)
+
+        for attempt in range(ANSWER_ATTEMPTS):
+            response = yield ("recv", 1, ANSWER_TIMEOUT)
+            if response and response[0] in (11, 22):
+                if trace is not None:
+                    trace.add("handshake", time.perf_counter() - handshake_start)
+                return (yield from on_answer(speaker, response[0], device, filename, audio_content, trace, path=path))
+            print(f"{'Unexpected' if response else 'No'} response from ESP32, "
+                  f"try more {ANSWER_ATTEMPTS - 1 - attempt} times.")
+            if response == b'':
+                break  # ~ note: the connection is closed.
+
+    except Exception as e:
+        print(f"ERR while speak_transmit: {e}")
+    return False
+
+
+def send_filler(speaker, filename, device=None, trace=None):
+    """
+    Call the device with a filler file, and wait for its answer ([22] -> the filler audio is sent).
+    Returns:
+        float: the earliest time (perf_counter) for the next server-call, or None if the device did not answer.
+    """
+    with span(trace, "filler"):
+        yield ("send", server_call(filename), None)
+        print(f"Filler Server-Call signal sent: {filename}")
+        try:
+            response = yield ("recv", 1, ANSWER_TIMEOUT)
+        except Exception as e:
+            print(f"ERR: no answer to the filler call -> {e}")
+            return None
+        if not response or response[0] not in (11, 22):
+            print(f"Unexpected answer to the filler call: {response}")
+            return None
+
+        audio_content = None
+        if response[0] == 22:
+            text = speaker.fillers.text(filename)
+            audio_content = yield ("call", speaker.get_audio, text, True)
+            if not audio_content:
+                return None
+            yield from on_answer(speaker, 22, device, filename, audio_content, path=speaker.cache.path(text))
+        else:
+            speaker.manifest.record(device, filename, stored=True)
+    return speaker.fillers.next_call_at(time.perf_counter(), len(audio_content or b''))
+
+
+def transmit(speaker, text, device=None, audio_future=None, save_it=False, trace=None):
+    """
+    Speak the response text on the device: its audio (cached or synthesized), then call() with its file.
+    audio_future: the audio prepared in the background (Speach.prepare_audio()), or None -> get_audio() now.
+            While it is not ready, a filler may be said first (see filler.FillerPolicy).
+    Returns: as call(), None if no audio.
+    """
+    if audio_future is None:
+        audio_content = yield ("call", speaker.get_audio, text, save_it, True, trace)
+    else:
+        filler = speaker.filler_for(text, audio_future)
+        next_call_at = (yield from send_filler(speaker, filler, device, trace)) if filler else None
+        audio_content = yield ("wait", audio_future)
+        if next_call_at is not None:
+            # ~ note: the device still waits for the filler data, the server-call would be read as it.
+            yield ("sleep", max(0.0, next_call_at - time.perf_counter()))
+
+    if not audio_content:
+        print("No audio content collected. Transmit terminated.")
+        return None
+    return (yield from call(speaker, speaker.device_filename(text), audio_content, device, trace,
+                            path=speaker.cache.path(text)))
+
+
+def starting_reply(engines):
+    """ A command received before the engines are ready: the audio is dropped,
+        and the device is called with its stored 'connecting' file (EnginePool.starting_reply()).
+    """
+    yield from drain(first_timeout=1.0)  # ~ note: the device starts sending on the [202].
+    filename, audio_content = engines.starting_reply()
+    yield ("send", server_call(filename), None)
+    print(f"Engines {engines.state}. Starting Server-Call signal sent: {filename}")
+    response = yield ("recv", 1, ANSWER_TIMEOUT)
+    if response and response[0] == 22 and audio_content:
+        yield ("send", audio_content, None)
+        print(f"Starting audio sent [{len(audio_content)} bytes].")
+
+
+def busy_reply(engines, device=None, trace=None):
+    """ A command not processed (no free recognizer or capture buffer): its audio is dropped,
+        and the device says the BUSY response (a known response: pre-rendered, see Decoder.known_responses()).
+        Returns: as transmit().
+    """
+    yield from drain()
+    return (yield from transmit(engines.speaker, engines.decoder.intents.BUSY, device, trace=trace))
+
+
+def run(steps, sock):
+    """ Run the steps on a blocking socket -> their result. """
+    result, error = None, None
+    while True:
+        try:
+            op = steps.throw(error) if error is not None else steps.send(result)
+        except StopIteration as stop:
+            return stop.value
+        result, error = None, None
+        try:
+            result = _execute(sock, op)
+        except Exception as e:
+            error = e
+
+
+def _execute(sock, op):
+    kind = op[0]
+    if kind == "call":
+        return op[1](*op[2:])
+    if kind == "wait":
+        return op[1].result()
+    if kind == "sleep":
+        time.sleep(op[1])
+        return None
+
+    timeout = op[-1]
+    saved = sock.gettimeout()
+    if timeout is not None:
+        sock.settimeout(timeout)
+    try:
+        if kind == "send":
+            sock.sendall(op[1])
+            return None
+        if kind == "sendfile":
+            return sock.sendfile(op[1], offset=op[2], count=op[3])
+        if kind == "recv":
+            try:
+                return sock.recv(op[1])
+            except TimeoutError:
+                return None
+        raise ValueError(f"Unknown IO step: {kind}")
+    finally:
+        if timeout is not None:
+            sock.settimeout(saved)
@@ -0,0 +1,224 @@
+import itertools
+import string
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+
+ActionResult = namedtuple("ActionResult", "intent slots device status value error elapsed")
+# ~ note: status: 'ok', 'error', 'timeout' (the action still runs, its result is ignored), 'rejected' (executor full)
+
+
+class IntentHandler:
+    """
+    One intent: the slot validation, the spoken response, and the action (the side effect: ak. switch a light).
+
+    slots: {slot name: allowed values (a collection), or a check function(value) -> bool, or None (any value)}
+    required: the slot names that must be in the Rhino result.
+    defaults: the values of the optional slots, when not said (ak. {"location": "kitchen"}).
+    response: the text spoken back. A format string of the slots ("Turning the {location} light {state}."),
+              or a function(slots) -> text.
+    action: function(slots) -> any. Runs on the IntentRegistry executor, never on the client thread.
+    """
+    def __init__(self, intent, action=None, response=None, slots=None, required=(), defaults=None, timeout=None):
+        self.intent = intent
+        self.action = action
+        self.response = response
+        self.slots = slots or {}
+        self.required = tuple(required)
+        self.defaults = defaults or {}
+        self.timeout = timeout
+
+    def validate(self, slots):
+        """ -> None if the slots are valid, else the reason. """
+        for name in self.required:
+            if name not in slots:
+                return f"missing slot '{name}'"
+        for name, value in slots.items():
+            if name not in self.slots:
+                return f"unknown slot '{name}'"
+            allowed = self.slots[name]
+            if allowed is None:
+                continue
+            if callable(allowed) and not allowed(value) or not callable(allowed) and value not in allowed:
+                return f"invalid value '{value}' of slot '{name}'"
+        return None
+
+    def respond(self, slots):
+        if self.response is None:
+            return None
+        if callable(self.response):
+            return self.response(slots)
+        return self.response.format_map(_Slots(slots))
+
+    def responses(self, limit):
+        """ The response texts this handler can give, if they can be listed (max `limit`). See Decoder.known_responses() """
+        if self.response is None or callable(self.response):
+            return []
+        names = [field for _, field, _, _ in string.Formatter().parse(self.response) if field]
+        if not names:
+            return [self.response]
+        values = [self.slots.get(name) for name in names]
+        if any(v is None or callable(v) for v in values):
+            return []
+        texts = []
+        for combination in itertools.islice(itertools.product(*values), limit):
+            texts.append(self.response.format_map(dict(zip(names, combination))))
+        return texts
+
+
+class _Slots(dict):
+    def __missing__(self, key):
+        return ""  # ~ note: an optional slot not said -> empty in the response.
+
+
+class IntentRegistry:
+    """
+    The intent handlers of the Decoder, and the bounded executor running their actions.
+
+    dispatch() validates the slots and returns the response text at once. The action is submitted to the executor,
+    so the voice response never waits for a device: a slow or hung device call delays nothing but itself.
+    The action end (ok / error / timeout) is reported to the completion callbacks, with an ActionResult.
+
+        registry = IntentRegistry()
+
+        @registry.intent("changeLightState", slots={"location": ("kitchen", "bedroom"), "state": ("on", "off")},
+                         required=("state",), defaults={"location": "kitchen"}, response="Turning the {location} light {state}.")
+        def change_light(slots):
+            lights.set(slots["location"], slots["state"] == "on")
+
+    ~ note: a Python thread can not be stopped. A timed out action is reported as 'timeout' and keeps its worker
+            until it returns, so MAX_PENDING bounds the actions queued + running (more -> 'rejected', BUSY spoken).
+    """
+    WORKERS = 4             # actions running at once
+    MAX_PENDING = 32        # actions queued + running. More -> rejected.
+    TIMEOUT = 5.0           # seconds for an action, if its handler has no timeout.
+    EXPANSION_LIMIT = 64    # max listed responses of a handler (the pre-render of the slot combinations).
+
+    INVALID = "Sorry, I can not do that."
+    BUSY = "Sorry, I am busy now. Try again later."
+
+    def __init__(self, workers=None, max_pending=None):
+        self.workers = workers or IntentRegistry.WORKERS
+        self.max_pending = max_pending or IntentRegistry.MAX_PENDING
+        self._handlers = {}
+        self._callbacks = []
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="intent-action")
+        self._lock = threading.Lock()
+        self._pending = 0
+        self.stats = {"dispatched": 0, "invalid": 0, "ok": 0, "error": 0, "timeout": 0, "rejected": 0}
+
+    def register(self, intent, action=None, response=None, slots=None, required=(), defaults=None, timeout=None):
+        handler = IntentHandler(intent, action, response, slots, required, defaults, timeout)
+        self._handlers[intent] = handler
+        return handler
+
+    def intent(self, intent, **kwargs):
+        """ Decorator version of register(): the decorated function is the action. """
+        def decorator(action):
+            self.register(intent, action=action, **kwargs)
+            return action
+        return decorator
+
+    def add_callback(self, callback):
+        """ callback(ActionResult), called on every action end (on the executor thread, or the timeout timer). """
+        self._callbacks.append(callback)
+
+    def __contains__(self, intent):
+        return intent in self._handlers
+
+    def dispatch(self, intent, slots, device=None, callback=None, run=True):
+        """
+        Validate the slots, start the action (not waited, and only if run), and return the response text.
+        Returns None if no handler is registered for the intent (the Decoder default response is used).
+        """
+        handler = self._handlers.get(intent)
+        if handler is None:
+            return None
+        reason = handler.validate(slots)
+        if reason is not None:
+            print(f"Intent '{intent}' rejected: {reason}.")
+            self._count("invalid")
+            return self.INVALID
+        slots = dict(handler.defaults, **slots)
+
+        response = handler.respond(slots)
+        if handler.action is not None and run:
+            if not self._submit(handler, slots, device, callback):
+                return self.BUSY
+        self._count("dispatched")
+        return response
+
+    def _submit(self, handler, slots, device, callback):
+        with self._lock:
+            if self._pending >= self.max_pending:
+                full = True
+            else:
+                full = False
+                self._pending += 1
+        if full:
+            self._report(ActionResult(handler.intent, slots, device, "rejected", None, "too many pending actions", 0.0),
+                         callback)
+            return False
+
+        state = {"reported": False, "start": time.perf_counter()}
+        timer = threading.Timer(handler.timeout or self.TIMEOUT, self._on_timeout, (handler, slots, device, callback, state))
+        timer.daemon = True
+        state["timer"] = timer
+        self._executor.submit(self._run, handler, slots, device, callback, state)
+        return True
+
+    def _run(self, handler, slots, device, callback, state):
+        # ~ note: the timeout counts from the action start, not from the submit (the queue time is not the device's).
+        state["start"] = time.perf_counter()
+        state["timer"].start()
+        try:
+            value, error, status = handler.action(slots), None, "ok"
+        except Exception as e:
+            value, error, status = None, str(e), "error"
+        finally:
+            state["timer"].cancel()
+            with self._lock:
+                self._pending -= 1
+        self._finish(ActionResult(handler.intent, slots, device, status, value, error,
+                                  time.perf_counter() - state["start"]), callback, state)
+
+    def _on_timeout(self, handler, slots, device, callback, state):
+        self._finish(ActionResult(handler.intent, slots, device, "timeout", None,
+                                  f"no result in {handler.timeout or self.TIMEOUT} sec",
+                                  time.perf_counter() - state["start"]), callback, state)
+
+    def _finish(self, result, callback, state):
+        with self._lock:
+            if state["reported"]:
+                return  # ~ note: the late end of a timed out action.
+            state["reported"] = True
+        self._report(result, callback)
+
+    def _count(self, key):
+        with self._lock:
+            self.stats[key] += 1
+
+    def _report(self, result, callback):
+        self._count(result.status)
+        if result.status != "ok":
+            print(f"Intent action '{result.intent}' {result.status}: {result.error}")
+        for function in self._callbacks + ([callback] if callback is not None else []):
+            try:
+                function(result)
+            except Exception as e:
+                print(f"ERR in the intent action callback -> {e}")
+
+    def responses(self):
+        """ The response texts that can be listed, of all the handlers. """
+        texts = [self.INVALID, self.BUSY]
+        for handler in self._handlers.values():
+            texts.extend(handler.responses(self.EXPANSION_LIMIT))
+        return texts
+
+    def pending(self):
+        return self._pending
+
+    def close(self, wait=True):
+        self._executor.shutdown(wait=wait)
@@ -0,0 +1,329 @@
+"""
+Load generator: simulated ESP32 intercoms, speaking the same protocol as the intercom_v01 firmware.
+
+    [101] -> [202] -> audio at real-time pace (512 bytes chunks, 16 kHz 16-bit mono)
+          -> 29 bytes server-call -> [11] 'I have it' / [22] 'send it' -> the mp3 data
+
+~ note: like the ESP, a device does not read while it is recording. It only watches when the first response byte
+        arrives (without reading it), for the 'end of speech -> first response byte' latency.
+
+By default the server (TCPServer, or AsyncTCPServer with --impl asyncio) runs in a child process with the stub engines
+(stubs.py), so no Picovoice model, TTS account or intercom is needed. Use --host / --port for a running server.
+
+Run from the python_tcp_server/ directory:
+    python loadgen.py --devices 20 --commands 5
+    python loadgen.py --devices 5 --wav sr/test/lights_on.wav --answer first-22
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import select
+import socket
+import struct
+import sys
+import threading
+import time
+import wave
+
+HOST = "127.0.0.1"
+SIM_MAX_CLIENTS = 10000                         # the server connection limit, in the simulations
+
+SAMPLE_RATE = 16000
+CHUNK_SIZE = 512                                # bytes per chunk, same as the ESP
+CHUNK_SEC = CHUNK_SIZE / 2 / SAMPLE_RATE        # 0.016 sec
+SERVER_CALL_SIZE = 29
+SPEECH_LEVEL = 1000                             # a chunk with a sample above this is speech (for the end of speech time)
+
+
+def load_wav(file_name):
+    """ 16 kHz 16-bit mono wav -> raw audio bytes. """
+    with wave.open(file_name, "rb") as wav_file:
+        if wav_file.getframerate() != SAMPLE_RATE or wav_file.getsampwidth() != 2 or wav_file.getnchannels() != 1:
+            raise ValueError(f"{file_name}: a 16 kHz, 16-bit, mono wav file is expected.")
+        return wav_file.readframes(wav_file.getnframes())
+
+
+def synthetic_utterance(speech_sec=0.5, silence_sec=1.0, amplitude=3000):
+    """ A square wave 'speech', followed by silence (the ESP keeps sending until its silence timeout). """
+    speech = struct.pack('<256h', *([amplitude, -amplitude] * 128)) * int(speech_sec / CHUNK_SEC)
+    return speech + bytes(CHUNK_SIZE * int(silence_sec / CHUNK_SEC))
+
+
+def speech_end(audio):
+    """ The offset (bytes) after the last chunk with speech in it. """
+    end = 0
+    for offset in range(0, len(audio), CHUNK_SIZE):
+        chunk = audio[offset:offset + CHUNK_SIZE]
+        if chunk and max(abs(v) for v in struct.unpack(f"<{len(chunk) // 2}h", chunk)) > SPEECH_LEVEL:
+            end = offset + len(chunk)
+    return end
+
+
+class AnswerPolicy:
+    """
+    How a device answers the server-calls:
+        '11'        -> always 'I have it'
+        '22'        -> always 'send it'
+        'first-22'  -> 'send it' the first time of every file, then 'I have it' (a real device saving to SPIFFS)
+        'random:P'  -> 'send it' with the probability P (0.0 - 1.0)
+    """
+    def __init__(self, policy="first-22", seed=None):
+        self.policy = policy
+        self._random = random.Random(seed)
+        if not (policy in ("11", "22", "first-22") or policy.startswith("random:")):
+            raise ValueError(f"Unknown answer policy '{policy}'")
+
+    def answer(self, filename, stored):
+        if self.policy == "11":
+            return 11
+        if self.policy == "22":
+            return 22
+        if self.policy == "first-22":
+            return 11 if filename in stored else 22
+        return 22 if self._random.random() < float(self.policy.split(":", 1)[1]) else 11
+
+
+class SimDevice:
+    """ One simulated intercom. Every command() appends its measures to self.results. """
+    MP3_GAP = 0.3       # the mp3 transfer ended, when nothing is received for this long (the ESP waits 1 sec).
+    TIMEOUT = 5.0       # waiting for the 202 / the server-call.
+
+    def __init__(self, host, port, policy, name=""):
+        self.host = host
+        self.port = port
+        self.policy = policy
+        self.name = name
+        self.sock = None
+        self.stored = set()     # the files 'saved' on this device (SPIFFS)
+        self.setup_time = None
+        self.results = []       # dicts, one per command
+        self.errors = {}        # error type -> count
+
+    def connect(self):
+        start = time.perf_counter()
+        self.sock = socket.create_connection((self.host, self.port), timeout=self.TIMEOUT)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.setup_time = time.perf_counter() - start
+
+    def _error(self, kind):
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+
+    def _recv_exactly(self, size):
+        data = b''
+        while len(data) < size:
+            chunk = self.sock.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError("server closed the connection")
+            data += chunk
+        return data
+
+    def command(self, audio, audio_end=None):
+        """ One full command. audio: raw 16-bit audio. audio_end: the end of speech offset (default: speech_end()). """
+        audio_end = speech_end(audio) if audio_end is None else audio_end
+        result = {"first_byte": None, "mp3_bytes": 0, "answer": None}
+        try:
+            self.sock.settimeout(self.TIMEOUT)
+            start = time.perf_counter()
+            self.sock.sendall(bytes([101]))
+            if self._recv_exactly(1) != bytes([202]):
+                self._error("no 202")
+                return
+            result["ready"] = time.perf_counter() - start
+
+            # real-time audio stream. ~ note: not reading, only watching for the first response byte.
+            next_send = time.perf_counter()
+            speech_ended = None
+            for offset in range(0, len(audio), CHUNK_SIZE):
+                self.sock.sendall(audio[offset:offset + CHUNK_SIZE])
+                if speech_ended is None and offset + CHUNK_SIZE >= audio_end:
+                    speech_ended = time.perf_counter()
+                if speech_ended is not None and result["first_byte"] is None \
+                        and select.select([self.sock], [], [], 0)[0]:
+                    result["first_byte"] = time.perf_counter() - speech_ended
+                next_send += CHUNK_SEC
+                time.sleep(max(0.0, next_send - time.perf_counter()))
+            if speech_ended is None:
+                speech_ended = time.perf_counter()
+
+            call = self._recv_exactly(SERVER_CALL_SIZE)
+            if result["first_byte"] is None:
+                result["first_byte"] = time.perf_counter() - speech_ended
+            filename = call.rstrip(b'\x00').decode('utf-8', errors='replace')
+            if not filename.startswith("/"):
+                self._error("bad server-call")
+                return
+
+            answer = self.policy.answer(filename, self.stored)
+            result["answer"] = answer
+            self.sock.sendall(bytes([answer]))
+
+            if answer == 22:
+                transfer_start = time.perf_counter()
+                self.sock.settimeout(self.MP3_GAP)
+                try:
+                    while True:
+                        data = self.sock.recv(65536)
+                        if not data:
+                            raise ConnectionError("server closed the connection")
+                        result["mp3_bytes"] += len(data)
+                except socket.timeout:
+                    pass
+                result["transfer"] = max(0.0, time.perf_counter() - transfer_start - self.MP3_GAP)
+                if not result["mp3_bytes"]:
+                    self._error("no mp3 after 22")
+                    return
+                if filename != "/mp3respond.mp3":
+                    self.stored.add(filename)
+
+            result["total"] = time.perf_counter() - start
+            self.results.append(result)
+
+        except socket.timeout:
+            self._error("timeout")
+        except (ConnectionError, OSError) as e:
+            self._error(type(e).__name__)
+
+    def run(self, audios, commands, think=0.0):
+        for i in range(commands):
+            audio, audio_end = audios[i % len(audios)]
+            self.command(audio, audio_end)
+            if think:
+                time.sleep(think)
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+
+
+def _serve_stubs(impl, port, n_engines, synth_delay, server_log, conn):
+    """ Child process: the server with the stub engines, until the parent sends 'stop'. """
+    if not server_log:
+        sys.stdout = open(os.devnull, "w")  # ~ note: the server prints a lot on every command.
+
+    from stubs import create_stub_pool
+
+    engines = create_stub_pool(size=n_engines, synth_delay=synth_delay)
+    from connections import ConnectionRegistry
+    connections = ConnectionRegistry(max_clients=SIM_MAX_CLIENTS, device_limits=False)
+    # ~ note: the simulated clients share one IP (the v1 device id), and are not shed: the server load is measured.
+    if impl == "asyncio":
+        from async_server import AsyncTCPServer
+        server = AsyncTCPServer(host=HOST, port=port, engines=engines, connections=connections)
+        server.start()
+        server.ready.wait()
+    else:
+        from tcp_server import TCPServer
+        server = TCPServer(host=HOST, port=port, engines=engines, connections=connections)
+        server.start()
+        time.sleep(0.5)
+
+    conn.send("ready")
+    conn.recv()
+    server.stop()
+    server.join(timeout=10)
+
+
+def _pct(values, p):
+    values = sorted(v for v in values if v is not None)
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def run_load(host, port, n_devices, commands, audios, policy="first-22", think=0.0, seed=None):
+    """ N devices, each in its own thread, running `commands` commands. -> (devices, wall time) """
+    devices = [SimDevice(host, port, AnswerPolicy(policy, seed=None if seed is None else seed + i), name=f"sim{i}")
+               for i in range(n_devices)]
+    for device in devices:
+        try:
+            device.connect()
+        except OSError as e:
+            device._error(f"connect: {type(e).__name__}")
+
+    connected = [device for device in devices if device.sock is not None]
+    threads = [threading.Thread(target=device.run, args=(audios, commands, think), daemon=True) for device in connected]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - start
+
+    for device in devices:
+        device.close()
+    return devices, wall
+
+
+def report(devices, wall, commands):
+    results = [r for device in devices for r in device.results]
+    errors = {}
+    for device in devices:
+        for kind, n in device.errors.items():
+            errors[kind] = errors.get(kind, 0) + n
+    attempted = len(devices) * commands
+    mp3_bytes = sum(r["mp3_bytes"] for r in results)
+    ms = lambda values, p: _pct(values, p) * 1000
+
+    setup = [device.setup_time for device in devices]
+    first_byte = [r["first_byte"] for r in results]
+    total = [r["total"] for r in results]
+    transfer = [r.get("transfer") for r in results if r["answer"] == 22]
+
+    lines = [f"{len(devices)} devices x {commands} commands, {wall:.1f} sec",
+             f"  {'measure (ms)':<28}{'p50':>10}{'p95':>10}{'p99':>10}",
+             f"  {'connection setup':<28}{ms(setup, 50):>10.2f}{ms(setup, 95):>10.2f}{ms(setup, 99):>10.2f}",
+             f"  {'end of speech -> 1st byte':<28}{ms(first_byte, 50):>10.1f}{ms(first_byte, 95):>10.1f}{ms(first_byte, 99):>10.1f}",
+             f"  {'mp3 transfer (22)':<28}{ms(transfer, 50):>10.1f}{ms(transfer, 95):>10.1f}{ms(transfer, 99):>10.1f}",
+             f"  {'command total':<28}{ms(total, 50):>10.1f}{ms(total, 95):>10.1f}{ms(total, 99):>10.1f}",
+             f"  throughput: {len(results) / wall:.2f} commands/sec, {mp3_bytes / 1024 / wall:.1f} KB/sec of mp3 "
+             f"({sum(1 for r in results if r['answer'] == 22)} transfers)",
+             f"  errors: {attempted - len(results)} of {attempted} commands "
+             f"({(attempted - len(results)) / attempted * 100 if attempted else 0:.1f}%) {errors or ''}"]
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--devices", type=int, default=10)
+    parser.add_argument("--commands", type=int, default=3, help="commands per device")
+    parser.add_argument("--think", type=float, default=0.0, help="pause between the commands of a device (seconds)")
+    parser.add_argument("--wav", nargs="*", default=[], help="16 kHz 16-bit mono wav files (default: a synthetic utterance)")
+    parser.add_argument("--answer", default="first-22", help="'11', '22', 'first-22' or 'random:P'")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--host", default=None, help="a running server (default: a local stub server)")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--impl", choices=["threaded", "asyncio"], default="threaded", help="the local stub server")
+    parser.add_argument("--engines", type=int, default=None, help="local server engine pool size (default: the devices)")
+    parser.add_argument("--synth-delay", type=float, default=0.2, help="local server stub TTS time (seconds)")
+    parser.add_argument("--server-log", action="store_true", help="show the local server output")
+    args = parser.parse_args()
+
+    audios = [load_wav(name) for name in args.wav] or [synthetic_utterance()]
+    audios = [(audio, speech_end(audio)) for audio in audios]
+
+    proc = None
+    host, port = args.host, args.port
+    if host is None:
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+            s.bind((HOST, 0))
+            host, port = HOST, s.getsockname()[1]
+        parent_conn, child_conn = multiprocessing.Pipe()
+        proc = multiprocessing.Process(target=_serve_stubs, daemon=True,
+                                       args=(args.impl, port, args.engines or args.devices, args.synth_delay,
+                                             args.server_log, child_conn))
+        proc.start()
+        parent_conn.recv()
+        print(f"Local stub server ({args.impl}) on {host}:{port}")
+
+    try:
+        devices, wall = run_load(host, port, args.devices, args.commands, audios, args.answer, args.think, args.seed)
+        print(report(devices, wall, args.commands))
+    finally:
+        if proc is not None:
+            parent_conn.send("stop")
+            proc.join(timeout=10)
+
+
+if __name__ == "__main__":
+    main()
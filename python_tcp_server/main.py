@@ -1,19 +1,85 @@
+import argparse
 
 from tcp_server import TCPServer
+from metrics import METRICS
+from recorder import RECORDER, SessionArchive, replay
 
 if __name__ == "__main__":
 
+    parser = argparse.ArgumentParser(description="Intercom TCP server")
+    parser.add_argument("--asyncio", action="store_true", help="serve all the clients from one asyncio event loop (instead of a thread per client)")
+    parser.add_argument("--workers", type=int, default=0, help="run the recognition in N worker processes (0: in the server process)")
+    parser.add_argument("--record", metavar="DIR", help="record every command (audio, result, timings) to a session archive, see recorder.py")
+    parser.add_argument("--fast-start", action="store_true", help="listen at once, load the engines in the background (the early commands get a 'connecting' reply)")
+    args = parser.parse_args()
+
+    if args.record:
+        RECORDER.start(args.record)
+
+    engines = None
+    if args.workers:
+        from recognition_workers import create_process_pool
+        engines = create_process_pool(workers=args.workers, background=args.fast_start)
+    elif args.fast_start:
+        from engines import EnginePool
+        engines = EnginePool(background=True)
+
     # Main Program Loop (With Keyboard Input Handling)
-    server = TCPServer()
+    if args.asyncio:
+        from async_server import AsyncTCPServer
+        server = AsyncTCPServer(engines=engines)
+    else:
+        server = TCPServer(engines=engines)
     server.start()
 
     try:
         while True:
-            cmd = input("Enter 'exit' to stop server: ").strip().lower()
+            cmd = input("Enter 'exit' to stop server, 'cache' for the TTS cache report, 'stats' for the latency report: ").strip().lower()
             if cmd == "exit":
                 server.stop()
                 break
+            elif cmd and not server.engines.ready.is_set():
+                print(f"Engines {server.engines.state}. Try again when ready.")
+                continue
+            elif cmd == "cache":
+                print(server.engines.prerenderer.report())
+                print(f"TTS cache: {server.engines.speaker.cache.stats()}")
+                continue
+            elif cmd == "stats":
+                print(METRICS.report())
+                print(f"Engine pool: {server.engines.stats()}")
+                print(f"Connections: {server.clients.report()}")
+                print(f"Capture buffers: {server.engines.captures.stats()}")
+                print(f"mp3 transfers: {server.engines.speaker.transfers}")
+                print(f"Fillers: {server.engines.speaker.fillers.stats()}")
+                print(f"TTS calls: {server.engines.speaker.synthesis.stats}")
+                print(f"mp3 packing: {server.engines.speaker.packing}")
+                print(f"Intent actions: {server.engines.decoder.intents.stats}")
+                print(f"Wake word (hands-free): {server.engines.wakeword.report()}")
+                print(f"Same command on several devices: {server.engines.utterances.report()}")
+                if RECORDER.enabled:
+                    print(f"Session recorder: {RECORDER.stats()}")
+                continue
+            elif cmd == "stats reset":
+                METRICS.reset()
+                continue
+            elif cmd == "replay" or cmd.startswith("replay "):
+                # replay the recorded sessions (all, or the given ids) through the current pipeline.
+                if not RECORDER.enabled:
+                    print("Not recording. Start the server with --record DIR.")
+                    continue
+                archive = SessionArchive(RECORDER.directory)
+                try:
+                    with server.engines.recognizer() as recognizer:
+                        print("\n".join(replay(archive, recognizer, server.engines.decoder,
+                                               ids=[int(i) for i in cmd.split()[1:]])))
+                except Exception as e:
+                    print(f"ERR in replay -> {e}")
+                finally:
+                    archive.close()
+                continue
             print(f"Active clients: {len(server.clients)}")
     except KeyboardInterrupt:
         print("\nKeyboard Interrupt detected. Stopping server...")
-        server.stop()
\ No newline at end of file
+        server.stop()
+    RECORDER.stop()
@@ -0,0 +1,162 @@
+import bisect
+import itertools
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager, nullcontext
+
+
+class Histogram:
+    """
+    Latency histogram with fixed log-scale buckets (0.05 ms ... ~100 sec, +12% per bucket).
+    Recording is O(log buckets) and allocates nothing, so it can stay on in production.
+    The percentiles are estimated from the buckets (the upper bound of the bucket), max 12% above the real value.
+    """
+    MIN = 0.00005   # seconds
+    FACTOR = 1.12
+    BUCKETS = 128   # ~ note: MIN * FACTOR ** 128 = ~100 sec
+    BOUNDS = None   # the bucket upper bounds, set below the class.
+
+    def __init__(self):
+        self.counts = [0] * (self.BUCKETS + 1)  # the last one: over the last bound.
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        self.counts[bisect.bisect_left(self.BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p):
+        """ p in 0 - 100 -> seconds (the bucket upper bound), or 0.0 if empty. """
+        if not self.count:
+            return 0.0
+        rank = max(1, int(round(self.count * p / 100.0)))
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return min(self.BOUNDS[i], self.max) if i < self.BUCKETS else self.max
+        return self.max
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+
+Histogram.BOUNDS = [Histogram.MIN * Histogram.FACTOR ** i for i in range(Histogram.BUCKETS)]
+
+
+class Trace:
+    """
+    The spans of one command (one utterance), tagged with a correlation id: '<client>#<command number>'.
+    Create with Metrics.new_trace(). Every span is added to the trace and to the Metrics histogram of its stage.
+
+        with trace.span("decode"):
+            ...
+        trace.finish()  -> records the 'total' span, and keeps the trace in the recent traces.
+    """
+    def __init__(self, metrics, trace_id):
+        self.metrics = metrics
+        self.id = trace_id
+        self.started = time.perf_counter()
+        self.spans = []  # [(stage, seconds), ...] in the order they ended
+        self.finished = False
+
+    @contextmanager
+    def span(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start)
+
+    def add(self, stage, seconds):
+        """ Record a span measured elsewhere (ak. the summed Rhino time of a stream). """
+        self.spans.append((stage, seconds))
+        self.metrics.record(stage, seconds)
+
+    def finish(self):
+        if self.finished:
+            return
+        self.finished = True
+        self.add("total", time.perf_counter() - self.started)
+        self.metrics.keep(self)
+
+    def summary(self):
+        return f"[{self.id}] " + " | ".join(f"{stage} {seconds * 1000:.1f}ms" for stage, seconds in self.spans)
+
+
+class Metrics:
+    """
+    Per stage latency histograms, filled by the command traces of all the clients.
+    ~ note: the server-wide instance is metrics.METRICS. The 'stats' console command (main.py) prints its report().
+    """
+    RECENT = 50         # the last traces kept, for the report.
+    LOG_TRACES = True   # print the spans of every finished command (one line).
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}   # stage -> Histogram, in the first seen order
+        self._recent = deque(maxlen=self.RECENT)
+        self._counters = {}     # client -> itertools.count
+        self.started = time.time()
+
+    def new_trace(self, client_id):
+        """ A new Trace for the next command of a client. client_id: ak. the device IP. """
+        with self._lock:
+            counter = self._counters.setdefault(client_id, itertools.count(1))
+            return Trace(self, f"{client_id}#{next(counter)}")
+
+    def record(self, stage, seconds):
+        with self._lock:
+            histogram = self._histograms.get(stage)
+            if histogram is None:
+                histogram = self._histograms[stage] = Histogram()
+            histogram.record(seconds)
+
+    def keep(self, trace):
+        with self._lock:
+            self._recent.append(trace)
+        if self.LOG_TRACES:
+            print(trace.summary())
+
+    def snapshot(self):
+        """ {stage: {"count", "mean", "p50", "p95", "p99", "max"}}, in seconds. """
+        with self._lock:
+            return {stage: {"count": h.count, "mean": h.mean, "p50": h.percentile(50), "p95": h.percentile(95),
+                            "p99": h.percentile(99), "max": h.max}
+                    for stage, h in self._histograms.items()}
+
+    def recent(self, n=10):
+        with self._lock:
+            return list(self._recent)[-n:]
+
+    def report(self, traces=5):
+        """ The latency table of all the stages (ms), and the last traces. """
+        lines = [f"Latency per stage (ms), since {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.started))}:",
+                 f"  {'stage':<14}{'count':>8}{'mean':>10}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}"]
+        for stage, s in self.snapshot().items():
+            lines.append(f"  {stage:<14}{s['count']:>8}{s['mean'] * 1000:>10.1f}{s['p50'] * 1000:>10.1f}"
+                         f"{s['p95'] * 1000:>10.1f}{s['p99'] * 1000:>10.1f}{s['max'] * 1000:>10.1f}")
+        if traces:
+            lines.append("Last commands:")
+            lines.extend(f"  {trace.summary()}" for trace in self.recent(traces))
+        return "\n".join(lines)
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+            self._recent.clear()
+            self.started = time.time()
+
+
+METRICS = Metrics()
+
+
+def span(trace, stage):
+    """ trace.span(stage), or nothing if no trace (the code can be instrumented without requiring a trace). """
+    return trace.span(stage) if trace is not None else nullcontext()
@@ -0,0 +1,168 @@
+"""
+Packing of the TTS mp3 responses for the ESP32: the audio is sent over a weak WiFi, and written to the SPIFFS.
+
+pack() parses the mp3 frames (MPEG 1 / 2 / 2.5 Layer III, no decoding) and drops:
+    - the ID3v2 / ID3v1 / APE tags and the Xing / Info (VBR) header frame: metadata, not played.
+    - the silent frames at the start and at the end of the audio.
+A frame is 'silent' when all its granules have no Huffman data (part2_3_length), or a global gain under SILENT_GAIN:
+the quantization step is too small to be heard on the intercom speaker.
+
+~ note: PAD_FRAMES silent frames are kept at both ends: the first kept frame may use the bit reservoir of the
+        dropped frames before it (main_data_begin), so it is decoded wrong -> it must be a silent one.
+        The bitrate is not changed: the v1 firmware plays a received file for (bytes / bitrate) time.
+"""
+import struct
+from collections import namedtuple
+
+
+Mp3Frame = namedtuple("Mp3Frame", "offset length silent")
+PackResult = namedtuple("PackResult", "audio original_size frames kept tags_bytes silent_head silent_tail")
+
+_BITRATES = {   # kbps, by the bitrate index. Layer III.
+    1: (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),  # MPEG 1
+    2: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),      # MPEG 2 / 2.5
+}
+_SAMPLE_RATES = {1: (44100, 48000, 32000), 2: (22050, 24000, 16000), 25: (11025, 12000, 8000)}
+_VERSIONS = {0b11: 1, 0b10: 2, 0b00: 25}
+
+SILENT_GAIN = 100   # global_gain under this -> a silent granule (the step 2 ^ ((gain - 210) / 4) is ~ 1/190000 of full scale).
+PAD_FRAMES = 1      # silent frames kept at each end.
+
+
+def _header(data, offset):
+    """ -> (frame length, version, channels, side info offset) of a Layer III frame header, or None. """
+    if offset + 4 > len(data):
+        return None
+    b1, b2, b3 = data[offset + 1], data[offset + 2], data[offset + 3]
+    if data[offset] != 0xFF or (b1 & 0xE0) != 0xE0:
+        return None
+    version = _VERSIONS.get((b1 >> 3) & 0b11)
+    layer = (b1 >> 1) & 0b11
+    bitrate_index = b2 >> 4
+    sample_rate_index = (b2 >> 2) & 0b11
+    if version is None or layer != 0b01 or bitrate_index in (0, 15) or sample_rate_index == 3:
+        return None
+
+    bitrate = _BITRATES[1 if version == 1 else 2][bitrate_index] * 1000
+    sample_rate = _SAMPLE_RATES[version][sample_rate_index]
+    padding = (b2 >> 1) & 1
+    length = (144 if version == 1 else 72) * bitrate // sample_rate + padding
+    channels = 1 if (b3 >> 6) == 0b11 else 2
+    side_info = offset + 4 + (0 if b1 & 1 else 2)  # ~ note: protection bit 0 -> a 16-bit CRC after the header.
+    return length, version, channels, side_info
+
+
+def _side_info_size(version, channels):
+    """ The Layer III side info bytes: MPEG 1 -> 17 (mono) / 32, MPEG 2 / 2.5 -> 9 (mono) / 17. """
+    if version == 1:
+        return 17 if channels == 1 else 32
+    return 9 if channels == 1 else 17
+
+
+def _is_silent(data, version, channels, side_info):
+    """ All the granules: part2_3_length == 0, or global_gain < SILENT_GAIN. """
+    size = _side_info_size(version, channels)
+    if side_info + size > len(data):
+        return False
+    bits = int.from_bytes(data[side_info:side_info + size], "big")
+    total = size * 8
+
+    # main_data_begin + private bits (+ scfsi in MPEG 1)
+    if version == 1:
+        position = 9 + (5 if channels == 1 else 3) + 4 * channels
+        granules = 2
+    else:
+        position = 8 + (1 if channels == 1 else 2)
+        granules = 1
+    granule_bits = 59 if version == 1 else 63   # part2_3_length(12) ... till the next channel granule
+
+    for _ in range(granules * channels):
+        part2_3_length = (bits >> (total - position - 12)) & 0xFFF
+        global_gain = (bits >> (total - position - 12 - 9 - 8)) & 0xFF
+        if part2_3_length and global_gain >= SILENT_GAIN:
+            return False
+        position += granule_bits
+    return True
+
+
+def _is_vbr_header(data, offset, length, version, channels, side_info):
+    """ The Xing / Info tag right after the side info (LAME), or the VBRI tag 32 bytes after the header (Fraunhofer). """
+    tag = side_info + _side_info_size(version, channels)
+    if tag + 4 <= offset + length and bytes(data[tag:tag + 4]) in (b"Xing", b"Info"):
+        return True
+    return length >= 40 and bytes(data[offset + 36:offset + 40]) == b"VBRI"
+
+
+def frames(data):
+    """ -> (the mp3 frames [Mp3Frame, ...], the bytes of the tags and of the not parsable data) """
+    data = memoryview(data)
+    offset, skipped = 0, 0
+    end = len(data)
+
+    if bytes(data[:3]) == b"ID3" and end >= 10:
+        size = (data[6] << 21) | (data[7] << 14) | (data[8] << 7) | data[9]
+        offset = 10 + size + (10 if data[5] & 0x10 else 0)  # ~ note: + the footer, if the flag is set.
+        skipped += offset
+    if end >= 128 and bytes(data[end - 128:end - 125]) == b"TAG":
+        end -= 128
+        skipped += 128
+    if end >= 32 and bytes(data[end - 32:end - 24]) == b"APETAGEX":
+        size = struct.unpack_from("<I", data, end - 32 + 12)[0]   # ~ note: the tag size, with the footer.
+        end -= size + (32 if data[end - 32 + 23] & 0x80 else 0)   # + the header, if present.
+        skipped += size
+
+    result = []
+    first, synced = True, False
+    while offset < end:
+        header = _header(data, offset)
+        if header is not None and not synced and offset + header[0] < end and _header(data, offset + header[0]) is None:
+            header = None   # ~ note: a sync found in junk, 0xFFF is not rare: a frame must be followed by a frame.
+        if header is None or offset + header[0] > end:
+            offset += 1     # ~ note: junk between the frames -> look for the next sync.
+            skipped += 1
+            synced = False
+            continue
+        synced = True
+        length, version, channels, side_info = header
+        if first and _is_vbr_header(data, offset, length, version, channels, side_info):
+            skipped += length   # the Xing / Info frame: frame counts, no audio.
+        else:
+            result.append(Mp3Frame(offset, length, _is_silent(data, version, channels, side_info)))
+        first = False
+        offset += length
+    return result, skipped
+
+
+def pack(data, trim_silence=True):
+    """ -> PackResult: the packed audio (bytes), and what was dropped. The data is returned as is, if no mp3 frames. """
+    parsed, tags_bytes = frames(data)
+    if not parsed:
+        return PackResult(bytes(data), len(data), 0, 0, 0, 0, 0)
+
+    start, stop = 0, len(parsed)
+    if trim_silence:
+        while start < stop and parsed[start].silent:
+            start += 1
+        while stop > start and parsed[stop - 1].silent:
+            stop -= 1
+        if start == stop:   # all silent: keep it as is.
+            start, stop = 0, len(parsed)
+        else:
+            start = max(0, start - PAD_FRAMES)
+            stop = min(len(parsed), stop + PAD_FRAMES)
+
+    view = memoryview(data)
+    audio = b"".join(view[frame.offset:frame.offset + frame.length] for frame in parsed[start:stop])
+    return PackResult(audio, len(data), len(parsed), stop - start, tags_bytes, start, len(parsed) - stop)
+
+
+def duration(data):
+    """ The play time of the mp3 data (seconds), from its frames. """
+    data = memoryview(data)
+    seconds = 0.0
+    for frame in frames(data)[0]:
+        b1, b2 = data[frame.offset + 1], data[frame.offset + 2]
+        version = _VERSIONS[(b1 >> 3) & 0b11]
+        samples = 1152 if version == 1 else 576
+        seconds += samples / _SAMPLE_RATES[version][(b2 >> 2) & 0b11]
+    return seconds
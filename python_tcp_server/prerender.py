@@ -0,0 +1,87 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Prerenderer:
+    """
+    Pre-render the known response texts (Decoder.known_responses()) to audio, on a bounded background worker pool,
+    filling the offline cache of the speaker. Started on the server start, so the live commands never wait
+    for a first time TTS synthesis of a known phrase.
+
+    ~ note: while a text is being pre-rendered, Speach.get_audio() waits for it (speaker.prerendering),
+            instead of synthesizing it a second time.
+    """
+    WORKERS = 2     # max simultaneous TTS calls of the pre-render.
+
+    def __init__(self, speaker, texts, workers=None):
+        self.speaker = speaker
+        self.texts = list(dict.fromkeys(texts))  # unique, same order
+        self.workers = workers or Prerenderer.WORKERS
+
+        self.rendered = []
+        self.failed = []
+        self.cached = []
+        self.started = None
+        self.finished = None
+        self._lock = threading.Lock()
+        self._executor = None
+        self.done = threading.Event()
+
+    def start(self):
+        """ Start the pre-render in the background. Returns immediately. """
+        self.started = time.time()
+        self.cached = [text for text in self.texts if text in self.speaker.cache]
+        missing = [text for text in self.texts if text not in self.speaker.cache]
+
+        if not missing:
+            self._finish()
+            return
+
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="prerender")
+        with self._lock:
+            self._pending = len(missing)
+            for text in missing:
+                self.speaker.prerendering[text] = self._executor.submit(self._render, text)
+        self._executor.shutdown(wait=False)
+
+    def _render(self, text):
+        try:
+            audio_content = self.speaker.get_audio(text, save_it=True, wait_prerender=False)
+            ok = audio_content is not None
+        except Exception as e:
+            print(f"ERR pre-rendering '{text}' -> {e}")
+            ok = False
+
+        with self._lock:
+            self.speaker.prerendering.pop(text, None)
+            (self.rendered if ok else self.failed).append(text)
+            self._pending -= 1
+            if self._pending == 0:
+                self._finish()
+        return ok
+
+    def _finish(self):
+        self.finished = time.time()
+        self.done.set()
+        print(self.report())
+
+    def wait(self, timeout=None):
+        return self.done.wait(timeout)
+
+    def coverage(self):
+        """ Part of the known responses (0.0 - 1.0) with audio ready in the cache. """
+        if not self.texts:
+            return 1.0
+        return sum(1 for text in self.texts if text in self.speaker.cache) / len(self.texts)
+
+    def report(self):
+        """ The readiness report. """
+        lines = [f"Pre-render: {self.coverage() * 100:.0f}% of {len(self.texts)} known responses ready "
+                 f"({len(self.cached)} cached, {len(self.rendered)} rendered, {len(self.failed)} failed"
+                 f"{'' if self.done.is_set() else ', IN PROGRESS'})"]
+        if self.finished:
+            lines.append(f"  finished in {self.finished - self.started:.2f} sec")
+        for text in self.failed:
+            lines.append(f"  missing: '{text}'")
+        return "\n".join(lines)
@@ -0,0 +1,432 @@
+"""
+Framed protocol v2, alongside the original byte hand-shake protocol (v1).
+
+v1 (the intercom_v01 firmware): single bytes [101] / [202] / [11] / [22], raw audio ended by a read timeout,
+    and a 29 bytes zero-padded server-call.
+
+v2: every message is a frame -> [type: 1 byte][payload length: 4 bytes, big-endian][payload]
+    Message boundaries are explicit, so no timeouts are needed to find them, and several messages can be
+    sent without waiting for each other (pipelining).
+
+Version negotiation on connect:
+    client -> [MAGIC][max version]     ~ note: a v1 device never sends MAGIC, its first byte is 101 (or 11 / 22)
+    server -> [MAGIC][used version]
+    then only frames, both directions.
+
+Frames:
+    HELLO        client -> server: device id (utf-8)                      server -> client: empty
+    WAKE         client -> server: start of an utterance (the v1 [101])
+                 server -> client: the wake word was detected (hands-free mode), an utterance starts.
+    READY        server -> client: ready to receive the audio (the v1 [202])
+    AUDIO        client -> server: 16-bit 16 kHz mono audio chunk (any size)
+    END          client -> server: end of the utterance (no timeout wait)
+    SERVER_CALL  server -> client: [flags: 1 byte][file name]. flags & FILE_FOLLOWS -> a FILE frame follows, no ACK needed.
+    ACK          client -> server: [11 or 22][file name] (the v1 answers, with the file name, so they can be pipelined)
+    FILE         server -> client: [file name length: 1 byte][file name][mp3 data]
+    LISTEN       client -> server: [1] hands-free mode on / [0] off     server -> client: [1] / [0] the mode now
+                 In the hands-free mode, the client streams AUDIO all the time, and the server detects the wake word
+                 between the utterances (see wakeword.py). No WAKE / END needed from the client.
+    ERROR        both directions: utf-8 message
+"""
+import struct
+
+from metrics import METRICS, span
+from recorder import RECORDER
+
+MAGIC = 0xA5
+VERSION = 2
+
+HELLO = 0x01
+WAKE = 0x02
+READY = 0x03
+AUDIO = 0x04
+END = 0x05
+SERVER_CALL = 0x06
+ACK = 0x07
+FILE = 0x08
+LISTEN = 0x09
+ERROR = 0x0F
+
+FRAME_TYPES = {HELLO: "HELLO", WAKE: "WAKE", READY: "READY", AUDIO: "AUDIO", END: "END",
+               SERVER_CALL: "SERVER_CALL", ACK: "ACK", FILE: "FILE", LISTEN: "LISTEN", ERROR: "ERROR"}
+
+FILE_FOLLOWS = 0x01     # SERVER_CALL flag
+
+HEADER = struct.Struct(">BI")
+MAX_PAYLOAD = 1024 * 1024   # 1 MB. Bigger frames are a protocol error (a corrupted stream).
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def encode_frame(frame_type, payload=b''):
+    """ A frame, ready to be sent. """
+    if frame_type not in FRAME_TYPES:
+        raise ProtocolError(f"Unknown frame type {frame_type}")
+    return HEADER.pack(frame_type, len(payload)) + bytes(payload)
+
+
+def negotiate(client_max_version):
+    """ The version used with a client, which supports up to client_max_version. """
+    if client_max_version < 2:
+        raise ProtocolError(f"Client protocol version {client_max_version} is not a framed version.")
+    return min(client_max_version, VERSION)
+
+
+def server_call_payload(filename, file_follows=False):
+    return bytes([FILE_FOLLOWS if file_follows else 0]) + filename.encode('utf-8')
+
+
+def file_payload(filename, audio_content):
+    name = filename.encode('utf-8')
+    return bytes([len(name)]) + name + audio_content
+
+
+def parse_ack(payload):
+    """ ACK payload -> (answer, file name) """
+    if len(payload) < 1 or payload[0] not in (11, 22):
+        raise ProtocolError(f"Invalid ACK payload: {payload[:8]!r}")
+    return payload[0], payload[1:].decode('utf-8')
+
+
+class FrameParser:
+    """
+    Incremental frame parser. Feed it the received bytes (any size, any split), get back the complete frames.
+    Does no IO, so it can be tested in isolation:
+
+        parser = FrameParser()
+        frames = parser.feed(data)  # -> [(frame_type, payload), ...]
+    """
+    def __init__(self, max_payload=MAX_PAYLOAD):
+        self.max_payload = max_payload
+        self._buffer = bytearray()
+
+    def feed(self, data):
+        self._buffer.extend(data)
+        frames = []
+        offset = 0
+        while len(self._buffer) - offset >= HEADER.size:
+            frame_type, length = HEADER.unpack_from(self._buffer, offset)
+            if frame_type not in FRAME_TYPES:
+                raise ProtocolError(f"Unknown frame type {frame_type}")
+            if length > self.max_payload:
+                raise ProtocolError(f"Frame too big ({length} bytes)")
+            end = offset + HEADER.size + length
+            if end > len(self._buffer):
+                break
+            frames.append((frame_type, bytes(self._buffer[offset + HEADER.size:end])))
+            offset = end
+        del self._buffer[:offset]
+        return frames
+
+    @property
+    def pending_bytes(self):
+        return len(self._buffer)
+
+
+class V2Session:
+    """
+    The server side of a v2 connection. Does no socket IO: on_data() gets the received bytes,
+    and the frames to be sent go to the send(bytes) callable. Used by the tcp_client.Client (and the async client).
+
+    ~ note: the recording ends on the END frame, on Rhino finalized, or on the VAD end-of-speech.
+            The AUDIO frames after the end are ignored, so no drain is needed (unlike v1).
+    """
+    PUSH_UNKNOWN = True     # when the device manifest does not know the file, send it with the call (no ACK round-trip).
+    SKIP_MAX_SEC = 10.0     # without a VAD: the audio of a not started utterance is ignored this long (or till END).
+
+    def __init__(self, engines, send, device, vad=None, streaming=True, on_hello=None):
+        self.engines = engines
+        self.send = send
+        self.device = device
+        self.on_hello = on_hello    # on_hello(device id): the client tells the server its device. See connections.py
+        self.vad = vad
+        self.streaming = streaming
+
+        self.parser = FrameParser()
+        self._recognizer = None
+        self._capture = None    # the capture buffer of the utterance (see capture.py)
+        self._trace = None
+        self._pending = {}  # file name -> audio content, of the calls waiting for an ACK
+        self._stream = None     # the wake word stream, in the hands-free mode (see wakeword.WakeWordStream)
+        self._utterance = None  # the current utterance, in the cross-device de-duplication (see arbiter.py)
+        self._skipping = None   # bytes ignored of an utterance not started (no engines / recognizer / capture buffer)
+
+    def on_data(self, data):
+        for frame_type, payload in self.parser.feed(data):
+            self._on_frame(frame_type, payload)
+
+    def _on_frame(self, frame_type, payload):
+        if frame_type == HELLO:
+            if payload:
+                self.device = payload.decode('utf-8', errors='replace')
+                if self.on_hello is not None:
+                    self.on_hello(self.device)
+            print(f"v2 device identified: {self.device}")
+            self.send(encode_frame(HELLO))
+
+        elif frame_type == WAKE:
+            self._start_utterance()
+
+        elif frame_type == AUDIO:
+            if self._recognizer is not None:
+                self._on_audio(payload)
+            elif self._skipping is not None:
+                self._skip(payload)
+            elif self._stream is not None:
+                self._listen(payload)
+
+        elif frame_type == END:
+            if self._recognizer is not None:
+                print("The client audio transmission ended (END frame).")
+                self._end_utterance()
+            elif self._skipping is not None:
+                self._end_skip()
+
+        elif frame_type == ACK:
+            answer, filename = parse_ack(payload)
+            self._on_ack(answer, filename)
+
+        elif frame_type == LISTEN:
+            self._set_listening(bool(payload and payload[0]))
+
+        elif frame_type == ERROR:
+            print(f"v2 client error: {payload.decode('utf-8', errors='replace')}")
+
+        else:
+            raise ProtocolError(f"Unexpected frame from the client: {FRAME_TYPES[frame_type]}")
+
+    def _set_listening(self, on):
+        """ The hands-free mode on / off: the audio between the utterances goes to the wake word detection. """
+        if on and self._stream is None:
+            try:
+                self._stream = self.engines.wakeword.open(self.device)
+            except Exception as e:
+                print(f"ERR: no wake word detector for {self.device} -> {e}")
+                self.send(encode_frame(ERROR, b"no wake word detector"))
+            else:
+                print(f"Hands-free mode on: {self.device}")
+        elif not on and self._stream is not None:
+            self._stream.close()
+            self._stream = None
+            print(f"Hands-free mode off: {self.device}")
+        self.send(encode_frame(LISTEN, bytes([self._stream is not None])))
+
+    def _listen(self, chunk):
+        """ Hands-free mode, between the utterances: the audio to the wake word detection (on the scheduler workers). """
+        self._stream.feed(chunk)
+        if self._stream.detected is None:
+            return
+        keyword, audio = self._stream.take()
+        print(f"Wake word detected: {self.device}")
+        self.send(encode_frame(WAKE))
+        self._start_utterance()
+        if self._recognizer is not None and audio:
+            self._on_audio(audio)  # ~ note: the audio after the wake word, the start of the command.
+        elif self._skipping is not None and audio:
+            self._skip(audio)
+
+    def _skip_utterance(self):
+        """ The utterance could not start: its AUDIO frames are ignored, till END or the VAD end-of-speech.
+            ~ note: in the hands-free mode, they do not go to the wake word detection (one wake word -> one answer).
+        """
+        self._skipping = 0
+        if self.vad:
+            self.vad.reset()
+
+    def _skip(self, chunk):
+        self._skipping += len(chunk)
+        if self.vad:
+            self.vad.process(chunk)
+            if self.vad.ended:
+                self._end_skip()
+        elif self._skipping >= self.SKIP_MAX_SEC * 16000 * 2:
+            self._end_skip()
+
+    def _end_skip(self):
+        print(f"Not started utterance ended, {self._skipping} bytes ignored.")
+        self._skipping = None
+        if self._stream is not None:
+            self._stream.resume()  # back to the wake word detection, with the audio of the skipped utterance dropped.
+
+    def _start_utterance(self):
+        if self._recognizer is not None:
+            self._end_utterance()
+        self._skipping = None
+        if not self.engines.ready.is_set():
+            # the engines are still warming up (see EnginePool.start()): the device says its 'connecting' file.
+            # ~ note: no READY sent, the AUDIO frames of the utterance are ignored (no recognizer).
+            filename, audio_content = self.engines.starting_reply()
+            if audio_content:
+                self._pending[filename] = audio_content
+            self.send(encode_frame(SERVER_CALL, server_call_payload(filename)))
+            print(f"Engines {self.engines.state}. Starting Server-Call frame sent: {filename}")
+            self._skip_utterance()
+            return
+        self._trace = METRICS.new_trace(self.device)
+        self._utterance = self.engines.utterances.begin(self.device)
+        try:
+            with span(self._trace, "lease"):
+                self._recognizer = self.engines.acquire()
+        except Exception as e:
+            print(f"ERR: in audio processing -> no recognizer available ({e}).")
+            self._cancel_utterance()
+            self._busy()
+            return
+
+        try:
+            self._capture = self.engines.captures.acquire()
+        except Exception as e:
+            print(f"ERR: in audio processing -> no capture buffer available ({e}).")
+            self.engines.release(self._recognizer)
+            self._recognizer = None
+            self._cancel_utterance()
+            self._busy()
+            return
+
+        if RECORDER.enabled:
+            self._capture.keep_raw()
+        if self.streaming:
+            self._recognizer.start_stream()
+        if self.vad:
+            self.vad.reset()
+        self.send(encode_frame(READY))
+        print("Ready frame sent. Start recording...")
+
+    def _busy(self):
+        """ The utterance could not start (no free recognizer or capture buffer): ERROR 'busy', the BUSY response. """
+        self.send(encode_frame(ERROR, b"busy"))
+        self._respond(self.engines.decoder.intents.BUSY, self._trace)
+        if self._trace is not None:
+            self._trace.finish()
+            self._trace = None
+        self._skip_utterance()
+
+    def _on_audio(self, chunk):
+        capture = self._capture
+        capture.put(chunk)
+        chunk = capture.last
+        if self.vad:
+            chunk = self.vad.process(chunk)
+        chunk = capture.commit(chunk)
+
+        if capture.full:
+            print(f"Max utterance length reached [{capture.size} bytes]. Stop recording.")
+            self._end_utterance()
+        elif self.streaming and chunk and self._recognizer.process_chunk(chunk):
+            print("Rhino finalized while receiving. Stop recording.")
+            self._end_utterance()
+        elif self.vad and self.vad.ended:
+            print("End of speech detected (VAD). Stop recording.")
+            self._end_utterance()
+
+    def _end_utterance(self):
+        recognizer, self._recognizer = self._recognizer, None
+        capture, self._capture = self._capture, None
+        trace, self._trace = self._trace, None
+        utterance, self._utterance = self._utterance, None
+        try:
+            if self.streaming:
+                with span(trace, "finish"):
+                    result = recognizer.finish_stream()
+                trace.add("rhino", recognizer.stream_rhino_time)
+            else:
+                result = recognizer.process_audio_data(capture.audio, trace=trace)
+            print(f"Data Ready, [{capture.length} of {capture.received} bytes]. PROCESSED.")
+            recording = RECORDER.take(capture)
+            heard = capture.length
+        except Exception:
+            self.engines.utterances.cancel(utterance)
+            raise
+        finally:
+            self.engines.captures.release(capture)
+            self.engines.release(recognizer)
+
+        if self._stream is not None and not heard:
+            # hands-free: no speech after the wake word (the VAD gave up). Not a command, no response.
+            print("No command after the wake word.")
+            self.engines.utterances.cancel(utterance)
+            self._stream.resume()
+            return
+
+        if self.engines.utterances.end(utterance, self.vad.snr() if self.vad else None, result):
+            with span(trace, "decode"):
+                text = self.engines.decoder.decode_rhino(pvRhino_result=result, device=self.device)
+            self._respond(text, trace)
+            trace.finish()
+            RECORDER.record(self.device, recording, result, text, trace)
+        else:
+            # the same command, heard better by another device: only a short acknowledgement, no action.
+            speaker = self.engines.speaker
+            filename = self.engines.utterances.ACK_FILE
+            with span(trace, "filler"):
+                self._call(filename, speaker.get_audio(speaker.fillers.text(filename), save_it=True))
+            trace.finish()
+        if self._stream is not None:
+            self._stream.resume()  # back to the wake word detection.
+
+    def _respond(self, text, trace=None):
+        speaker = self.engines.speaker
+        filler = speaker.fillers.choose(text) if text and text not in speaker.cache else None
+        if filler is not None:
+            # a filler ('On it.') first, while the response is synthesized. See filler.FillerPolicy
+            # ~ note: no wait needed after it, unlike v1: the frames tell where every file ends.
+            with span(trace, "filler"):
+                filler_audio = speaker.get_audio(speaker.fillers.text(filler), save_it=True)
+                if filler_audio:
+                    self._call(filler, filler_audio)
+
+        audio_content = speaker.get_audio(text, trace=trace)
+        if not audio_content:
+            print("No audio content collected. Transmit terminated.")
+            return
+        self._call(speaker.device_filename(text), audio_content)
+
+    def _call(self, filename, audio_content):
+        """ Call the device with a file: SERVER_CALL (+ FILE, when the device is not known to have it). """
+        speaker = self.engines.speaker
+        if speaker.manifest.has(self.device, filename) or not self.PUSH_UNKNOWN:
+            # the device answers with an ACK: [11] -> done, [22] -> the FILE is sent then.
+            self._pending[filename] = audio_content
+            self.send(encode_frame(SERVER_CALL, server_call_payload(filename)))
+            print(f"Server-Call frame sent: {filename}")
+        else:
+            # pipelined: the call and the file in one go.
+            self.send(encode_frame(SERVER_CALL, server_call_payload(filename, file_follows=True))
+                      + encode_frame(FILE, file_payload(filename, audio_content)))
+            speaker.manifest.record(self.device, filename, stored=True)
+            print(f"Server-Call + File frames sent: {filename} [{len(audio_content)} bytes]")
+
+    def _on_ack(self, answer, filename):
+        audio_content = self._pending.pop(filename, None)
+        speaker = self.engines.speaker
+        stored = answer == 11
+        if answer == 22:
+            if audio_content is not None:
+                self.send(encode_frame(FILE, file_payload(filename, audio_content)))
+                print(f"File frame sent: {filename} [{len(audio_content)} bytes]")
+                stored = True
+            else:
+                # no call pending for this file (ak. a late or repeated ACK): nothing sent, the device does not have it.
+                print(f"ACK [22] without a pending call: {filename}. No File frame sent.")
+        if speaker is not None:  # ~ note: None, if the ACK of a starting call came before the engines were ready.
+            speaker.manifest.record(self.device, filename, stored=stored)
+
+    def close(self):
+        """ Give back a leased recognizer (ak. the connection dropped in the middle of an utterance). """
+        if self._recognizer is not None:
+            self.engines.release(self._recognizer)
+            self._recognizer = None
+        if self._capture is not None:
+            self.engines.captures.release(self._capture)
+            self._capture = None
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
+        self._cancel_utterance()
+
+    def _cancel_utterance(self):
+        if self._utterance is not None:
+            self.engines.utterances.cancel(self._utterance)
+            self._utterance = None
@@ -0,0 +1,221 @@
+import multiprocessing
+import os
+import signal
+from multiprocessing import shared_memory
+
+from engines import EnginePool
+from metrics import span
+
+
+def _rhino_recognizer():
+    from recognizer import Recognizer  # ~ note: pvrhino + numpy, in the worker process only.
+    return Recognizer()
+
+
+def _worker_main(conn, shm_name, recognizer_factory):
+    """
+    The recognition worker process: one recognizer (its own Rhino handle), serving the requests of one RemoteRecognizer.
+    The audio is read from the shared memory block, only the small requests / results go through the pipe.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # ~ note: the main process handles the Ctrl+C, and stops the workers.
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        recognizer = recognizer_factory()
+        conn.send(("ready",))
+
+        while True:
+            try:
+                request = conn.recv()
+            except EOFError:
+                break
+            op = request[0]
+            try:
+                if op == "chunk":
+                    finalized = recognizer.process_chunk(shm.buf[:request[1]])
+                    conn.send(("ok", finalized, recognizer.stream_rhino_time))
+                elif op == "start":
+                    recognizer.start_stream()
+                    conn.send(("ok",))
+                elif op == "finish":
+                    result = recognizer.finish_stream(request[1])
+                    conn.send(("ok", result, recognizer.stream_rhino_time))
+                elif op == "batch":
+                    _, size, gain_factor, quiet_duration, insert_mode = request
+                    result = recognizer.process_audio_data(shm.buf[:size], gain_factor, quiet_duration, insert_mode)
+                    conn.send(("ok", result, recognizer.frames_processed))
+                elif op == "reset":
+                    recognizer.reset()
+                    conn.send(("ok",))
+                elif op == "stop":
+                    break
+                else:
+                    conn.send(("err", f"unknown request '{op}'"))
+            except Exception as e:
+                conn.send(("err", str(e)))
+
+        recognizer.clear_res()
+    finally:
+        shm.close()
+
+
+class RemoteRecognizer:
+    """
+    A Recognizer running in a separate process: same interface (start_stream / process_chunk / finish_stream /
+    process_audio_data / reset / clear_res), so the EnginePool and the clients use it unchanged.
+
+    The recognition (the per frame Python loop, and pvRhino) runs outside the server process, so the GIL does not
+    serialize several intercoms talking at once. The audio goes through a shared memory block, not pickled bytes.
+
+    Supervised: a worker which died or hung is restarted (with a new recognizer), and the utterance is not understood.
+    ~ note: the requests are synchronous, one at a time (the client thread waits for every chunk result).
+            The workers are 'spawn' started: a fork of the multi-threaded server can inherit a held lock (ak. the
+            stdout lock of a printing client thread), and hang on its first print.
+    """
+    START_METHOD = "spawn"
+    MAX_AUDIO_SEC = 30          # the shared memory block size. Longer audio is trimmed (the start is kept).
+    READY_TIMEOUT = 30.0        # seconds for a new worker to load its model.
+    REPLY_TIMEOUT = 5.0         # seconds for a request. A longer one -> the worker is hung, restarted.
+    SAMPLE_RATE = 16000         # Recognizer.SAMPLE_RATE
+    SAMPLE_WIDTH = 2            # Recognizer.SAMPLE_WIDTH
+    GAIN_FACTOR = 10            # Recognizer.GAIN_FACTOR
+
+    def __init__(self, recognizer_factory=_rhino_recognizer):
+        self._factory = recognizer_factory
+        self._shm = shared_memory.SharedMemory(create=True, size=self.MAX_AUDIO_SEC * self.SAMPLE_RATE * self.SAMPLE_WIDTH)
+        self._process = None
+        self._conn = None
+        self.restarts = 0
+        self.stream_rhino_time = 0.0
+        self.frames_processed = 0
+        self._stream_failed = False
+        try:
+            self._start_worker()
+        except Exception:
+            self._shm.close()
+            self._shm.unlink()
+            raise
+
+    def _start_worker(self):
+        context = multiprocessing.get_context(self.START_METHOD)
+        parent_conn, child_conn = context.Pipe()
+        self._process = context.Process(target=_worker_main, args=(child_conn, self._shm.name, self._factory),
+                                                daemon=True, name="recognition-worker")
+        self._process.start()
+        child_conn.close()
+        self._conn = parent_conn
+        if not self._conn.poll(self.READY_TIMEOUT):
+            self._kill()
+            raise RuntimeError("Recognition worker did not start.")
+        self._conn.recv()
+        print(f"Recognition worker started [pid {self._process.pid}].")
+
+    def _kill(self):
+        if self._process is not None and self._process.is_alive():
+            self._process.kill()
+            self._process.join(timeout=1)
+        if self._conn is not None:
+            self._conn.close()
+
+    def _restart(self):
+        self.restarts += 1
+        print(f"ERR: recognition worker [pid {self._process.pid}] died or hung. Restarting ({self.restarts})...")
+        self._kill()
+        self._start_worker()
+
+    def _call(self, *request):
+        """ Send a request and wait for its reply -> the reply values, or None if the worker failed (restarted). """
+        try:
+            self._conn.send(request)
+            if not self._conn.poll(self.REPLY_TIMEOUT):
+                raise TimeoutError(f"no reply in {self.REPLY_TIMEOUT} sec")
+            reply = self._conn.recv()
+        except (EOFError, OSError, TimeoutError) as e:
+            print(f"ERR in the recognition worker request '{request[0]}' -> {e}")
+            try:
+                self._restart()
+            except Exception as e:
+                print(f"ERR restarting the recognition worker -> {e}")
+            return None
+
+        if reply[0] == "err":
+            print(f"ERR in the recognition worker -> {reply[1]}")
+            return None
+        return reply[1:]
+
+    def _write(self, audio_data):
+        """ Copy the audio into the shared memory block -> the size written. """
+        size = min(len(audio_data), self._shm.size)
+        if size < len(audio_data):
+            print(f"Audio trimmed to {self.MAX_AUDIO_SEC} sec for the recognition worker.")
+        self._shm.buf[:size] = memoryview(audio_data)[:size]
+        return size
+
+    # --- the Recognizer interface ---
+
+    def start_stream(self):
+        self.stream_rhino_time = 0.0
+        self._stream_failed = self._call("start") is None
+
+    def process_chunk(self, chunk):
+        if self._stream_failed:
+            return False
+        reply = self._call("chunk", self._write(chunk))
+        if reply is None:
+            self._stream_failed = True
+            return False
+        finalized, self.stream_rhino_time = reply
+        return finalized
+
+    def finish_stream(self, quiet_duration=1.0):
+        if self._stream_failed:
+            return None
+        reply = self._call("finish", quiet_duration)
+        if reply is None:
+            return None
+        result, self.stream_rhino_time = reply
+        return result
+
+    def process_audio_data(self, audio_data, gain_factor=None, quiet_duration=1.0, insert_mode='split', trace=None):
+        with span(trace, "rhino"):
+            reply = self._call("batch", self._write(audio_data), gain_factor, quiet_duration, insert_mode)
+        if reply is None:
+            return None
+        result, self.frames_processed = reply
+        return result
+
+    def reset(self):
+        if not self._process.is_alive():
+            self._restart()
+        else:
+            self._call("reset")
+        self._stream_failed = False
+
+    def clear_res(self):
+        try:
+            self._conn.send(("stop",))
+            self._process.join(timeout=2)
+        except Exception:
+            pass
+        self._kill()
+        self._shm.close()
+        self._shm.unlink()
+        print("Recognition worker stopped.")
+
+
+def create_process_pool(workers=None, recognizer_factory=_rhino_recognizer, background=False, **kwargs):
+    """
+    EnginePool with the recognizers in worker processes (see RemoteRecognizer).
+    workers: the worker processes count = the max simultaneous recognitions (default: the CPU count).
+    background: the workers are started by the EnginePool warm-up, after the server is listening (see EnginePool.start())
+    """
+    size = workers or os.cpu_count()
+    pool = EnginePool(size=size, recognizer_factory=lambda: RemoteRecognizer(recognizer_factory),
+                      warm=size, background=background, **kwargs)
+    if background:
+        return pool
+
+    # start all the workers now (the model loading takes time), instead of on the first commands.
+    recognizers = [pool.acquire() for _ in range(pool.size)]
+    for recognizer in recognizers:
+        pool.release(recognizer)
+    return pool
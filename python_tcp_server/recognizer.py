@@ -1,7 +1,12 @@
-import pvrhino
 import wave
 import numpy as np
 import struct
+import ctypes
+import time
+
+from metrics import span
+from dsp import AudioDSP
+from intents import IntentRegistry
 
 
 class Recognizer:
@@ -11,6 +16,7 @@ class Recognizer:
     CHUNK_SIZE = 512        # Data received in chunks from ESP32-S3. ESP buffer is 512 byte, so the server needs to capture exactly this.
 
     GAIN_FACTOR = 10        # used to boost the gain of the audio file, for clear capture.
+    AGC = True              # use the AudioDSP (DC removal, automatic gain, soft limiter) instead of the fixed GAIN_FACTOR.
     QUIET_BYTE = 0x000F     # we replace/ or add/ the last part of the collected audio_data with some quiet time, for the pvRhino to work
     # this assures data will have a quiet end, even in a noisy environment.
 
@@ -19,13 +25,31 @@ class Recognizer:
     _RHINO_MODEL_PATH = 'sr/rhino/rhino_speach_to_intent_model.rhn'
     # - NOTE: generate your model and api key in the Picovoice Console.
 
-    def __init__(self):
+    SCRATCH_SIZE = 4096     # samples. The int32 block used for the amplification without overflow.
+    NATIVE_PROCESS_VERSIONS = ("3.0.",)     # pvrhino versions checked with the native process call (see _rhino_process())
+
+    SENSITIVITY = 0.35      # pvRhino sensitivity (0.0 - 1.0). Higher -> less misses, more false understandings.
+    ENDPOINT_SEC = 0.8      # pvRhino endpoint_duration_sec: the silence after the command, to finalize the inference.
+
+    def __init__(self, sensitivity=None, endpoint_duration_sec=None):
+        import pvrhino  # ~ note: imported with the first model, so the stub engines (stubs.py) run without it.
 
         self.rhino = pvrhino.create(access_key=Recognizer._PV_ACCESS_KEY,
                                     context_path=Recognizer._RHINO_MODEL_PATH,
-                                    sensitivity=0.35,
-                                    endpoint_duration_sec=0.8,
+                                    sensitivity=self.SENSITIVITY if sensitivity is None else sensitivity,
+                                    endpoint_duration_sec=self.ENDPOINT_SEC if endpoint_duration_sec is None else endpoint_duration_sec,
                                     require_endpoint=True)
+        self._init_buffers()
+        self.start_stream()
+
+    def _init_buffers(self):
+        """ Preallocated audio buffers, reused for every utterance. """
+        self._buffer = np.empty(0, dtype=np.int16)                           # batch work buffer. See _work_buffer()
+        self.frames_processed = 0                                           # Rhino frames of the last process_audio_data()
+        self._scratch = np.empty(self.SCRATCH_SIZE, dtype=np.int32)         # amplification scratch
+        self._frame = np.empty(self.rhino.frame_length, dtype=np.int16)     # streaming: the amplified frame
+        self.dsp = AudioDSP(frame_length=self.rhino.frame_length)           # see dsp.AudioDSP and AGC
+        self._native_process = self._native_process_func()                  # see _rhino_process()
 
     @staticmethod
     def _read_file(file_name, sample_rate):
@@ -140,58 +164,246 @@ class Recognizer:
             wf.writeframes(audio_data)
         print(f"Audio saved as {filename}")
 
-    def process_audio_data(self, audio_data):
-        # 1. amplify the audio_data:
-        audio_data_amplified = self._amplify_audio(audio_data, self.GAIN_FACTOR)
-        print(f"Audio amplified by factor of {self.GAIN_FACTOR}. Amplified: [{len(audio_data_amplified)} bytes]")
+    def _work_buffer(self, samples_num):
+        """
+        The preallocated int16 work buffer, (re)used by process_audio_data() for every utterance.
+        ~ note: it only grows (x2) when a longer utterance comes, so a recognizer from the EnginePool stops allocating after warm-up.
+        """
+        if len(self._buffer) < samples_num:
+            self._buffer = np.empty(max(samples_num, 2 * len(self._buffer)), dtype=np.int16)
+        return self._buffer[:samples_num]
 
-        # 2. quieting the last part of the audio, for recognition purposes
-        self._quieting_audio_end(audio_data_amplified, 1.0)
-        # 512 bytes per frame, 16000 bytes per sec --> 0.032 sec per frame. (31.25 frames x 512)/16000 = 1.0 sec
-        # ~ note: the quiet duration will be trimmed to fit the x512 rule multiple (31 frames -> 0.992 s)
+    def _amplify_into(self, src, dst, gain_factor):
+        """
+        Amplify int16 samples (src) into dst, with clipping. Works block by block, on the preallocated int32 scratch,
+        so no full-size temporary arrays are created. src and dst may be the same array (in-place).
+        """
+        block = len(self._scratch)
+        for start in range(0, len(src), block):
+            end = min(start + block, len(src))
+            scratch = self._scratch[:end - start]
+            np.multiply(src[start:end], gain_factor, out=scratch, dtype=np.int32)  # ~ note: int32, so no overflow before the clip.
+            np.clip(scratch, -32768, 32767, out=scratch)
+            dst[start:end] = scratch
+
+    def _quiet_samples_num(self, quiet_duration):
+        """ Number of quiet samples for the duration, trimmed to x1024 bytes (same as _quieting_audio_end()). """
+        total_quiet_bytes = int(self.SAMPLE_RATE * quiet_duration) * self.SAMPLE_WIDTH * self.CHANNELS
+        return (total_quiet_bytes // 1024) * 1024 // self.SAMPLE_WIDTH
+
+    def _native_process_func(self):
+        """
+        The native pv_rhino_process() of the pvrhino handle (its private _process_func / _handle), or None.
+        Only for the NATIVE_PROCESS_VERSIONS of pvrhino, with the expected C signature: another version (an upgrade)
+        gets the public Rhino.process(), not a ctypes call that may crash.
+        """
+        process_func = getattr(self.rhino, '_process_func', None)
+        if process_func is None or getattr(self.rhino, '_handle', None) is None:
+            return None
+        try:
+            from importlib.metadata import version
+            installed = version("pvrhino")
+        except Exception:
+            installed = "unknown"
+        argtypes = getattr(process_func, 'argtypes', None) or ()
+        if (not installed.startswith(self.NATIVE_PROCESS_VERSIONS) or len(argtypes) != 3
+                or argtypes[1] is not ctypes.POINTER(ctypes.c_short)):
+            print(f"pvrhino {installed}: using the public Rhino.process() "
+                  f"(the native call is checked for the versions {', '.join(self.NATIVE_PROCESS_VERSIONS)}).")
+            return None
+        return process_func
+
+    def _rhino_process(self, frame):
+        """
+        Hand a frame (a view of int16 samples) to Rhino.
+        ~ note: Rhino.process() converts the frame to a ctypes array sample by sample (512 Python objects per frame).
+                For a checked pvrhino version (see _native_process_func()), the frame buffer is passed directly
+                to the native process function instead.
+        """
+        process_func = self._native_process
+        if process_func is None or not frame.flags.c_contiguous:
+            return self.rhino.process(frame)
 
-        print(f"Audio data ready for save and recognition.")
+        result = ctypes.c_bool()
+        status = process_func(self.rhino._handle, frame.ctypes.data_as(ctypes.POINTER(ctypes.c_short)), ctypes.byref(result))
+        if getattr(status, 'value', status) != 0:  # 0 -> PV_STATUS_SUCCESS
+            raise RuntimeError(f"Rhino process failed with status {status}")
+        return result.value
 
-        # self.save_wav_file(audio_data_amplified,
+    def process_audio_data(self, audio_data, gain_factor=None, quiet_duration=1.0, insert_mode='split', trace=None):
+        """
+        Recognize a full utterance (batch mode).
+
+        The audio is copied once into the preallocated int16 work buffer, amplified in-place, the quiet end is written
+        directly into it (same modes as _quieting_audio_end()), and the Rhino frames are views of that buffer.
+
+        Args:
+            audio_data (bytes-like): 16-bit little-endian mono audio.
+            gain_factor (int): fixed amplification. Default: the AudioDSP if AGC, else GAIN_FACTOR.
+            quiet_duration (float): seconds of quiet sound for the audio end (trimmed to x1024 bytes).
+            insert_mode (str): 'replace', 'extend' or 'split'. See _quieting_audio_end()
+            trace (metrics.Trace): records the 'amplify' and 'rhino' spans, if given.
+        """
+        use_dsp = gain_factor is None and self.AGC
+        gain_factor = self.GAIN_FACTOR if gain_factor is None else gain_factor
+        samples_num = len(audio_data) // self.SAMPLE_WIDTH
+        quiet_num = self._quiet_samples_num(quiet_duration)
+
+        # 1. where the quiet part starts / ends:
+        if insert_mode == 'split':
+            replaced = min(quiet_num // 2, samples_num)
+            total = samples_num + (quiet_num - quiet_num // 2)
+        elif insert_mode == 'extend':
+            replaced = 0
+            total = samples_num + quiet_num
+        elif insert_mode == 'replace':
+            replaced = quiet_num if samples_num > quiet_num else 0
+            total = samples_num
+        else:
+            raise ValueError("insert_mode should be a str equal to 'replace', 'extend' or 'split'.")
+
+        # 2. copy and amplify the audio_data into the work buffer, then quieting the last part.
+        with span(trace, "amplify"):
+            buffer = self._work_buffer(total)
+            source = np.frombuffer(audio_data, dtype=np.int16, count=samples_num)  # ~ note: a view, no copy.
+            audio_end = samples_num - replaced
+            if use_dsp:
+                self.dsp.reset()
+                self.dsp.process(source[:audio_end], buffer[:audio_end])
+            else:
+                self._amplify_into(source[:audio_end], buffer[:audio_end], gain_factor)
+            buffer[audio_end:] = self.QUIET_BYTE
+            del source
+
+        gain_info = f"AGC (last gain {self.dsp.gain:.1f})" if use_dsp else f"factor of {gain_factor}"
+        print(f"Audio amplified by {gain_info}, quiet end added: [{total * self.SAMPLE_WIDTH} bytes]")
+
+        # self.save_wav_file(buffer,
         #                    sample_rate=self.SAMPLE_RATE,
         #                    sample_width=self.SAMPLE_WIDTH,
         #                    channels=self.CHANNELS,
         #                    filename="audio_data.wav")
 
         # recognizing...
-        audio_frames = struct.unpack('<' + 'h' * (len(audio_data_amplified) // 2), audio_data_amplified)
-
         frame_length = self.rhino.frame_length  # the value is 512.
-        num_frames = len(audio_frames) // frame_length
+        num_frames = total // frame_length
 
         print(f"Start decoding [{num_frames} frames]... rhino frame length = {self.rhino.frame_length}")
+        self.frames_processed = 0
         try:
-            # frames_scanned = 0
-            for i in range(num_frames):
-                frame = audio_frames[i * frame_length:(i + 1) * frame_length]
-                is_finalized = self.rhino.process(frame)
-                if is_finalized:
-                    print("Finalized!")
-                    # print(f"Finalized! -> {frames_scanned} frames scanned, total of {frames_scanned*frame_length} bytes.")
-
-                    inference = self.rhino.get_inference()
-                    if inference.is_understood:
-                        return inference.intent, inference.slots
-                    else:
-                        # print(f"Didn't understand the command. -> {frames_scanned} frames scanned, total of {frames_scanned*frame_length} bytes.")
-                        return None
-
-                # frames_scanned += len(frame)
-            # print(f"pvRhino finished -> {frames_scanned} frames scanned, total of {frames_scanned*frame_length} bytes.")
+            with span(trace, "rhino"):
+                for i in range(num_frames):
+                    self.frames_processed = i + 1
+                    if self._rhino_process(buffer[i * frame_length:(i + 1) * frame_length]):
+                        print(f"Finalized! -> {i + 1} frames scanned.")
+                        return self._inference_result()
 
         except Exception as e:
             print(f"ERR in pvrhino decode -> {e}")
 
+    def _inference_result(self):
+        """ Read the finalized Rhino inference -> (intent, slots) or None if not understood. """
+        inference = self.rhino.get_inference()
+        if inference.is_understood:
+            return inference.intent, inference.slots
+        return None
+
+    def start_stream(self):
+        """
+        Prepare the recognizer for a new real-time (streaming) utterance.
+        Must be called before the first process_chunk() of every utterance.
+        """
+        self._stream_buffer = bytearray()
+        self._stream_finalized = False
+        if len(self._frame) != self.rhino.frame_length:
+            self._frame = np.empty(self.rhino.frame_length, dtype=np.int16)
+        self._stream_result = None
+        self._stream_frames = 0
+        self.dsp.reset()
+        self.stream_rhino_time = 0.0  # seconds spent in the amplification + Rhino, for the current stream.
+
+    def process_chunk(self, chunk):
+        """
+        Amplify and decode an incoming audio chunk with pvRhino, while the audio is still being received.
+        ~ note: the ESP sends 512 bytes chunks (256 samples), but Rhino needs frames of 512 samples (1024 bytes),
+                so the chunks are collected until a full frame is available.
+
+        Returns:
+            bool: True when Rhino finalized the inference. The caller should stop recording and answer.
+        """
+        if self._stream_finalized:
+            return True
+
+        self._stream_buffer.extend(chunk)
+        frame_length = self.rhino.frame_length
+        frame_bytes = frame_length * self.SAMPLE_WIDTH
+        start = time.perf_counter()
+
+        try:
+            while len(self._stream_buffer) >= frame_bytes:
+                frame_data = np.frombuffer(self._stream_buffer, dtype=np.int16, count=frame_length)
+                if self.AGC:
+                    self.dsp.process(frame_data, self._frame)
+                else:
+                    self._amplify_into(frame_data, self._frame, self.GAIN_FACTOR)
+                del frame_data  # release the buffer view, before resizing it.
+                del self._stream_buffer[:frame_bytes]
+
+                self._stream_frames += 1
+                if self._rhino_process(self._frame):
+                    print(f"Finalized! -> {self._stream_frames} frames scanned (streaming).")
+                    self._stream_finalized = True
+                    self._stream_result = self._inference_result()
+                    return True
+
+        except Exception as e:
+            print(f"ERR in pvrhino stream decode -> {e}")
+
+        finally:
+            self.stream_rhino_time += time.perf_counter() - start
+
+        return False
+
+    def finish_stream(self, quiet_duration=1.0):
+        """
+        Called when the audio stream ended. If Rhino is already finalized, return the result directly.
+        Otherwise, feed some quiet frames (same as the _quieting_audio_end() in the batch mode),
+        helping the recognizer to reach the endpoint.
+        """
+        if not self._stream_finalized:
+            frame_length = self.rhino.frame_length
+            quiet_frames = int(self.SAMPLE_RATE * quiet_duration) // frame_length
+            quiet_frame = np.full(frame_length, self.QUIET_BYTE, dtype=np.int16)
+            # ~ note: the incomplete frame left in the buffer is dropped. Less than 0.032 sec of audio.
+            print(f"Stream ended without endpoint. Flushing with [{quiet_frames}] quiet frames...")
+            start = time.perf_counter()
+            try:
+                for _ in range(quiet_frames):
+                    self._stream_frames += 1
+                    if self._rhino_process(quiet_frame):
+                        print(f"Finalized! -> {self._stream_frames} frames scanned (streaming).")
+                        self._stream_finalized = True
+                        self._stream_result = self._inference_result()
+                        break
+            except Exception as e:
+                print(f"ERR in pvrhino stream decode -> {e}")
+            self.stream_rhino_time += time.perf_counter() - start
+
+        self._stream_buffer = bytearray()
+        return self._stream_result
+
+    def reset(self):
+        """ Reset the Rhino state and the streaming buffers, ready for a new utterance (ak. when returned to the EnginePool). """
+        if hasattr(self.rhino, 'reset'):  # ~ note: Rhino.reset() is available in pvrhino >= 3.0
+            self.rhino.reset()
+        self.start_stream()
+
     def clear_res(self):
         print("clearing PicoVoice...")
 
         if self.rhino is not None:
             self.rhino.delete()
+            self.rhino = None
 
         if not self.rhino:
             print("Picovoice resources cleared successfully")
@@ -204,17 +416,20 @@ class Decoder:
     giving back a human friendly text response.
 
     This is a bridge between the action methods (light-on, door-close...) and the pvRhino model.
+    The actions are registered per intent in `intents` (see intents.IntentRegistry): decode_rhino() returns their
+    response at once, and the actions run in the background (a slow device never delays the spoken answer).
     """
-    def __init__(self):
-        # TODO: this class may inherit the action / skills class and its executing methods.
-        #       or the possible Engage class may inherit this class, and skills class too,
-        #       and call something like engage.decode_rhino(), for example...
-        ...
+    UNDERSTOOD = "Command received and understood!"
+    NOT_UNDERSTOOD = "Sorry, I did not understand that."
+
+    def __init__(self, intents=None):
+        self.intents = intents or IntentRegistry()
 
-    def decode_rhino(self, pvRhino_result:tuple):
+    def decode_rhino(self, pvRhino_result:tuple, device=None, run_actions=True):
         """
         The method decodes the incoming request and return / run the functions that should be ran.
         It also returns a text response, for the user to be spoken back.
+        run_actions=False -> only the response, no side effects (ak. the session replay).
 
         ~ note: When the used pvRhino model is changed, only this part should be reworked.
         """
@@ -232,13 +447,24 @@ class Decoder:
             print('  }')
             print('}')
 
-            ...
-            test_respond = "Command received and understood!"
+            # -- run the action of the intent (in the background), and get its response.
+            test_respond = self.intents.dispatch(intent, slots, device=device, run=run_actions) or self.UNDERSTOOD
         else:
-            test_respond = "Sorry, I did not understand that."
+            test_respond = self.NOT_UNDERSTOOD
 
         return test_respond
 
+    def known_responses(self):
+        """ All the text responses decode_rhino() can give. Pre-rendered to audio on the server start (see prerender.py).
+            ~ note: responses with variable parts (ak. numbers, time) can not be listed here.
+                    The intent handler responses are listed, with all the allowed slot values combinations.
+        """
+        return [self.UNDERSTOOD, self.NOT_UNDERSTOOD] + self.intents.responses()
+
+    def close(self):
+        """ Wait for the running intent actions. """
+        self.intents.close()
+
 
 
 
@@ -0,0 +1,253 @@
+"""
+Session recording (opt-in) and replay, to debug the misrecognitions with the production audio.
+
+Recording: python main.py --record recordings/
+    Every command is recorded: the raw received audio (before the VAD), the audio given to the recognizer,
+    the Rhino result, the decoder response and the latency spans.
+    The clients only hand over the data (a copy of the audio), a background thread writes it. When the writer can not
+    keep up, the sessions are dropped (counted), the live commands are never slowed down.
+
+Archive (a directory):
+    archive.bin     the audio, appended
+    index.jsonl     one line per session: the metadata, and the [offset, size] of its audio in archive.bin
+    The archive is read memory-mapped (SessionArchive), so any session audio is read without loading the archive.
+
+Replay: feed recorded sessions through the current pipeline (VAD, recognizer, decoder), and compare with the recorded:
+    python recorder.py recordings/ --engine stub            # all the sessions
+    python recorder.py recordings/ --ids 3 7 --processed    # the recognizer audio, without the VAD
+or the 'replay [id]' console command of the running server (main.py).
+"""
+import argparse
+import json
+import mmap
+import os
+import queue
+import threading
+import time
+
+
+class SessionRecorder:
+    """
+    The background writer of the session archive. Disabled until start(directory).
+    ~ note: the server-wide instance is recorder.RECORDER (like metrics.METRICS).
+    """
+    ARCHIVE = "archive.bin"
+    INDEX = "index.jsonl"
+    MAX_QUEUE = 32      # sessions waiting for the writer. More -> dropped.
+    CHUNK_SIZE = 512    # the replay chunks, same as the ESP audio chunks.
+
+    def __init__(self):
+        self.directory = None
+        self._queue = queue.Queue(maxsize=self.MAX_QUEUE)
+        self._thread = None
+        self.recorded = 0
+        self.dropped = 0
+
+    @property
+    def enabled(self):
+        return self.directory is not None
+
+    def start(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self._thread = threading.Thread(target=self._run, daemon=True, name="session-recorder")
+        self._thread.start()
+        print(f"Session recorder: recording to {directory}/")
+
+    def stop(self):
+        """ Write the queued sessions, and stop the writer. """
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+        self.directory = None
+        print(f"Session recorder stopped: {self.recorded} recorded, {self.dropped} dropped.")
+
+    def take(self, capture):
+        """
+        The audio of an utterance to be recorded: (raw, audio, truncated), copied from the capture.CaptureBuffer
+        before it is released (its raw audio kept, see CaptureBuffer.keep_raw()). None if not recording.
+        """
+        if not self.enabled:
+            return None
+        return bytes(capture.raw or b''), bytes(capture.audio), capture.truncated
+
+    def record(self, device, audio, result, response, trace=None):
+        """ Hand over a command to the writer (non-blocking). audio: from take(). Called after the trace finished. """
+        if not self.enabled or audio is None:
+            return
+        raw, processed, truncated = audio
+        session = {"device": device, "time": time.time(), "trace": trace.id if trace is not None else None,
+                   "result": [result[0], dict(result[1])] if result is not None else None, "response": response,
+                   "spans": _spans(trace), "truncated": truncated}
+        try:
+            self._queue.put_nowait((session, raw, processed))
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        archive_path = os.path.join(self.directory, self.ARCHIVE)
+        index_path = os.path.join(self.directory, self.INDEX)
+        with open(archive_path, "ab") as archive, open(index_path, "a", encoding="utf-8") as index:
+            session_id = _count_lines(index_path)
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    break
+                session, raw, audio = item
+                try:
+                    offset = archive.tell()
+                    archive.write(raw)
+                    archive.write(audio)
+                    archive.flush()
+                    # ~ note: the index line is written after its audio, so an index entry always has its audio.
+                    session.update(id=session_id, raw=[offset, len(raw)], audio=[offset + len(raw), len(audio)])
+                    index.write(json.dumps(session) + "\n")
+                    index.flush()
+                    session_id += 1
+                    self.recorded += 1
+                except Exception as e:
+                    self.dropped += 1
+                    print(f"ERR in the session recorder -> {e}")
+
+    def stats(self):
+        return {"directory": self.directory, "recorded": self.recorded, "dropped": self.dropped,
+                "queued": self._queue.qsize()}
+
+
+def _spans(trace):
+    """ {stage: ms} of a metrics.Trace """
+    spans = {}
+    if trace is not None:
+        for stage, seconds in trace.spans:
+            spans[stage] = round(spans.get(stage, 0.0) + seconds * 1000, 3)
+    return spans
+
+
+def _count_lines(path):
+    with open(path, "rb") as f:
+        return sum(1 for _ in f)
+
+
+RECORDER = SessionRecorder()
+
+
+class SessionArchive:
+    """ Read access to a session archive: the index, and the audio memory-mapped (no copy until used). """
+    def __init__(self, directory):
+        self.directory = directory
+        self.sessions = []
+        self._file = None
+        self._map = None
+        self.refresh()
+
+    def refresh(self):
+        """ Load the index and map the archive again (the recorder may have appended sessions). """
+        self.close()
+        with open(os.path.join(self.directory, SessionRecorder.INDEX), encoding="utf-8") as f:
+            self.sessions = [json.loads(line) for line in f if line.strip()]
+        self._file = open(os.path.join(self.directory, SessionRecorder.ARCHIVE), "rb")
+        if os.fstat(self._file.fileno()).st_size:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def get(self, session_id):
+        for session in self.sessions:
+            if session["id"] == session_id:
+                return session
+        raise KeyError(f"No session {session_id} in {self.directory}")
+
+    def audio(self, session, kind="raw"):
+        """ kind: 'raw' (as received) or 'audio' (as given to the recognizer) -> a memoryview of the archive. """
+        offset, size = session[kind]
+        if not size:
+            return memoryview(b'')
+        return memoryview(self._map)[offset:offset + size]
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def replay_session(archive, session, recognizer, decoder, raw=True, vad=True):
+    """
+    Feed one recorded session through the pipeline, the same way as the tcp_client.Client streaming record:
+    the audio in 512 bytes chunks -> the VAD (raw audio only) -> recognizer.process_chunk() -> the decoder.
+
+    Returns:
+        tuple: (result, response, changed): changed is True if the result differs from the recorded one.
+    """
+    from vad import VoiceActivityDetector  # ~ note: numpy, not imported on the server start.
+
+    audio = archive.audio(session, "raw" if raw and session["raw"][1] else "audio")
+    detector = VoiceActivityDetector() if vad and raw and session["raw"][1] else None
+
+    recognizer.reset()
+    recognizer.start_stream()
+    for start in range(0, len(audio), SessionRecorder.CHUNK_SIZE):
+        chunk = audio[start:start + SessionRecorder.CHUNK_SIZE]
+        if detector is not None:
+            chunk = detector.process(chunk)
+        if len(chunk) and recognizer.process_chunk(chunk):
+            break
+        if detector is not None and detector.ended:
+            break
+    result = recognizer.finish_stream()
+
+    response = decoder.decode_rhino(pvRhino_result=result, run_actions=False)
+    replayed = [result[0], dict(result[1])] if result is not None else None
+    return result, response, replayed != session["result"]
+
+
+def replay(archive, recognizer, decoder, ids=None, raw=True, vad=True):
+    """ Replay the sessions (all, or the ids) -> the report lines. """
+    sessions = archive.sessions if not ids else [archive.get(session_id) for session_id in ids]
+    lines = [f"{'id':>5}  {'device':<16}{'recorded':<28}{'replayed':<28}"]
+    changed = 0
+    for session in sessions:
+        result, response, differs = replay_session(archive, session, recognizer, decoder, raw=raw, vad=vad)
+        changed += differs
+        recorded = session["result"][0] if session["result"] else "-"
+        replayed = result[0] if result is not None else "-"
+        lines.append(f"{session['id']:>5}  {session['device']:<16}{recorded:<28}{replayed:<28}"
+                     f"{'CHANGED' if differs else ''}")
+    lines.append(f"{len(sessions)} sessions replayed, {changed} changed.")
+    return lines
+
+
+def main():
+    from evaluate import engine_factory
+    from recognizer import Decoder
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("archive", help="the session archive directory (main.py --record)")
+    parser.add_argument("--ids", type=int, nargs="+", help="the sessions to replay (default: all)")
+    parser.add_argument("--engine", default="rhino", help="'rhino', 'stub' or module:function (see evaluate.py)")
+    parser.add_argument("--sensitivity", type=float, default=0.35)
+    parser.add_argument("--endpoint", type=float, default=0.8)
+    parser.add_argument("--processed", action="store_true", help="replay the recognizer audio (no VAD), not the raw")
+    parser.add_argument("--list", action="store_true", help="only list the sessions")
+    args = parser.parse_args()
+
+    archive = SessionArchive(args.archive)
+    if args.list:
+        for session in archive.sessions:
+            print(f"{session['id']:>5}  {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(session['time']))}  "
+                  f"{session['device']:<16}{str(session['result']):<50}{session['spans'].get('total', 0):>9.1f} ms")
+        return
+
+    recognizer = engine_factory(args.engine)(args.sensitivity, args.endpoint)
+    try:
+        lines = replay(archive, recognizer, Decoder(), ids=args.ids, raw=not args.processed)
+    finally:
+        recognizer.clear_res()
+        archive.close()
+    print("\n".join(lines))
+
+
+if __name__ == "__main__":
+    main()
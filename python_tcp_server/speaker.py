@@ -1,8 +1,18 @@
-from google.cloud import texttospeech_v1
 import os
 import re
+import hashlib
 from datetime import datetime
 import time
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from tts_cache import ResponseCache
+from device_manifest import DeviceManifest
+from metrics import span
+from filler import FillerPolicy
+from synthesis import SynthesisCoordinator
+import mp3pack
+import handshake
 
 class Speach:
     PITCH = 1.5  # voice pitch
@@ -12,19 +22,57 @@ class Speach:
     CHANNELS = 1
     SAMPLE_WIDTH = 2  # 16-bit audio (2 bytes per sample)
 
-    def __init__(self):
+    VOICE_NAME = 'en-US-Wavenet-F'
+    PRERENDER_WAIT = 10.0   # seconds to wait for a text being pre-rendered, before synthesizing it again.
+
+    TRANSFER_CHUNK = 32 * 1024  # bytes per send of the mp3 transfer (the progress accounting step)
+    TRANSFER_TIMEOUT = 10.0     # seconds for a whole mp3 transfer to one device
+
+    SPEAK_FILE = "tts/speak.mp3"   # the last synthesized response, not saved to the offline_audio/ (for listening to it).
+
+    FILLER = True           # say a filler ('On it.') while a not cached response is synthesized. See filler.FillerPolicy
+    SYNTH_WORKERS = 4       # threads preparing the responses audio (prepare_audio()).
+
+    LEGACY_NAMES = True     # keep the old SPIFFS file names of the known responses, where still unambiguous. See device_filename()
+    PACK = True             # drop the mp3 tags and the silent frames at both ends, before caching. See mp3pack.pack()
+    EFFECTS_PROFILE = None  # the TTS audio profile, ak. 'small-bluetooth-speaker-class-device' (None: the TTS default)
+    # ~ note: the mp3 bitrate is kept: the v1 firmware plays a received file for (bytes * 8 / 64000) sec.
+
+    def __init__(self, cache=None, manifest=None, synthesis=None):
         self._is_error = False
         self.client = None
+        self.cache = cache or ResponseCache(voice_id=self.voice_id())
+        # ~ note: the offline responses (memory + tts/offline_audio/). See tts_cache.ResponseCache
+        self.manifest = manifest or DeviceManifest()
+        # ~ note: the mp3 files stored on each device. See device_manifest.DeviceManifest
+        self.prerendering = {}  # text -> Future, of the texts being pre-rendered. See prerender.Prerenderer
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="tts-writer")
+        # ~ note: the fresh audio is written to the disk here, while it is sent to the device.
+        self.transfers = {"count": 0, "bytes": 0, "sendfile": 0, "errors": 0}
+        self.fillers = FillerPolicy(enabled=self.FILLER)
+        self.synthesis = synthesis or SynthesisCoordinator()
+        # ~ note: the TTS calls: one per text in flight, max SynthesisCoordinator.MAX_CONCURRENT at once.
+        self._synth = ThreadPoolExecutor(max_workers=self.SYNTH_WORKERS, thread_name_prefix="tts-synth")
+        self.packing = {"count": 0, "bytes_in": 0, "bytes_out": 0}
+        self._device_names = {}  # text -> its legacy device file name. See keep_legacy_names()
+
+        self._init_client()
+
+    def _init_client(self):
+        """ Init the Google TTS client and the voice configurations. """
         try:
             # 1. init the client
+            from google.cloud import texttospeech_v1
+            # ~ note: imported here, not on the module import: heavy (grpc), and the server binds before. See EnginePool.start()
             os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = "tts/gtts_accnt.json"
             self.client = texttospeech_v1.TextToSpeechClient()
 
             # 2. configurate the voice  and response configurations
 
-            self.voice0 = texttospeech_v1.VoiceSelectionParams(language_code='en-US', name='en-US-Wavenet-F', ssml_gender=texttospeech_v1.SsmlVoiceGender.FEMALE)
+            self.voice0 = texttospeech_v1.VoiceSelectionParams(language_code='en-US', name=Speach.VOICE_NAME, ssml_gender=texttospeech_v1.SsmlVoiceGender.FEMALE)
 
-            self.audio_config_mp3 = texttospeech_v1.AudioConfig(audio_encoding=texttospeech_v1.AudioEncoding.MP3, speaking_rate=Speach.RATE, pitch=Speach.PITCH)
+            self.audio_config_mp3 = texttospeech_v1.AudioConfig(audio_encoding=texttospeech_v1.AudioEncoding.MP3, speaking_rate=Speach.RATE, pitch=Speach.PITCH,
+                                                                effects_profile_id=[Speach.EFFECTS_PROFILE] if Speach.EFFECTS_PROFILE else None)
             self.audio_config_wav = texttospeech_v1.AudioConfig(audio_encoding=texttospeech_v1.AudioEncoding.LINEAR16, sample_rate_hertz=16000, speaking_rate=Speach.RATE, pitch=Speach.RATE)
             # ~ note: LINEAR16 is a PCM (with a sample_rate_hertz=16000, channel_count=1, and sample_width=2 (16-bit audio))
             #          ... but with a WAV header included, ensuring that the data can be played on more devices, like Arduino Audio library.
@@ -36,6 +84,12 @@ class Speach:
             print(f"An exception raised during TTS init: {e}")
             self._is_error = True
 
+    @classmethod
+    def voice_id(cls):
+        """ The voice configuration, part of the cache keys. A changed voice does not reuse the old responses. """
+        voice = f"{cls.VOICE_NAME}|{cls.RATE}|{cls.PITCH}"
+        return f"{voice}|{cls.EFFECTS_PROFILE}" if cls.EFFECTS_PROFILE else voice
+
     @staticmethod
     def _play_sound(audio_data=None, mp3_file=None):
         """
@@ -58,11 +112,8 @@ class Speach:
         """
         try:
             # check if a file to speak (with name "text") is available offline
-            encoded = Tools.encode_str(text)
-            filename = f"tts/offline_audio/{encoded}.mp3"
-
-            is_exist = os.path.exists(filename)
-            if is_exist:
+            filename = self.cache.path(text)
+            if filename:
                 self._play_sound(mp3_file=filename)
                 return True
             else:
@@ -72,11 +123,10 @@ class Speach:
             print(f"ERR: in _speak_offline(): {e}")
             return False
 
-    @staticmethod
-    def _transmit_offline(text):
+    def _transmit_offline(self, text):
         """
-        Check if an audio file for the given text exists locally.
-        If it exists, read and return the audio content.
+        Check if an audio for the given text is cached (in memory, or in the offline_audio/ files).
+        If it exists, return the audio content (a memory hit does not touch the filesystem).
         If not, return None.
 
         Args:
@@ -86,21 +136,12 @@ class Speach:
             bytes: The audio content if the file exists, otherwise None.
         """
         try:
-            # check if a file to speak (with name "text") is available offline
-            encoded = Tools.encode_str(text)
-            filename = f"tts/offline_audio/{encoded}.mp3"
-            # print(f"try to speak: {filename}")
-            # path = f"/home/alex/lab/alex2.0/{filename}"
-            if os.path.exists(filename):
-                # Read the file content
-                with open(filename, "rb") as audio_file:
-                    audio_content = audio_file.read()
-                    print(f"Found offline audio file: {filename}. Read {len(audio_content)} bytes")
-                return audio_content
-
+            audio_content = self.cache.get(text)
+            if audio_content is not None:
+                print(f"Found offline audio for: '{text}'. {len(audio_content)} bytes")
             else:
                 print(f"No offline audio file found for text: {text}")
-                return None
+            return audio_content
 
         except Exception as e:
             print(f"ERR: in _offline_transmit: {e}")
@@ -117,108 +158,187 @@ class Speach:
             else:
                 # speak online:
                 try:
-                    synthesis_input = texttospeech_v1.SynthesisInput(text=text)
-                    response = self.client.synthesize_speech(input=synthesis_input, voice=self.voice0, audio_config=self.audio_config_mp3)
+                    audio_content = self.synthesis.run(self.cache.key(text), self._synthesize_new, text, save_it)
 
                 except Exception as e:
                     print(f"ERR while speak: {e}")
 
                 else:
-                    # Note: The Ubuntu max file_name is 255. So with the encoding it should not exceed that.
-                    if save_it and len(text) < 60:
-                        encoded = Tools.encode_str(text)
-                        filename = f"tts/offline_audio/{encoded}.mp3"
-                    else:
-                        filename = "tts/speak.mp3"
+                    # ~ note: played from memory. The speak.mp3 file may be replaced meanwhile, by a client response.
+                    self._play_sound(audio_data=audio_content)
 
-                    with open(filename, 'wb') as output:
-                        output.write(response.audio_content)
+    def _synthesize(self, text):
+        """ Generate new mp3 audio content for the text, using Google Cloud TTS. """
+        from google.cloud import texttospeech_v1
 
-                    self._play_sound(mp3_file="tts/speak.mp3")
+        synthesis_input = texttospeech_v1.SynthesisInput(text=text)
+        response = self.client.synthesize_speech(input=synthesis_input, voice=self.voice0,
+                                                 audio_config=self.audio_config_mp3)
+        return response.audio_content
 
-    def speak_transmit(self, text, client, save_it=False):
-        # --> check if the text is already spoken (mp3 file available in the offline_audio/)
-        #     and send the audio file to the esp32
-        if not self._is_error and text:
-
-            # 1. Get the audio data:
-            audio_content = self._transmit_offline(text)
-            if audio_content is None:  # TODO: and if is_online...
-                # Generate new audio content using Google Cloud TTS
-                try:
-                    synthesis_input = texttospeech_v1.SynthesisInput(text=text)
-                    response = self.client.synthesize_speech(input=synthesis_input, voice=self.voice0,
-                                                             audio_config=self.audio_config_mp3)
-
-                    audio_content = response.audio_content
-
-                    if save_it and len(text) < 60:
-                        encoded = Tools.encode_str(text)
-                        mp3_filename = f"tts/offline_audio/{encoded}.mp3"
-                    else:
-                        mp3_filename = "tts/speak.mp3"
-
-                    # ->  save the file
-                    with open(mp3_filename, 'wb') as output:
-                        output.write(response.audio_content)
-                    # ~ note: we save the file to local, no mater save_it flag. But if False, we overwrite the speak.mp3 file.
-
-                except Exception as e:
-                    print(f"ERR while generating online GTTS respond: {e}")
-                    print("Transmit to ESP32 terminated..")
-
-            # 2. Send the audio data over TCP Wifi:
-            if audio_content:
-                try:
+    def get_audio(self, text, save_it=False, wait_prerender=True, trace=None):
+        """
+        Get the mp3 audio data for the text: from the offline_audio/ if already spoken,
+        or generated with the TTS (and saved locally).
+        ~ note: this is the blocking (slow) part of the respond. It does not touch the client socket,
+                so it can be run in a worker thread / executor.
 
-                    # a. sending 'server-call' to the client - the file name of the spoken text, encoded to binary, max 29 chars, to 29 bytes.:
-                    server_call_data = Tools.mp3name_to_bin(text)
-                    client.send(server_call_data)
-                    print("Server-Call signal sent")
+        Args:
+            trace (metrics.Trace): records the 'tts_wait', 'tts_cache' and 'tts_synth' spans, if given.
+        Returns:
+            bytes: The mp3 audio content, or None on error.
+        """
+        if self._is_error or not text:
+            return None
 
-                    # b. waiting for client to answer...
-                    # ~ note: timeout is set to 1.0 second for fast response. But there are 3 check tries if client delays...
-                    attempts = 0
+        future = self.prerendering.get(text) if wait_prerender else None
+        if future is not None:
+            print(f"'{text}' is being pre-rendered. Waiting for it...")
+            try:
+                with span(trace, "tts_wait"):
+                    future.result(timeout=self.PRERENDER_WAIT)
+            except Exception as e:
+                print(f"ERR waiting for the pre-render of '{text}' -> {e}")
 
-                    while attempts < 3:
-                        try:
-                            response = client.recv(1)  # Expecting 1 byte response
+        with span(trace, "tts_cache"):
+            audio_content = self._transmit_offline(text)
+        if audio_content is None:  # TODO: and if is_online...
+            # Generate new audio content using Google Cloud TTS
+            try:
+                with span(trace, "tts_synth"):
+                    audio_content = self.synthesis.run(self.cache.key(text), self._synthesize_new, text, save_it)
+
+            except Exception as e:
+                print(f"ERR while generating online GTTS respond: {e}")
+                print("Transmit to ESP32 terminated..")
+                return None
 
-                            # total_time = (time.time() - start_time) * 1000
-                            # operation_time = (time.time() - last_record) * 1000
-                            # last_record = time.time()
+        return audio_content
 
-                            if response[0] == 22:  # 1 byte with value of 22
+    def _synthesize_new(self, text, save_it=False):
+        """ Synthesize a not cached text (once for all the concurrent requests, see SynthesisCoordinator),
+            and cache it: in memory now, and to the disk in the background (the offline_audio/ if save_it).
+        """
+        audio_content = self.cache.get(text)
+        if audio_content is not None:
+            return audio_content  # ~ note: synthesized just before, by a request finished after the caller cache check.
+
+        synth_start = time.perf_counter()
+        audio_content = self._synthesize(text)
+        self.fillers.learn(text, time.perf_counter() - synth_start)
+        if self.PACK:
+            audio_content = self._pack(audio_content)
+
+        self.cache.put(text, audio_content, persist=False)
+        self._writer.submit(self._write_audio, text, audio_content, save_it and len(text) < 60)
+        return audio_content
+
+    def _pack(self, audio_content):
+        """ The packed mp3 (mp3pack.pack()): less bytes to send, and to write to the device SPIFFS. """
+        try:
+            packed = mp3pack.pack(audio_content)
+        except Exception as e:
+            print(f"ERR packing the mp3 -> {e}")
+            return audio_content
+        self.packing["count"] += 1
+        self.packing["bytes_in"] += packed.original_size
+        self.packing["bytes_out"] += len(packed.audio)
+        return packed.audio
+
+    def prepare_audio(self, text, save_it=False, trace=None):
+        """ get_audio() in the background -> a Future of the audio (its `started` is the perf_counter start time).
+            ~ note: the client starts it before draining the device audio stream, so the synthesis overlaps the drain.
+        """
+        future = self._synth.submit(self.get_audio, text, save_it, True, trace)
+        future.started = time.perf_counter()
+        return future
 
-                                # print(f"ESP32 ready to receive audio data. -> {total_time:.1f} | {operation_time:.2f} ms")
-                                print(f"ESP32 ready to receive audio data...")
+    def keep_legacy_names(self, texts):
+        """
+        The known responses (Decoder.known_responses()) keep their old device file name (Tools.legacy_device_filename()),
+        when no other known text has the same one: the files already in the SPIFFS of the devices are still used,
+        not sent again under the new name. The texts sharing an old name (ak. 'Yes.' and 'Yes?') get the new names.
+        """
+        if not self.LEGACY_NAMES:
+            return
+        owners = {}
+        for text in set(texts):
+            name = Tools.legacy_device_filename(text)
+            if name is not None:
+                owners.setdefault(name, []).append(text)
+        self._device_names = {found[0]: name for name, found in owners.items() if len(found) == 1}
+        print(f"Device file names: {len(self._device_names)} known responses keep their old name, "
+              f"{sum(len(found) for found in owners.values() if len(found) > 1)} renamed (shared old names).")
+
+    def device_filename(self, text):
+        """ The device file name of the response text: its old name (see keep_legacy_names()), else Tools.device_filename(). """
+        return self._device_names.get(text) or Tools.device_filename(text)
+
+    def filler_for(self, text, audio_future):
+        """ The filler file to call the device with, while the audio_future (prepare_audio()) is not ready, or None. """
+        if audio_future.done() or not text or text in self.cache:
+            return None
+        return self.fillers.choose(text, elapsed=time.perf_counter() - audio_future.started)
 
-                                # sand the audio data to the client:
-                                print(f"Streaming audio [{len(audio_content)} bytes] --TCP--> to ESP32...")
-                                client.sendall(audio_content)
+    def send_filler(self, client, filename, device=None, trace=None):
+        """ Call the device with a filler file, see handshake.send_filler() -> the earliest time of the next server-call. """
+        return handshake.run(handshake.send_filler(self, filename, device, trace), client)
 
-                                # At the end:
-                                print("Audio data sent successfully.")
-                                break
+    def _write_audio(self, text, audio_content, persist):
+        """ The disk part of a fresh audio (on the tts-writer thread): the offline_audio/ cache, or the speak.mp3 file. """
+        try:
+            if persist:
+                self.cache.put(text, audio_content, persist=True)
+            else:
+                # ~ note: if not saved, we replace the speak.mp3 file.
+                self._write_atomic(self.SPEAK_FILE, audio_content)
+        except Exception as e:
+            print(f"ERR writing the audio of '{text}' -> {e}")
 
-                            elif response[0] == 11:
-                                # print(f"ESP32 has the audio data pre-recorded. Do not send. -> {total_time:.5f} | {operation_time:.2f} ms")
-                                print(f"ESP32 has the audio data pre-recorded. Do not send.")
-                                break
-                            else:
-                                attempts += 1
-                                print(f"Unexpected response from ESP32, try more {2 - attempts} times.")
-                        except Exception as e:
-                            attempts += 1
-                            print(f"err or mo response from client. Try more {2 - attempts} times.")
-                            print(e)
+    @staticmethod
+    def _write_atomic(path, data):
+        """ Write to a unique temp file, then rename it to the path: the readers see the old or the new file, whole. """
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=".speak-", suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def send_audio(self, client, audio_content, path=None, trace=None, progress=None):
+        """ Send the mp3 data to the device, see handshake.send_audio() -> the bytes sent. """
+        return handshake.run(handshake.send_audio(self, audio_content, path, trace, progress), client)
+
+    def close(self):
+        """ Finish the background disk writes, and save the cache index. """
+        self._synth.shutdown(wait=True)
+        self._writer.shutdown(wait=True)
+        self.cache.flush()
+
+    def speak_transmit(self, text, client, save_it=False, device=None, trace=None, audio_future=None):
+        """
+        'Call' the ESP with the file name of the respond, and send it the mp3 data if it does not have it.
+        The v1 protocol steps are in handshake.transmit() (shared with the asyncio server).
 
-                except Exception as e:
-                    print(f"ERR while speak_transmit: {e}")
-                    return False
+        Args:
+            audio_future: the audio prepared in the background (prepare_audio()), or None -> get_audio() now.
+                    While it is not ready, a filler may be said first (see filler.FillerPolicy).
+            device: the device identity (ak. the client IP). When the manifest says the device has the file,
+                    the answer is not waited for: a PendingAnswer is returned, and the client loop
+                    must give the late answer to complete_pending().
+            trace (metrics.Trace): records the tts, 'handshake' and 'send' spans, if given.
+        Returns:
+            True if done, PendingAnswer if not waited for the answer, False / None on error.
+        """
+        if self._is_error or not text:
+            return None
+        return handshake.run(handshake.transmit(self, text, device, audio_future, save_it, trace), client)
 
-            else:
-                print("No audio content collected. Transmit terminated.")
+    def complete_pending(self, pending, answer, client):
+        """ The late answer to a not waited server-call (see speak_transmit()). """
+        return handshake.run(handshake.complete_pending(self, pending, answer), client)
 
 
 class Tools:
@@ -260,26 +380,31 @@ class Tools:
         return text2
 
     @staticmethod
-    def mp3name_to_bin(text):
-        """ Used to create a short .mp3 file name from raw text and encode it to BINARY data.
-            Decoding a frequently used speech responds,
-            to be recorded and use it locally (ak. 'yes', 'may I help you', etc.)
+    def device_filename(text):
+        """ The SPIFFS file name of a spoken respond, on the ESP32 (max 29 chars, including the '/' and '.mp3').
+
+            A readable part (letters and numbers, max 15 chars) + 8 hex chars of the text hash,
+            so different texts (ak. 'Yes.' and 'Yes?') never share the same file on the device.
+            ~ note: texts with numbers are non frequent responds (ak. 'temperature is 32 degrees'),
+                    so the default '/mp3respond.mp3' is returned, which the ESP32 never keeps.
         """
         # 1. strip to only letters and numbers
         text_strip = re.sub(r'[^a-zA-Z0-9]', '', text)
 
-        # 2. If length > 26 or any number is present, return default 'mp3respond.mp3'
-        # ~ note: numbers means this is non frequent used respond (ak. 'temperature is 32 degrees')
-        if len(text_strip) > 24 or any(char.isdigit() for char in text_strip):
-            print("Text has more than 24 chars or has a number. 'mp3respond.mp3' returned instead.")
-            filename = "/mp3respond.mp3"
-        else:
-            filename = f"/{text_strip.lower()}.mp3"
-
-        # 3. Encode to binary data of  bytes fixed lenght. Fill the empty with zeroes.
-        binary_data = filename.encode('utf-8')  # Convert text to bytes
-        return binary_data.ljust(29, b'\x00')  # Pad with zeroes to make it 29 bytes
-
-
+        # 2. If any number is present, return default 'mp3respond.mp3'
+        if not text_strip or any(char.isdigit() for char in text_strip):
+            return "/mp3respond.mp3"
 
+        text_hash = hashlib.sha256(text.encode('utf-8')).hexdigest()[:8]
+        return f"/{text_strip[:15].lower()}_{text_hash}.mp3"
 
+    @staticmethod
+    def legacy_device_filename(text):
+        """ The SPIFFS file name given by the servers before device_filename(), or None (the '/mp3respond.mp3').
+            Only the letters and numbers, lower case: different texts (ak. 'Yes.' and 'Yes?') shared the same file.
+            ~ note: the devices updated from those servers still have these files. See Speach.keep_legacy_names()
+        """
+        text_strip = re.sub(r'[^a-zA-Z0-9]', '', text)
+        if not text_strip or len(text_strip) > 24 or any(char.isdigit() for char in text_strip):
+            return None
+        return f"/{text_strip.lower()}.mp3"
@@ -0,0 +1,191 @@
+"""
+Local stand-ins for the voice engines (the pvRhino handle and the Google TTS), and for the home devices.
+Used by the benchmarks, to run the servers without the Picovoice model, the API keys, the network and the devices.
+"""
+import time
+from functools import partial
+
+import numpy as np
+
+from engines import EnginePool
+from intents import IntentRegistry
+from recognizer import Recognizer, Decoder
+from speaker import Speach
+from tts_cache import ResponseCache
+from device_manifest import DeviceManifest
+from wakeword import WakeWordScheduler
+
+
+class StubRhino:
+    """
+    Deterministic stand-in for the pvrhino handle (same frame_length / process() / get_inference() interface).
+    Finalizes after `endpoint_frames` quiet frames following the speech,
+    and the command is 'understood' when it had at least `min_speech_frames` loud frames.
+    """
+    frame_length = 512
+
+    def __init__(self, speech_threshold=1000, endpoint_frames=25, min_speech_frames=5, frame_cost=0.0):
+        self.speech_threshold = speech_threshold
+        self.endpoint_frames = endpoint_frames      # 25 frames x 0.032 sec = 0.8 sec, the Recognizer endpoint_duration_sec.
+        self.min_speech_frames = min_speech_frames
+        self.frame_cost = frame_cost                # simulated CPU time per frame (seconds).
+        self.reset()
+
+    def reset(self):
+        self._speech_frames = 0
+        self._quiet_frames = 0
+        self._understood = False
+
+    def process(self, pcm):
+        if len(pcm) != self.frame_length:
+            raise ValueError(f"Invalid frame length. expected {self.frame_length} but received {len(pcm)}")
+
+        if self.frame_cost:
+            end = time.perf_counter() + self.frame_cost
+            while time.perf_counter() < end:
+                pass
+
+        if np.abs(np.asarray(pcm, dtype=np.int32)).max() > self.speech_threshold:
+            self._speech_frames += 1
+            self._quiet_frames = 0
+            return False
+
+        if self._speech_frames:
+            self._quiet_frames += 1
+            if self._quiet_frames >= self.endpoint_frames:
+                self._understood = self._speech_frames >= self.min_speech_frames
+                self._speech_frames = 0
+                self._quiet_frames = 0
+                return True
+        return False
+
+    def get_inference(self):
+        understood = self._understood
+        self._understood = False
+        return StubInference(understood)
+
+    def delete(self):
+        ...
+
+
+class StubWakeWord:
+    """
+    Deterministic stand-in for the pvporcupine handle (same frame_length / process() / delete() interface).
+    'Detects' the wake word (keyword 0) on a loud burst of `min_frames` - `max_frames` frames, ended by a quiet frame:
+    a short word said before a pause. Longer loud sounds (talking, music) are not a wake word.
+    """
+    frame_length = 512
+
+    def __init__(self, speech_threshold=1000, min_frames=5, max_frames=30, frame_cost=0.0):
+        self.speech_threshold = speech_threshold
+        self.min_frames = min_frames    # 5 frames x 0.032 sec = 0.16 sec
+        self.max_frames = max_frames
+        self.frame_cost = frame_cost    # simulated CPU time per frame (seconds).
+        self._loud_frames = 0
+
+    def process(self, pcm):
+        if len(pcm) != self.frame_length:
+            raise ValueError(f"Invalid frame length. expected {self.frame_length} but received {len(pcm)}")
+
+        if self.frame_cost:
+            end = time.perf_counter() + self.frame_cost
+            while time.perf_counter() < end:
+                pass
+
+        if np.abs(np.frombuffer(pcm, dtype=np.int16).astype(np.int32)).max() > self.speech_threshold:
+            self._loud_frames += 1
+            return -1
+        loud_frames, self._loud_frames = self._loud_frames, 0
+        return 0 if self.min_frames <= loud_frames <= self.max_frames else -1
+
+    def delete(self):
+        ...
+
+
+class StubInference:
+    def __init__(self, is_understood):
+        self.is_understood = is_understood
+        self.intent = "changeLightState" if is_understood else None
+        self.slots = {"location": "kitchen", "state": "on"} if is_understood else {}
+
+
+class StubRecognizer(Recognizer):
+    """ The real Recognizer pipeline, running on the StubRhino. """
+    def __init__(self, rhino=None):
+        self.rhino = rhino or StubRhino()
+        self._init_buffers()
+        self.start_stream()
+
+
+class StubSpeaker(Speach):
+    """ The real Speach, with the Google TTS synthesis replaced by a fixed delay and a fake mp3 payload. """
+    def __init__(self, synth_delay=0.2, audio_size=8000, cache=None, manifest=None):
+        self.synth_delay = synth_delay
+        self.audio_size = audio_size
+        self.synth_count = 0
+        super().__init__(cache=cache or ResponseCache(directory=None), manifest=manifest or DeviceManifest(path=None))
+        # ~ note: memory only cache and manifest by default, the tts/ files are not touched.
+
+    def _init_client(self):
+        self._is_error = False
+
+    def _synthesize(self, text):
+        self.synth_count += 1
+        time.sleep(self.synth_delay)
+        payload = text.encode('utf-8')
+        return (b'\xff\xf3' + payload * (self.audio_size // max(len(payload), 1) + 1))[:self.audio_size]
+
+
+class FakeLights:
+    """ Stand-in for the light switches: each switch takes `delay` seconds, and fails if `fail` is set. """
+    LOCATIONS = ("kitchen", "bedroom", "living room", "bathroom")
+
+    def __init__(self, delay=0.0, fail=False):
+        self.delay = delay
+        self.fail = fail
+        self.state = {location: False for location in self.LOCATIONS}
+        self.calls = 0
+
+    def change_light_state(self, slots):
+        self.calls += 1
+        time.sleep(self.delay)
+        if self.fail:
+            raise ConnectionError("the light switch does not answer")
+        location = slots["location"]
+        self.state[location] = slots["state"] == "on"
+        return self.state[location]
+
+
+def stub_intents(lights=None):
+    """ IntentRegistry with the changeLightState intent (the StubRhino result) on the fake lights. """
+    lights = lights or FakeLights()
+    registry = IntentRegistry()
+    registry.register("changeLightState", action=lights.change_light_state,
+                      slots={"location": FakeLights.LOCATIONS, "state": ("on", "off")}, required=("state",),
+                      defaults={"location": "kitchen"}, response="Turning the {location} light {state}.")
+    registry.lights = lights
+    return registry
+
+
+def stub_recognizer(frame_cost=0.0):
+    """ A StubRecognizer, with a simulated CPU time per frame (seconds). """
+    return StubRecognizer(rhino=StubRhino(frame_cost=frame_cost))
+
+
+def create_stub_pool(size=None, synth_delay=0.2, frame_cost=0.0, processes=False, lights=None):
+    """ EnginePool for the servers, using the stand-ins.
+        processes=True -> the recognizers run in worker processes (see recognition_workers.py).
+        lights: a FakeLights -> the changeLightState intent switches it (see stub_intents()).
+    """
+    speaker_factory = lambda: StubSpeaker(synth_delay=synth_delay)
+    wakeword_factory = lambda: WakeWordScheduler(detector_factory=StubWakeWord)
+    decoder_factory = (lambda: Decoder(stub_intents(lights))) if lights is not None else Decoder
+    if processes:
+        from recognition_workers import create_process_pool
+        return create_process_pool(workers=size, recognizer_factory=partial(stub_recognizer, frame_cost),
+                                   speaker_factory=speaker_factory, decoder_factory=decoder_factory,
+                                   wakeword_factory=wakeword_factory)
+    return EnginePool(size=size,
+                      recognizer_factory=partial(stub_recognizer, frame_cost),
+                      speaker_factory=speaker_factory, decoder_factory=decoder_factory,
+                      wakeword_factory=wakeword_factory)
@@ -0,0 +1,78 @@
+import threading
+import time
+from concurrent.futures import Future
+
+
+class SynthesisCoordinator:
+    """
+    Server-wide single-flight of the TTS syntheses, with a bounded concurrency.
+
+    - The requests of the same key (the cache key: the text and the voice configuration) while its synthesis
+      is in flight, join it: one TTS call, the same audio for all.
+    - Max MAX_CONCURRENT TTS calls at once. The other requests wait for a free place (backpressure on a burst),
+      max QUEUE_TIMEOUT seconds, then fail (the response is not spoken, instead of piling up the TTS calls).
+
+        audio_content = coordinator.run(cache.key(text), synthesize, text)
+    """
+    MAX_CONCURRENT = 4      # TTS calls at once
+    QUEUE_TIMEOUT = 10.0    # seconds to wait for a free TTS call place
+
+    def __init__(self, max_concurrent=None, queue_timeout=None):
+        self.max_concurrent = max_concurrent or SynthesisCoordinator.MAX_CONCURRENT
+        self.queue_timeout = SynthesisCoordinator.QUEUE_TIMEOUT if queue_timeout is None else queue_timeout
+        self._slots = threading.BoundedSemaphore(self.max_concurrent)
+        self._lock = threading.Lock()
+        self._inflight = {}     # key -> Future
+        self.stats = {"calls": 0, "joined": 0, "queued": 0, "rejected": 0, "errors": 0}
+
+    def run(self, key, synthesize, *args):
+        """
+        synthesize(*args) -> the audio, once for all the concurrent requests of the key.
+        Raises:
+            TimeoutError: no free TTS call place in QUEUE_TIMEOUT seconds.
+            the synthesize() exceptions (to all the joined requests).
+        """
+        with self._lock:
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self._inflight[key] = Future()
+            else:
+                self.stats["joined"] += 1
+
+        if not leader:
+            print("Synthesis of the same text in flight. Joining it...")
+            return future.result()
+
+        try:
+            if not self._slots.acquire(blocking=False):
+                self._count("queued")
+                start = time.perf_counter()
+                if not self._slots.acquire(timeout=self.queue_timeout):
+                    self._count("rejected")
+                    raise TimeoutError(f"No free TTS call in {self.queue_timeout} sec "
+                                       f"({self.max_concurrent} running).")
+                print(f"TTS call queued for {(time.perf_counter() - start) * 1000:.0f} ms.")
+            try:
+                self._count("calls")
+                audio_content = synthesize(*args)
+            finally:
+                self._slots.release()
+        except BaseException as e:
+            self._count("errors")
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(audio_content)
+            return audio_content
+        finally:
+            with self._lock:
+                del self._inflight[key]
+
+    def _count(self, key):
+        with self._lock:
+            self.stats[key] += 1
+
+    def inflight(self):
+        with self._lock:
+            return len(self._inflight)
@@ -4,11 +4,21 @@ import time
 import errno
 import struct
 
-from recognizer import Recognizer, Decoder
-from speaker import Speach
+import protocol
+import handshake
+from metrics import METRICS, span
+from recorder import RECORDER
+from device_manifest import PendingAnswer
 
 
 class Client(threading.Thread):
+    STREAMING = True        # decode the audio with pvRhino on real time, while it is still being received.
+    VAD = True              # end the recording on the server-side voice activity end-of-speech, and trim the leading silence.
+    VAD_LOG_FILE = None     # ak. "vad_decisions.csv" -> append the VAD decisions of every utterance, for tuning.
+    DRAIN_TIMEOUT = 0.15    # after an early stop, wait this long for the rest of the client audio stream to end (seconds).
+    # ~ note: the ESP keeps sending audio until its own silence_timeout, and it does not read while recording.
+    #         So the remaining audio must be consumed before the 'server-call', or it will be read as the 11/22 answer.
+
     def __init__(self, client_socket, address, server):
         super().__init__(daemon=True)
         # ~ note: daemon=True make thread running in a background,
@@ -20,14 +30,12 @@ class Client(threading.Thread):
         self.server = server
         self.running = True
 
-        try:
-            self.recognizer = Recognizer()
-            self.decoder = Decoder()
-            self.speaker = Speach()
-
-        except Exception as e:
-            print(f"ERR initializing the voice recognition -> {e}")
-            self.recognizer = None
+        self.engines = server.engines
+        # ~ note: the voice engines (recognizer, decoder, speaker) are shared by all the clients. See engines.EnginePool
+        from vad import VoiceActivityDetector  # ~ note: numpy, imported by the first client, not on the server start.
+        self.vad = VoiceActivityDetector() if self.VAD else None
+        self.device = address[0]  # ~ note: the device identity of the v1 protocol is its IP address.
+        self._pending = None      # a server-call sent without waiting for the answer. See Speach.speak_transmit()
 
     def run(self):
         """Main class loop, to handle client communication"""
@@ -50,58 +58,37 @@ class Client(threading.Thread):
                     # data is empty or empty byte string received for client disconnected signal
                     print(f"Client {self.address} has disconnected.")
                     break
+                self.server.clients.touch(self)
 
                 # elif len(data) == 1:  # check if exactly 1 byte is available, which means it is a wake-up-call and nothing else. Not used.
 
                 # 1 byte 'hand-shake' message: 'wake-up' call from the client [101] or 'ready' answer from the client [202]
-                if data[0] == 101:
+                if data[0] in (11, 22) and self._pending is not None:
+                    # the late answer to a server-call, not waited for (the device manifest says it has the file).
+                    pending, self._pending = self._pending, None
+                    if not pending.expired:
+                        self.engines.speaker.complete_pending(pending, data[0], self.client_socket)
+
+                elif data[0] == 101:
                     # wake-up-call received from the client: 'Client has an audio data to send'
                     # 1. Answer back with [202], meaning 'I am ready'
+                    self._pending = None
+                    if not self.engines.ready.is_set():
+                        # the engines are still warming up (see EnginePool.start()): a 'connecting' reply.
+                        self.client_socket.send(bytes([202]))
+                        self._reply_starting()
+                        continue
+
+                    trace = METRICS.new_trace(self.device)  # ~ note: the command spans, see metrics.py
                     self.client_socket.send(bytes([202]))
                     print("Ready signal sent. The client should start sending audio data")
 
-                    # Prepare audio recording.
-                    audio_data = bytearray()
-                    audio_chunk_size = 512
-                    # ~ note: chunk size must match the client (sender) audio buffer size, and the pvrhino frame_length.
-
-                    print("Start recording...")
-                    while self.running:
-                        try:
-                            chunk = self.client_socket.recv(audio_chunk_size)
-                            if chunk == b'':
-                                print("Connection closed unexpectedly")
-                                break
-                            else:
-                                audio_data.extend(chunk)
-                                # TODO: decode the chunk with pvrhino on real time.
-
-                        except socket.timeout:
-                            print("The client audio transmission ended.")
-                            break
-
-                        except Exception as e:
-                            print(f"[ERR] while audio_data receive: {e}")
-                            break
-
-                    # recording ready. check and process...
-                    if audio_data:
-                        print(f"Data Ready, [{len(audio_data)} bytes]. PROCESSING...")
-                        if self.recognizer:
-                            result = self.recognizer.process_audio_data(audio_data)
-                            decoder_respond = self.decoder.decode_rhino(pvRhino_result=result)
-                            # --> speak back the respond
-                            # Using the Speach.speak_transmit() method, which is designed to 'cal' the ESP, convert the text to audio and send the mp3 data to esp.
-                            result = self.speaker.speak_transmit(text=decoder_respond,
-                                                                 client=self.client_socket)
-                            print(result)
-
-                        else:
-                            print("ERR: in audio processing -> recognizer not initialized. Breaking...")
-                            break
+                    self._handle_command(trace)
 
-                    else:
-                        print("ERR: audio_data is empty!")
+                elif data[0] == protocol.MAGIC:
+                    # a framed protocol v2 client (see protocol.py). The rest of the connection is served by _run_v2().
+                    self._run_v2()
+                    break
 
             except socket.error as e:
                 if e.errno == errno.ETIMEDOUT:  # [Errno 110] Connection timed out
@@ -112,11 +99,209 @@ class Client(threading.Thread):
                     break
 
             except Exception as e:
+                if not self.running:
+                    break  # ~ note: the socket was closed by stop() (ak. a replaced client).
                 print(f"ERR in client_socket.recv() for client {self.address} -> {e}")
                 print("Continue... ")
 
         self.stop()
 
+    def _handle_command(self, trace=None):
+        """ Receive the audio data, recognize it (with a recognizer leased from the server EnginePool), and answer back. """
+        utterance = self.engines.utterances.begin(self.device)  # ~ note: the same command heard by other devices? see arbiter.py
+        try:
+            with span(trace, "lease"):
+                recognizer = self.engines.acquire()
+        except Exception as e:
+            self.engines.utterances.cancel(utterance)
+            print(f"ERR: in audio processing -> no recognizer available ({e}). Dropping the audio...")
+            self._reply_busy(trace)
+            return
+
+        try:
+            capture = self.engines.captures.acquire()
+        except Exception as e:
+            self.engines.utterances.cancel(utterance)
+            self.engines.release(recognizer)
+            print(f"ERR: in audio processing -> no capture buffer available ({e}). Dropping the audio...")
+            self._reply_busy(trace)
+            return
+
+        if RECORDER.enabled:
+            capture.keep_raw()
+        try:
+            result, audio_size, stopped_early = self._record(recognizer, capture, trace)
+            recording = RECORDER.take(capture)  # ~ note: None, if not recording (see recorder.py)
+        except Exception:
+            self.engines.utterances.cancel(utterance)
+            raise
+        finally:
+            self.engines.captures.release(capture)
+            self.engines.release(recognizer)
+
+        if not audio_size:
+            self.engines.utterances.cancel(utterance)
+            print("ERR: audio_data is empty!")
+            return
+
+        if not self.engines.utterances.end(utterance, self.vad.snr() if self.vad else None, result):
+            # the same command, heard better by another device: only a short acknowledgement, no action.
+            if stopped_early:
+                self._drain_audio()
+            self.engines.speaker.send_filler(self.client_socket, self.engines.utterances.ACK_FILE, self.device, trace)
+            if trace is not None:
+                trace.finish()
+            return
+
+        with span(trace, "decode"):
+            decoder_respond = self.engines.decoder.decode_rhino(pvRhino_result=result, device=self.device)
+
+        # The audio (cached or synthesized) is prepared while the rest of the client stream is drained.
+        audio_future = self.engines.speaker.prepare_audio(decoder_respond, trace=trace)
+        if stopped_early:
+            with span(trace, "drain"):
+                self._drain_audio()
+
+        # --> speak back the respond
+        # Using the Speach.speak_transmit() method, which is designed to 'cal' the ESP, convert the text to audio and send the mp3 data to esp.
+        answer = self.engines.speaker.speak_transmit(text=decoder_respond, client=self.client_socket, device=self.device,
+                                                     trace=trace, audio_future=audio_future)
+        if isinstance(answer, PendingAnswer):
+            self._pending = answer
+        print(answer)
+        if trace is not None:
+            trace.finish()
+        RECORDER.record(self.device, recording, result, decoder_respond, trace)
+
+    def _record(self, recognizer, capture, trace=None):
+        """
+        Receive the client audio data into the capture buffer, decoding it on real time if STREAMING.
+        The recording stops when the client stops sending, or earlier: on Rhino finalized, on the VAD end-of-speech,
+        or when the capture buffer is full (the max utterance length).
+
+        Returns:
+            tuple: (pvRhino result, received audio size in bytes, True if stopped before the client audio end)
+        """
+        # Prepare audio recording.
+        audio_chunk_size = 512
+        # ~ note: chunk size must match the client (sender) audio buffer size.
+
+        streaming = self.STREAMING
+        if streaming:
+            recognizer.start_stream()
+        if self.vad:
+            self.vad.reset()
+        stopped_early = False
+
+        print("Start recording...")
+        receive_start = time.perf_counter()
+        while self.running:
+            try:
+                if not capture.recv_into(self.client_socket, audio_chunk_size):
+                    if capture.full:
+                        print(f"Max utterance length reached [{capture.size} bytes]. Stop recording.")
+                        stopped_early = True  # ~ note: the rest of the audio is drained.
+                    else:
+                        print("Connection closed unexpectedly")
+                    break
+
+                chunk = capture.last  # ~ note: a view of the capture buffer, no copy.
+                if self.vad:
+                    chunk = self.vad.process(chunk)  # ~ note: empty during the leading silence.
+                chunk = capture.commit(chunk)
+
+                if streaming and chunk and recognizer.process_chunk(chunk):
+                    print("Rhino finalized while receiving. Stop recording.")
+                    stopped_early = True
+                    break
+                if self.vad and self.vad.ended:
+                    print("End of speech detected (VAD). Stop recording.")
+                    stopped_early = True
+                    break
+
+            except socket.timeout:
+                print("The client audio transmission ended.")
+                break
+
+            except Exception as e:
+                print(f"[ERR] while audio_data receive: {e}")
+                break
+
+        if trace is not None:
+            trace.add("receive", time.perf_counter() - receive_start)
+
+        if self.vad and self.VAD_LOG_FILE:
+            self.vad.dump_csv(self.VAD_LOG_FILE, label=f"{self.address[0]}@{time.strftime('%Y-%m-%d %H:%M:%S')}")
+
+        # recording ready. check and process...
+        if not capture.received:
+            return None, 0, False
+
+        print(f"Data Ready, [{capture.length} of {capture.received} bytes]. PROCESSING...")
+        if streaming:
+            with span(trace, "finish"):
+                result = recognizer.finish_stream()
+            if trace is not None:
+                trace.add("rhino", recognizer.stream_rhino_time)
+        else:
+            result = recognizer.process_audio_data(capture.audio, trace=trace)
+
+        return result, capture.received, stopped_early
+
+    def _run_v2(self):
+        """ Negotiate the framed protocol version, then serve the v2 frames until the client disconnects. """
+        session = None
+        try:
+            version = self.client_socket.recv(1)
+            if not version:
+                return
+            used = protocol.negotiate(version[0])
+            self.client_socket.sendall(bytes([protocol.MAGIC, used]))
+            print(f"Client {self.address} uses the framed protocol v{used}.")
+
+            session = protocol.V2Session(self.engines, self.client_socket.sendall, self.device,
+                                         vad=self.vad, streaming=self.STREAMING,
+                                         on_hello=lambda device: self.server.identify(self, device))
+            while self.running:
+                try:
+                    data = self.client_socket.recv(4096)
+                except socket.timeout:
+                    continue  # ~ note: no timeouts in v2, the frames tell where the messages end.
+                if not data:
+                    print(f"Client {self.address} has disconnected.")
+                    break
+                self.server.clients.touch(self)
+                session.on_data(data)
+
+        except protocol.ProtocolError as e:
+            print(f"ERR: protocol error from client {self.address} -> {e}. Closing the connection.")
+            try:
+                self.client_socket.sendall(protocol.encode_frame(protocol.ERROR, str(e).encode('utf-8')))
+            except OSError:
+                pass
+        except Exception as e:
+            if self.running:  # ~ note: not an error, if the socket was closed by stop().
+                print(f"ERR in the v2 session of client {self.address} -> {e}")
+        finally:
+            if session is not None:
+                session.close()
+
+    def _reply_starting(self):
+        """ The command received before the engines are ready: the 'connecting' call (see handshake.starting_reply()). """
+        handshake.run(handshake.starting_reply(self.engines), self.client_socket)
+
+    def _reply_busy(self, trace=None):
+        """ The command could not be processed: the BUSY response (see handshake.busy_reply()). """
+        answer = handshake.run(handshake.busy_reply(self.engines, self.device, trace), self.client_socket)
+        if isinstance(answer, PendingAnswer):
+            self._pending = answer
+        if trace is not None:
+            trace.finish()
+
+    def _drain_audio(self, first_timeout=None):
+        """ Consume (and drop) the rest of the audio stream, after the recording was stopped early. See handshake.drain() """
+        handshake.run(handshake.drain(first_timeout, self.DRAIN_TIMEOUT), self.client_socket)
+
     @staticmethod
     def print_last_audio_samples(data):
         """ Printing the last ~ half second of audio data. """
@@ -131,6 +316,11 @@ class Client(threading.Thread):
     def stop(self):
         """Stops the client thread and removes it from server list"""
         self.running = False
+        try:
+            self.client_socket.shutdown(socket.SHUT_RDWR)  # ~ note: wakes up the client thread blocked in recv().
+        except OSError:
+            pass
         self.client_socket.close()
-        self.server.clients.remove(self)
-        print(f"[-] Client {self.address} disconnected | Client thread stopped.")
+        if self.server.remove_client(self):
+            # ~ note: stop() runs twice for a closed client (by the server, then at the client thread end).
+            print(f"[-] Client {self.address} disconnected | Client thread stopped.")
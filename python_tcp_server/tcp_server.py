@@ -2,19 +2,28 @@ import socket
 import threading
 
 from tcp_client import Client
+from engines import EnginePool
+from connections import ConnectionRegistry
 
 class TCPServer(threading.Thread):
     HOST = "172.16.1.160"  # Your Raspberry Pi's IP address
     PORT = 5000  # TCP Port
     MAX_CLIENTS = 10
+    LISTEN_BACKLOG = 32  # connections waiting for accept() (ak. all the intercoms reconnecting after a WiFi blip)
 
-    def __init__(self):
+    def __init__(self, host=None, port=None, engines=None, connections=None):
         super().__init__()
 
-        self.host = TCPServer.HOST
-        self.port = TCPServer.PORT
+        self.host = host or TCPServer.HOST
+        self.port = port or TCPServer.PORT
+        self.engines = engines or EnginePool()
+        # ~ note: the voice engines are shared by all the clients, and leased per utterance.
 
-        self.clients = []  # Store client threads
+        if connections is None:
+            connections = ConnectionRegistry(max_clients=self.MAX_CLIENTS, backlog=self.engines.backlog)
+        self.clients = connections
+        self.engines.captures.reserve(min(self.engines.size, connections.max_clients))
+        # ~ note: the client threads, by address and device id, with the admission control. See connections.py
         self.running = True
 
     def run(self):
@@ -26,7 +35,7 @@ class TCPServer(threading.Thread):
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server_socket:
             server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             server_socket.bind((self.host, self.port))
-            server_socket.listen(5)  # <- will handle up to 5 clients.
+            server_socket.listen(self.LISTEN_BACKLOG)  # ~ note: the max clients is ConnectionRegistry.max_clients
 
             # Enable TCP Keepalive
             server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)  # <- add a keepalive option to check for dead clients...
@@ -43,6 +52,7 @@ class TCPServer(threading.Thread):
             """
 
             print(f"Server running on {self.host}:{self.port}")
+            self.engines.start()  # ~ note: in the background: the engines warm-up (if not ready), the pre-render.
 
             while self.running:
                 try:
@@ -57,23 +67,40 @@ class TCPServer(threading.Thread):
                     print(f"New connection from {address}")
 
                     client = Client(client_socket, address, self)
+                    refused, to_close = self.clients.admit(client)
+                    self._close_clients(to_close, "replaced")
+                    if refused:
+                        print(f"Connection from {address} refused: {refused}.")
+                        client_socket.close()
+                        continue
                     client.start()
-                    self.clients.append(client)
 
                     print(f"Total connections: {len(self.clients)}")
 
                 except socket.timeout:
                     pass  # Allow loop to continue checking running state
+                finally:
+                    self._close_clients(self.clients.sweep(), "idle")
 
+        self.engines.close()
         print("Server SHUTDOWN successful!")
 
     def remove_client(self, client):
-        """ Removes a client from the active list
+        """ Removes a client from the active list -> True if it was there.
             ~ note: this removes the instance of the client.
             The method is called by the client itself, on client.stop().
         """
-        if client in self.clients:
-            self.clients.remove(client)
+        return self.clients.remove(client)
+
+    def identify(self, client, device):
+        """ A client told its device id (the v2 HELLO): an older session of the same device is closed. """
+        self._close_clients(self.clients.identify(client, device), "replaced")
+
+    @staticmethod
+    def _close_clients(clients, reason):
+        for client in clients:
+            print(f"Closing client {client.address} ({reason}).")
+            client.stop()
 
     def stop(self):
         """Stop the server and disconnect clients"""
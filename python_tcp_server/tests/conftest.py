@@ -0,0 +1,5 @@
+import os
+import sys
+
+# ~ note: the server modules are flat (run from the python_tcp_server/ directory), not a package.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
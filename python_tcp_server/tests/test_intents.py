@@ -0,0 +1,85 @@
+import threading
+
+from intents import IntentRegistry
+from recognizer import Decoder
+
+
+class FakeLights:
+    """ A fake device handler: records the calls, optionally slow. """
+    def __init__(self, delay=None):
+        self.calls = []
+        self.release = threading.Event()
+        self.delay = delay
+
+    def set(self, slots):
+        if self.delay is not None:
+            self.release.wait(self.delay)
+        self.calls.append((slots["location"], slots["state"]))
+        return "done"
+
+
+def make_registry(lights, **kwargs):
+    registry = IntentRegistry(**kwargs)
+    registry.register("changeLightState", action=lights.set, response="Turning the {location} light {state}.",
+                      slots={"location": ("kitchen", "bedroom"), "state": ("on", "off")},
+                      required=("state",), defaults={"location": "kitchen"})
+    return registry
+
+
+def test_dispatch_runs_the_action():
+    lights = FakeLights()
+    registry = make_registry(lights)
+    results = []
+    done = threading.Event()
+    registry.add_callback(lambda result: (results.append(result), done.set()))
+
+    assert registry.dispatch("changeLightState", {"state": "on"}, device="10.0.0.2") == "Turning the kitchen light on."
+    assert done.wait(2)
+    assert lights.calls == [("kitchen", "on")]
+    assert results[0].status == "ok" and results[0].value == "done" and results[0].device == "10.0.0.2"
+    registry.close()
+
+
+def test_response_does_not_wait_for_a_slow_handler():
+    lights = FakeLights(delay=5)
+    registry = make_registry(lights)
+    assert registry.dispatch("changeLightState", {"location": "bedroom", "state": "off"}) == \
+        "Turning the bedroom light off."
+    assert lights.calls == []   # ~ note: still running on the executor.
+    lights.release.set()
+    registry.close()
+    assert lights.calls == [("bedroom", "off")]
+
+
+def test_invalid_slots():
+    lights = FakeLights()
+    registry = make_registry(lights)
+    assert registry.dispatch("changeLightState", {"state": "dim"}) == IntentRegistry.INVALID
+    assert registry.dispatch("changeLightState", {"location": "garage"}) == IntentRegistry.INVALID
+    registry.close()
+    assert lights.calls == [] and registry.stats["invalid"] == 2
+
+
+def test_timeout_and_rejected():
+    lights = FakeLights(delay=5)
+    registry = make_registry(lights, workers=1, max_pending=1)
+    registry.register("slow", action=lambda slots: lights.release.wait(5), response="Slow.", timeout=0.05)
+    results = []
+    timed_out = threading.Event()
+    registry.add_callback(lambda result: (results.append(result.status), result.status == "timeout" and timed_out.set()))
+
+    assert registry.dispatch("slow", {}) == "Slow."
+    assert registry.dispatch("changeLightState", {"state": "on"}) == IntentRegistry.BUSY
+    assert timed_out.wait(2)
+    lights.release.set()
+    registry.close()
+    assert results[:2] == ["rejected", "timeout"]
+
+
+def test_unknown_intent_fallback():
+    registry = make_registry(FakeLights())
+    assert registry.dispatch("orderPizza", {}) is None
+    decoder = Decoder(intents=registry)
+    assert decoder.decode_rhino(("orderPizza", {}), run_actions=False) == Decoder.UNDERSTOOD
+    assert decoder.decode_rhino(None) == Decoder.NOT_UNDERSTOOD
+    registry.close()
@@ -0,0 +1,62 @@
+import threading
+
+from prerender import Prerenderer
+from stubs import StubSpeaker
+
+
+class FailingSpeaker(StubSpeaker):
+    """ The stub TTS backend, failing for some texts. """
+    def __init__(self, fail=(), **kwargs):
+        self.fail = set(fail)
+        super().__init__(**kwargs)
+
+    def _synthesize(self, text):
+        if text in self.fail:
+            raise ConnectionError("TTS not reachable")
+        return super()._synthesize(text)
+
+
+def test_report_cached_rendered_failed():
+    speaker = FailingSpeaker(fail={"Door locked."}, synth_delay=0.01)
+    speaker.cache.put("Hello.", b"\xff\xf3cached")
+    prerenderer = Prerenderer(speaker, ["Hello.", "Lights on.", "Lights off.", "Door locked.", "Lights on."])
+    assert prerenderer.texts == ["Hello.", "Lights on.", "Lights off.", "Door locked."]
+
+    prerenderer.start()
+    assert prerenderer.wait(5)
+    assert prerenderer.cached == ["Hello."]
+    assert sorted(prerenderer.rendered) == ["Lights off.", "Lights on."]
+    assert prerenderer.failed == ["Door locked."]
+    assert prerenderer.coverage() == 0.75
+    assert speaker.synth_count == 2
+    report = prerenderer.report()
+    assert report.startswith("Pre-render: 75% of 4 known responses ready (1 cached, 2 rendered, 1 failed)")
+    assert "  missing: 'Door locked.'" in report
+    assert not speaker.prerendering
+
+
+def test_all_cached():
+    speaker = StubSpeaker(synth_delay=0.01)
+    speaker.cache.put("Hello.", b"\xff\xf3cached")
+    prerenderer = Prerenderer(speaker, ["Hello."])
+    prerenderer.start()
+    assert prerenderer.done.is_set() and prerenderer.coverage() == 1.0
+    assert speaker.synth_count == 0
+
+
+def test_live_request_waits_for_the_prerender():
+    speaker = StubSpeaker(synth_delay=0.3)
+    prerenderer = Prerenderer(speaker, ["Turning the kitchen light on."], workers=1)
+    prerenderer.start()
+    assert "Turning the kitchen light on." in speaker.prerendering
+
+    # a live command, while the text is being pre-rendered: no second synthesis.
+    results = []
+    live = threading.Thread(target=lambda: results.append(speaker.get_audio("Turning the kitchen light on.")))
+    live.start()
+    live.join(5)
+    assert prerenderer.wait(5)
+    assert results[0] and results[0] == speaker.cache.get("Turning the kitchen light on.")
+    assert speaker.synth_count == 1
+    assert speaker.synthesis.stats["calls"] == 1
+    assert speaker.synthesis.stats["joined"] == 0  # ~ note: waited on speaker.prerendering, not on the TTS call.
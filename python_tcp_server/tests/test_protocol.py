@@ -0,0 +1,91 @@
+import pytest
+
+import protocol
+from protocol import FrameParser, ProtocolError, encode_frame
+from stubs import StubSpeaker
+
+
+def test_partial_frames():
+    frame = encode_frame(protocol.AUDIO, b"\x01\x02" * 100)
+    parser = FrameParser()
+    assert parser.feed(frame[:3]) == []         # a part of the header
+    assert parser.feed(frame[3:50]) == []       # the header, a part of the payload
+    assert parser.pending_bytes == 50
+    assert parser.feed(frame[50:]) == [(protocol.AUDIO, b"\x01\x02" * 100)]
+    assert parser.pending_bytes == 0
+
+
+def test_byte_by_byte():
+    frame = encode_frame(protocol.HELLO, b"kitchen")
+    parser = FrameParser()
+    frames = []
+    for i in range(len(frame)):
+        frames += parser.feed(frame[i:i + 1])
+    assert frames == [(protocol.HELLO, b"kitchen")]
+
+
+def test_several_frames_in_one_read():
+    data = (encode_frame(protocol.WAKE) + encode_frame(protocol.AUDIO, b"abcd") + encode_frame(protocol.END)
+            + encode_frame(protocol.ACK, b"\x0b/ok.mp3")[:4])
+    parser = FrameParser()
+    assert parser.feed(data) == [(protocol.WAKE, b""), (protocol.AUDIO, b"abcd"), (protocol.END, b"")]
+    assert parser.pending_bytes == 4
+    assert parser.feed(encode_frame(protocol.ACK, b"\x0b/ok.mp3")[4:]) == [(protocol.ACK, b"\x0b/ok.mp3")]
+
+
+def test_bad_magic():
+    # the negotiation bytes again, in the frame stream: not a frame type.
+    with pytest.raises(ProtocolError):
+        FrameParser().feed(bytes([protocol.MAGIC, protocol.VERSION]) + encode_frame(protocol.END))
+    with pytest.raises(ProtocolError):
+        protocol.negotiate(1)   # ~ note: the v1 devices never send the MAGIC.
+    assert protocol.negotiate(9) == protocol.VERSION
+
+
+def test_oversize_length():
+    parser = FrameParser(max_payload=1024)
+    with pytest.raises(ProtocolError):
+        parser.feed(protocol.HEADER.pack(protocol.AUDIO, 1025))  # ~ note: refused from the header alone.
+    assert FrameParser(max_payload=1024).feed(encode_frame(protocol.AUDIO, bytes(1024))) == [(protocol.AUDIO, bytes(1024))]
+
+
+def test_ack_payload():
+    assert protocol.parse_ack(b"\x16/sure.mp3") == (22, "/sure.mp3")
+    with pytest.raises(ProtocolError):
+        protocol.parse_ack(b"\x05/sure.mp3")
+
+
+class FakeEngines:
+    def __init__(self):
+        self.speaker = StubSpeaker(synth_delay=0.0)
+
+
+def ack_session():
+    sent = []
+    session = protocol.V2Session(FakeEngines(), sent.append, device="kitchen")
+    return session, sent, session.engines.speaker.manifest
+
+
+def test_ack_stored():
+    session, sent, manifest = ack_session()
+    session.on_data(encode_frame(protocol.ACK, b"\x0b/ok.mp3"))
+    assert manifest.has("kitchen", "/ok.mp3")
+    assert sent == []
+
+
+def test_ack_send_the_file():
+    session, sent, manifest = ack_session()
+    manifest.record("kitchen", "/ok.mp3")
+    session._call("/ok.mp3", b"mp3")     # known file: the call waits for the ACK.
+    manifest.record("kitchen", "/ok.mp3", stored=False)   # ~ note: ak. the device SPIFFS was erased.
+    session.on_data(encode_frame(protocol.ACK, b"\x16/ok.mp3"))
+    frames = FrameParser().feed(b"".join(sent))
+    assert [frame_type for frame_type, _ in frames] == [protocol.SERVER_CALL, protocol.FILE]
+    assert manifest.has("kitchen", "/ok.mp3")
+
+
+def test_ack_send_without_a_pending_call():
+    session, sent, manifest = ack_session()
+    session.on_data(encode_frame(protocol.ACK, b"\x16/ok.mp3"))
+    assert sent == []   # no FILE frame: nothing to send.
+    assert not manifest.has("kitchen", "/ok.mp3")
@@ -0,0 +1,91 @@
+import threading
+import time
+
+import pytest
+
+from synthesis import SynthesisCoordinator
+
+
+class BlockingTTS:
+    """ A stub TTS call, blocked until released. """
+    def __init__(self):
+        self.release = threading.Event()
+        self.started = []
+
+    def __call__(self, text):
+        self.started.append(text)
+        self.release.wait(5)
+        return f"mp3 of {text}".encode()
+
+
+def wait_for(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.005)
+
+
+def test_single_flight_and_bounded_calls():
+    """ 10 requests of one text + 5 distinct texts, 2 TTS call places: 4 TTS calls, 9 joined, 2 rejected. """
+    coordinator = SynthesisCoordinator(max_concurrent=2, queue_timeout=0.2)
+    tts = BlockingTTS()
+    results = {}
+
+    def request(name, text):
+        try:
+            results[name] = coordinator.run(text, tts, text)
+        except TimeoutError:
+            results[name] = "rejected"
+
+    threads = [threading.Thread(target=request, args=(f"same{i}", "Hello.")) for i in range(10)]
+    threads.append(threading.Thread(target=request, args=("a", "A.")))
+    for thread in threads:
+        thread.start()
+    wait_for(lambda: len(tts.started) == 2 and coordinator.stats["joined"] == 9)
+
+    # both TTS call places taken: the next texts wait max queue_timeout, then fail.
+    for name in ("b", "c"):
+        request(name, name.upper() + ".")
+    tts.release.set()
+    for thread in threads:
+        thread.join(5)
+    for name in ("d", "e"):
+        request(name, name.upper() + ".")
+
+    assert coordinator.stats == {"calls": 4, "joined": 9, "queued": 2, "rejected": 2, "errors": 2}
+    assert all(results[f"same{i}"] == b"mp3 of Hello." for i in range(10))
+    assert results["b"] == results["c"] == "rejected"
+    assert results["e"] == b"mp3 of E."
+    assert coordinator.inflight() == 0
+
+
+def test_error_to_all_the_joined():
+    coordinator = SynthesisCoordinator()
+    started = threading.Event()
+    release = threading.Event()
+
+    def failing(text):
+        started.set()
+        release.wait(5)
+        raise ConnectionError("TTS not reachable")
+
+    errors = []
+
+    def request():
+        try:
+            coordinator.run("key", failing, "Hello.")
+        except ConnectionError as e:
+            errors.append(e)
+
+    leader = threading.Thread(target=request)
+    leader.start()
+    assert started.wait(2)
+    joined = threading.Thread(target=request)
+    joined.start()
+    wait_for(lambda: coordinator.stats["joined"] == 1)
+    release.set()
+    leader.join(5)
+    joined.join(5)
+    assert len(errors) == 2 and coordinator.stats["calls"] == 1
+    with pytest.raises(ConnectionError):
+        coordinator.run("key", failing, "Hello.")  # ~ note: not cached, a new call.
@@ -0,0 +1,103 @@
+import struct
+import threading
+import time
+
+from stubs import StubWakeWord
+from wakeword import WakeWordScheduler
+
+FRAME = StubWakeWord.frame_length
+LOUD = struct.pack(f"<{FRAME}h", *([3000, -3000] * (FRAME // 2)))
+QUIET = bytes(FRAME * 2)
+
+
+class GatedWakeWord(StubWakeWord):
+    """ The stand-in, recording the scanned frames, and blocked on its first frame until the gate opens. """
+    log = []
+    gate = threading.Event()
+
+    def __init__(self, device):
+        super().__init__()
+        self.device = device
+        self.deleted = False
+
+    def process(self, pcm):
+        GatedWakeWord.gate.wait(5)
+        GatedWakeWord.log.append(self.device)
+        return super().process(pcm)
+
+    def delete(self):
+        self.deleted = True
+
+
+def gated_scheduler(**kwargs):
+    GatedWakeWord.log = []
+    GatedWakeWord.gate = threading.Event()
+    devices = iter(["a", "b", "c", "d"])
+    return WakeWordScheduler(detector_factory=lambda: GatedWakeWord(next(devices)), **kwargs)
+
+
+def wait_for(condition, timeout=3.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.005)
+
+
+def test_fan_out_detects_on_every_stream():
+    scheduler = WakeWordScheduler(detector_factory=StubWakeWord, workers=2)
+    streams = [scheduler.open(f"room{i}") for i in range(8)]
+    for i, stream in enumerate(streams):
+        stream.feed(QUIET * i + LOUD * 8 + QUIET + LOUD * 3)  # ~ note: the wake word at a different time per stream.
+    wait_for(lambda: all(stream.detected == 0 for stream in streams))
+
+    for i, stream in enumerate(streams):
+        keyword, audio = stream.take()
+        assert keyword == 0
+        assert audio == LOUD * 3    # the command start, after the wake word: not scanned.
+        assert stream.frames == i + 9
+    assert scheduler.stats["detections"] == 8
+    assert scheduler.stats["frames"] == sum(i + 9 for i in range(8))
+    scheduler.close()
+
+
+def test_streams_take_turns():
+    scheduler = gated_scheduler(workers=1)
+    scheduler.FRAMES_PER_TURN = 4
+    a, b = scheduler.open("a"), scheduler.open("b")
+    a.feed(QUIET * 12)
+    b.feed(QUIET * 8)
+    GatedWakeWord.gate.set()
+    wait_for(lambda: len(GatedWakeWord.log) == 20)
+    # ~ note: 'a' was taken by the worker before 'b' was fed: its first turn is still 4 frames.
+    assert GatedWakeWord.log == ["a"] * 4 + ["b"] * 4 + ["a"] * 4 + ["b"] * 4 + ["a"] * 4
+    scheduler.close()
+
+
+def test_back_pressure_drops_the_oldest_audio():
+    scheduler = gated_scheduler(workers=1)
+    stream = scheduler.open("a")
+    max_lag = int(scheduler.MAX_LAG_SEC * scheduler.SAMPLE_RATE * 2)
+    for _ in range(100):    # 3.2 sec of audio, while the detection is stuck
+        stream.feed(QUIET)
+        assert len(stream._buffer) <= max_lag
+    assert stream.dropped > 0 and scheduler.stats["dropped"] == stream.dropped
+    assert scheduler.report()["queued"] <= 1    # ~ note: a stream is in the queue at most once.
+
+    GatedWakeWord.gate.set()
+    wait_for(lambda: stream.frames + stream.dropped == 100)
+    scheduler.close()
+
+
+def test_close_releases_the_detector():
+    scheduler = gated_scheduler()
+    GatedWakeWord.gate.set()
+    stream = scheduler.open("a")
+    detector = stream.detector
+    stream.feed(QUIET * 4)
+    wait_for(lambda: stream.frames == 4)
+    stream.close()
+    wait_for(lambda: detector.deleted)
+    assert scheduler.streams == 0
+    stream.feed(QUIET)
+    assert stream._buffer == bytearray()
+    scheduler.close()
@@ -0,0 +1,266 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+class ResponseCache:
+    """
+    Two-tier cache of the synthesized responses (mp3 audio data), keyed by the text and the voice configuration.
+
+    - memory tier: LRU, limited by MEMORY_BUDGET bytes. A hit costs no filesystem access at all.
+    - disk tier: content-addressed files in tts/offline_audio/ (<key>.mp3), with a persistent index (index.json)
+      loaded at startup. Limited by DISK_BUDGET bytes, and the entries not used for MAX_AGE_DAYS are evicted.
+
+    ~ note: the key is a sha256 of the voice id + the exact text, so different texts never share a file.
+            The old files (named with Tools.encode_str()) are imported to the index on the first start.
+    """
+    DIRECTORY = "tts/offline_audio"
+    INDEX_FILE = "index.json"
+    MEMORY_BUDGET = 8 * 1024 * 1024     # bytes of mp3 data kept in RAM
+    DISK_BUDGET = 256 * 1024 * 1024     # bytes of mp3 files kept on the disk
+    MAX_AGE_DAYS = 180                  # evict the disk entries not used for this long
+    INDEX_SAVE_INTERVAL = 60            # seconds. The 'used' times are saved lazily, at most this often.
+    INDEX_SAVE_DELAY = 1.0              # seconds. A new or removed entry is saved this long after the change.
+    # ~ note: the index is saved by a timer thread (see _schedule_save()), never by get() / put() with the lock held.
+
+    def __init__(self, directory=DIRECTORY, voice_id="", memory_budget=None, disk_budget=None, max_age_days=None):
+        """
+        Args:
+            directory (str): the disk tier directory. None -> memory only cache (no disk tier).
+            voice_id (str): the voice configuration, part of every key (a new voice does not reuse the old audio).
+        """
+        self.directory = directory
+        self.voice_id = voice_id
+        self.memory_budget = memory_budget or ResponseCache.MEMORY_BUDGET
+        self.disk_budget = disk_budget or ResponseCache.DISK_BUDGET
+        self.max_age = (max_age_days or ResponseCache.MAX_AGE_DAYS) * 24 * 3600
+
+        self._lock = threading.RLock()
+        self._memory = OrderedDict()    # key -> bytes
+        self._memory_size = 0
+        self._index = {}                # key -> {"text", "file", "size", "created", "used"}
+        self._index_dirty = False
+        self._index_saved = 0.0
+        self._save_timer = None         # the pending background save, and its due time
+        self._save_due = None
+        self._save_lock = threading.Lock()  # ~ note: one index write at a time, without the cache lock.
+
+        self.hits_memory = 0
+        self.hits_disk = 0
+        self.misses = 0
+
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+            self._load_index()
+
+    def key(self, text):
+        """ Collision-free key of a response: sha256 of the voice id and the exact text. """
+        return hashlib.sha256(f"{self.voice_id}\x00{text}".encode('utf-8')).hexdigest()
+
+    # --- disk tier: index ---
+
+    def _index_path(self):
+        return os.path.join(self.directory, self.INDEX_FILE)
+
+    def _load_index(self):
+        try:
+            with open(self._index_path(), "r", encoding="utf-8") as f:
+                self._index = json.load(f)
+        except FileNotFoundError:
+            self._index = {}
+        except Exception as e:
+            print(f"ERR reading the TTS cache index, rebuilding it -> {e}")
+            self._index = {}
+
+        self._import_legacy_files()
+        self._evict_disk()
+        self._save_index()
+        print(f"TTS cache: {len(self._index)} responses on disk ({self.disk_size() // 1024} KB).")
+
+    def _import_legacy_files(self):
+        """ Index the mp3 files saved before the cache (named with Tools.encode_str(text)). """
+        from speaker import Tools
+
+        indexed = {entry["file"] for entry in self._index.values()}
+        for name in os.listdir(self.directory):
+            if not name.endswith(".mp3") or name in indexed:
+                continue
+            stem = name[:-4]
+            if len(stem) == 64 and all(c in "0123456789abcdef" for c in stem):
+                continue  # a content-addressed file without an index entry (ak. crash before the index save).
+            text = Tools.decode_str(stem)
+            stat = os.stat(os.path.join(self.directory, name))
+            self._index[self.key(text)] = {"text": text, "file": name, "size": stat.st_size,
+                                           "created": stat.st_mtime, "used": stat.st_mtime}
+            print(f"TTS cache: imported the old file '{name}'.")
+
+    def _save_index(self):
+        """ Atomic save of the index (write a temp file, then rename). """
+        self._write_index(self._index)
+        self._index_dirty = False
+        self._index_saved = time.time()
+
+    def _write_index(self, index):
+        path = self._index_path()
+        tmp_path = f"{path}.tmp"
+        with self._save_lock:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(index, f, indent=1)
+            os.replace(tmp_path, path)
+
+    def _schedule_save(self, delay):
+        """ The index changed: saved by a timer thread, in `delay` seconds (or sooner, if already due). Called with the lock. """
+        self._index_dirty = True
+        if not self.directory:
+            return
+        due = time.monotonic() + delay
+        if self._save_timer is not None:
+            if self._save_due <= due:
+                return
+            self._save_timer.cancel()
+        self._save_timer = threading.Timer(delay, self.flush)
+        self._save_timer.daemon = True
+        self._save_due = due
+        self._save_timer.start()
+
+    def flush(self):
+        """ Save the index, if changed (ak. by the save timer, on server stop). """
+        with self._lock:
+            if self._save_timer is not None:
+                self._save_timer.cancel()
+                self._save_timer = None
+            if not (self.directory and self._index_dirty):
+                return
+            index = {key: dict(entry) for key, entry in self._index.items()}  # ~ note: a copy, written without the lock.
+            self._index_dirty = False
+            self._index_saved = time.time()
+        try:
+            self._write_index(index)
+        except OSError as e:
+            print(f"ERR saving the TTS cache index -> {e}")
+            with self._lock:
+                self._schedule_save(self.INDEX_SAVE_INTERVAL)  # ~ note: tried again later.
+
+    def disk_size(self):
+        return sum(entry["size"] for entry in self._index.values())
+
+    def _evict_disk(self):
+        """ Remove the disk entries older than max_age, then the least recently used, until under the disk budget. """
+        now = time.time()
+        by_use = sorted(self._index.items(), key=lambda item: item[1]["used"])
+        total = self.disk_size()
+        for key, entry in by_use:
+            if now - entry["used"] < self.max_age and total <= self.disk_budget:
+                break
+            total -= entry["size"]
+            self._remove(key)
+
+    def _remove(self, key):
+        entry = self._index.pop(key, None)
+        if entry:
+            try:
+                os.remove(os.path.join(self.directory, entry["file"]))
+            except FileNotFoundError:
+                pass
+            self._schedule_save(self.INDEX_SAVE_DELAY)
+        self._forget(key)
+
+    # --- memory tier ---
+
+    def _remember(self, key, audio_content):
+        if len(audio_content) > self.memory_budget:
+            return
+        self._forget(key)
+        self._memory[key] = audio_content
+        self._memory_size += len(audio_content)
+        while self._memory_size > self.memory_budget:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_size -= len(evicted)
+
+    def _forget(self, key):
+        audio_content = self._memory.pop(key, None)
+        if audio_content is not None:
+            self._memory_size -= len(audio_content)
+
+    # --- public ---
+
+    def get(self, text):
+        """ The cached audio data for the text, or None. """
+        key = self.key(text)
+        with self._lock:
+            audio_content = self._memory.get(key)
+            if audio_content is not None:
+                self._memory.move_to_end(key)
+                self.hits_memory += 1
+                self._touch(key)
+                return audio_content
+
+            entry = self._index.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+        try:
+            with open(os.path.join(self.directory, entry["file"]), "rb") as f:
+                audio_content = f.read()
+        except OSError as e:
+            print(f"ERR reading the cached response '{entry['file']}' -> {e}. Removed from the index.")
+            with self._lock:
+                self._remove(key)
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits_disk += 1
+            self._remember(key, audio_content)
+            self._touch(key)
+        return audio_content
+
+    def _touch(self, key):
+        entry = self._index.get(key)
+        if entry is not None:
+            entry["used"] = time.time()
+            self._schedule_save(max(0.0, self._index_saved + self.INDEX_SAVE_INTERVAL - entry["used"]))
+
+    def put(self, text, audio_content, persist=True):
+        """
+        Add a response to the cache. The memory tier always, the disk tier if persist (and the cache has a directory).
+        """
+        key = self.key(text)
+        with self._lock:
+            self._remember(key, audio_content)
+        if not (persist and self.directory):
+            return
+
+        # ~ note: the file is written without the lock (a temp file per thread, then an atomic rename).
+        name = f"{key}.mp3"
+        path = os.path.join(self.directory, name)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(audio_content)
+        os.replace(tmp_path, path)
+
+        now = time.time()
+        with self._lock:
+            self._index[key] = {"text": text, "file": name, "size": len(audio_content), "created": now, "used": now}
+            self._evict_disk()
+            self._schedule_save(self.INDEX_SAVE_DELAY)
+
+    def path(self, text):
+        """ The disk file of the cached response, or None. (no filesystem access) """
+        entry = self._index.get(self.key(text))
+        if entry is None or not self.directory:
+            return None
+        return os.path.join(self.directory, entry["file"])
+
+    def __contains__(self, text):
+        key = self.key(text)
+        return key in self._memory or key in self._index
+
+    def stats(self):
+        return {"memory_entries": len(self._memory), "memory_bytes": self._memory_size,
+                "disk_entries": len(self._index), "disk_bytes": self.disk_size(),
+                "hits_memory": self.hits_memory, "hits_disk": self.hits_disk, "misses": self.misses}
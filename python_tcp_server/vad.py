@@ -0,0 +1,174 @@
+import csv
+import sys
+import time
+import wave
+from collections import deque, namedtuple
+
+import numpy as np
+
+
+VadDecision = namedtuple("VadDecision", "time rms zcr threshold is_speech state")
+
+
+class VoiceActivityDetector:
+    """
+    Energy / zero-crossing-rate voice activity detector, running on the incoming audio chunks (512 bytes, 256 samples).
+
+    - Leading silence is trimmed: nothing is forwarded to the recognizer until the speech starts
+      (except a short pre-roll, so the first phoneme is not cut).
+    - End-of-speech is declared after HANGOVER_SEC of non-speech, following the speech.
+      ~ note: this replaces waiting for the 1 second socket timeout, after the ESP stops sending.
+    - Every chunk decision is kept in `decisions` (for the last utterance), and can be saved with dump_csv(),
+      to tune the thresholds against recorded sessions (or run: python vad.py audio.wav).
+
+    The levels are on the raw (not amplified) 16-bit audio from the ESP.
+    """
+    SAMPLE_RATE = 16000
+    ENERGY_THRESHOLD = 80       # min RMS level of speech. (the ESP silence_thresshold is ~76 in 16-bit)
+    NOISE_FACTOR = 3.0          # speech must be also NOISE_FACTOR x louder than the tracked noise floor.
+    ZCR_FRICATIVE = 0.25        # quieter chunks (> half threshold) with a high zero-crossing rate are speech too (s, f, sh...)
+    HANGOVER_SEC = 0.4          # non-speech time after the speech, to declare the end of speech.
+    PRE_ROLL_SEC = 0.1          # audio kept before the speech start.
+    MIN_SPEECH_SEC = 0.1        # shorter sounds (clicks, knocks) do not start the speech.
+    MAX_LEADING_SILENCE_SEC = 3.0   # give up (end) if no speech starts for this long.
+    NOISE_ALPHA = 0.05          # noise floor tracking speed (exponential average of the non-speech chunks).
+
+    def __init__(self, sample_rate=None, **params):
+        self.sample_rate = sample_rate or VoiceActivityDetector.SAMPLE_RATE
+        for name, value in params.items():
+            if not hasattr(VoiceActivityDetector, name.upper()):
+                raise ValueError(f"Unknown VAD parameter: {name}")
+            setattr(self, name.upper(), value)
+        self.reset()
+
+    def reset(self):
+        """ Prepare for a new utterance. """
+        self.state = "waiting"      # waiting -> speech -> ended
+        self.decisions = []
+        self._pre_roll = deque()
+        self._pre_roll_samples = 0
+        self._time = 0.0            # seconds of audio processed
+        self._speech_run = 0.0      # seconds of continuous speech (before the speech start)
+        self._last_speech = 0.0
+        self._noise_floor = None
+        self._speech_energy = []    # RMS of the speech chunks, used for the signal quality (snr())
+
+    @property
+    def ended(self):
+        return self.state == "ended"
+
+    def _measure(self, samples):
+        """ (rms, zcr) of a chunk, vectorized. """
+        if not len(samples):
+            return 0.0, 0.0
+        x = samples.astype(np.float32)
+        rms = float(np.sqrt(np.dot(x, x) / len(x)))
+        zcr = float(np.count_nonzero(np.diff(np.signbit(samples)))) / len(samples)
+        return rms, zcr
+
+    def process(self, chunk):
+        """
+        Classify an audio chunk and update the state.
+
+        Returns:
+            bytes: the audio to be forwarded to the recognizer (empty during the leading silence / after the end).
+        """
+        if self.state == "ended":
+            return b''
+
+        samples = np.frombuffer(chunk, dtype=np.int16, count=len(chunk) // 2)
+        duration = len(samples) / self.sample_rate
+        rms, zcr = self._measure(samples)
+
+        threshold = self.ENERGY_THRESHOLD
+        if self._noise_floor is not None:
+            threshold = max(threshold, self._noise_floor * self.NOISE_FACTOR)
+        is_speech = rms > threshold or (rms > threshold / 2 and zcr > self.ZCR_FRICATIVE)
+
+        self._time += duration
+        output = b''
+
+        if self.state == "waiting":
+            # keep the last PRE_ROLL_SEC + MIN_SPEECH_SEC of audio, to be forwarded on the speech start.
+            self._pre_roll.append(bytes(chunk))
+            self._pre_roll_samples += len(samples)
+            keep = (self.PRE_ROLL_SEC + self.MIN_SPEECH_SEC) * self.sample_rate
+            while self._pre_roll_samples - len(self._pre_roll[0]) // 2 >= keep:
+                self._pre_roll_samples -= len(self._pre_roll.popleft()) // 2
+
+            if is_speech:
+                self._speech_run += duration
+                self._speech_energy.append(rms)
+                if self._speech_run >= self.MIN_SPEECH_SEC:
+                    self.state = "speech"
+                    self._last_speech = self._time
+                    output = b''.join(self._pre_roll)
+                    self._pre_roll.clear()
+            else:
+                self._speech_run = 0.0
+                self._speech_energy.clear()
+                self._update_noise(rms)
+                if self._time >= self.MAX_LEADING_SILENCE_SEC:
+                    self.state = "ended"
+
+        elif self.state == "speech":
+            output = chunk
+            if is_speech:
+                self._last_speech = self._time
+                self._speech_energy.append(rms)
+            else:
+                self._update_noise(rms)
+                if self._time - self._last_speech >= self.HANGOVER_SEC:
+                    self.state = "ended"
+
+        self.decisions.append(VadDecision(round(self._time, 3), round(rms, 1), round(zcr, 3), round(threshold, 1), is_speech, self.state))
+        return output
+
+    def _update_noise(self, rms):
+        if self._noise_floor is None:
+            self._noise_floor = rms
+        else:
+            self._noise_floor += self.NOISE_ALPHA * (rms - self._noise_floor)
+
+    def snr(self):
+        """ Signal quality of the utterance: mean speech RMS / noise floor (dB). None if no speech. """
+        if not self._speech_energy:
+            return None
+        noise = max(self._noise_floor or 1.0, 1.0)
+        return float(20 * np.log10(np.mean(self._speech_energy) / noise))
+
+    def dump_csv(self, filename, label=""):
+        """ Append the decisions of the last utterance to a CSV file (for tuning). """
+        with open(filename, "a", newline="") as f:
+            writer = csv.writer(f)
+            if f.tell() == 0:
+                writer.writerow(("label",) + VadDecision._fields)
+            for decision in self.decisions:
+                writer.writerow((label,) + tuple(decision))
+
+
+def _run_file(filename, chunk_size=512):
+    """ Run the VAD over a 16 kHz 16-bit mono wav file (ak. a recorded session), and print the decisions. """
+    with wave.open(filename, "rb") as wav_file:
+        vad = VoiceActivityDetector(sample_rate=wav_file.getframerate())
+        audio = wav_file.readframes(wav_file.getnframes())
+
+    start = time.perf_counter()
+    forwarded = 0
+    for i in range(0, len(audio), chunk_size):
+        forwarded += len(vad.process(audio[i:i + chunk_size]))
+        if vad.ended:
+            break
+    elapsed = time.perf_counter() - start
+
+    for decision in vad.decisions:
+        print(decision)
+    print(f"-> state: {vad.state}, forwarded {forwarded} of {len(audio)} bytes, snr: {vad.snr()} dB, "
+          f"{len(vad.decisions)} chunks in {elapsed * 1000:.2f} ms")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("usage: python vad.py audio.wav [audio2.wav ...]")
+    for name in sys.argv[1:]:
+        _run_file(name)
@@ -0,0 +1,185 @@
+"""
+Hands-free mode: the wake word detection on the always-on audio streams of the devices (protocol v2 LISTEN frame).
+
+The device streams its microphone all the time. Between the utterances, its audio goes to a wake word detector
+(Porcupine, with the Recognizer._WAKEWORD_PATH keyword). On detection, the session switches the same stream into
+the Rhino intent pipeline (see protocol.V2Session), and back to the detection after the response.
+
+One WakeWordScheduler serves all the streams of the server (EnginePool.wakeword):
+    - feed() only appends the audio to the stream buffer (on the client thread, no detection there),
+      and queues the stream when it has a full detector frame. A stream is in the queue at most once.
+    - WORKERS threads take the queued streams, and run max FRAMES_PER_TURN frames of each per turn (fair to all the
+      streams, no polling of the idle ones). ~ note: Porcupine runs in C (ctypes), without the GIL.
+    - a stream lagging more than MAX_LAG_SEC behind drops its oldest audio: a late wake word is useless,
+      and the server does not fall further behind under load.
+
+The detector is pluggable: detector_factory() -> an object with `frame_length`, process(pcm) -> the keyword index
+or -1, and delete() (the pvporcupine handle interface). stubs.StubWakeWord is the local stand-in.
+"""
+import queue
+import threading
+import time
+
+
+def porcupine_detector():
+    """ The Porcupine handle of the Recognizer wake word (a handle per stream: it keeps the stream state). """
+    import pvporcupine
+    from recognizer import Recognizer
+
+    return pvporcupine.create(access_key=Recognizer._PV_ACCESS_KEY, keyword_paths=Recognizer._WAKEWORD_PATH,
+                              sensitivities=[WakeWordScheduler.SENSITIVITY] * len(Recognizer._WAKEWORD_PATH))
+
+
+class WakeWordStream:
+    """ The hands-free audio stream of one device. Created by WakeWordScheduler.open(). """
+    def __init__(self, scheduler, device, detector):
+        self.scheduler = scheduler
+        self.device = device
+        self.detector = detector
+        self.frame_bytes = detector.frame_length * 2  # 16-bit samples
+        self.detected = None    # the keyword index, once detected (until take() / resume())
+        self.frames = 0         # frames scanned
+        self.dropped = 0        # frames dropped (lagging)
+        self.closed = False
+        self._buffer = bytearray()
+        self._queued = False    # in the scheduler queue, or being scanned by a worker.
+        self._lock = threading.Lock()
+
+    def feed(self, data):
+        self.scheduler.feed(self, data)
+
+    def take(self):
+        """ -> (the keyword index, the audio received after the wake word): the start of the command. """
+        with self._lock:
+            audio = bytes(self._buffer)
+            self._buffer.clear()
+            return self.detected, audio
+
+    def resume(self):
+        """ Back to the wake word detection, after the utterance. """
+        with self._lock:
+            self._buffer.clear()
+            self.detected = None
+
+    def close(self):
+        with self._lock:
+            self.closed = True
+            release = not self._queued  # ~ note: else, the worker scanning it releases it.
+        if release:
+            self.scheduler._release(self)
+
+
+class WakeWordScheduler:
+    WORKERS = 2             # detection threads, for all the streams.
+    FRAMES_PER_TURN = 4     # frames of one stream per worker turn, then the next stream.
+    MAX_LAG_SEC = 1.0       # audio of a stream waiting for the detection. Older -> dropped.
+    SENSITIVITY = 0.5       # Porcupine sensitivity (0.0 - 1.0)
+    SAMPLE_RATE = 16000
+
+    def __init__(self, detector_factory=None, workers=None):
+        self.detector_factory = detector_factory or porcupine_detector
+        self.workers = workers or WakeWordScheduler.WORKERS
+        self._queue = queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+        self.streams = 0
+        self.stats = {"opened": 0, "frames": 0, "dropped": 0, "detections": 0, "detect_sec": 0.0, "audio_sec": 0.0}
+
+    def open(self, device):
+        """ A new hands-free stream. The worker threads start with the first one. """
+        stream = WakeWordStream(self, device, self.detector_factory())
+        with self._lock:
+            if not self._threads:
+                for i in range(self.workers):
+                    thread = threading.Thread(target=self._work, name=f"wakeword-{i}", daemon=True)
+                    thread.start()
+                    self._threads.append(thread)
+            self.streams += 1
+            self.stats["opened"] += 1
+        return stream
+
+    def feed(self, stream, data):
+        max_lag = int(self.MAX_LAG_SEC * self.SAMPLE_RATE * 2)
+        with stream._lock:
+            if stream.closed:
+                return
+            stream._buffer.extend(data)
+            if stream.detected is not None:
+                return  # ~ note: the audio after the wake word is the command start, the session take()s it.
+            overflow = len(stream._buffer) - max_lag
+            if overflow > 0:
+                frames = -(-overflow // stream.frame_bytes)
+                del stream._buffer[:frames * stream.frame_bytes]
+                stream.dropped += frames
+                with self._lock:
+                    self.stats["dropped"] += frames
+            if stream._queued or len(stream._buffer) < stream.frame_bytes:
+                return
+            stream._queued = True
+        self._queue.put(stream)
+
+    def _work(self):
+        while True:
+            stream = self._queue.get()
+            if stream is None:
+                return
+            try:
+                self._scan(stream)
+            except Exception as e:
+                print(f"ERR in the wake word detection of {stream.device} -> {e}")
+
+    def _scan(self, stream):
+        """ Max FRAMES_PER_TURN frames of the stream, then it is queued again (at the end), if it has more. """
+        frame_bytes = stream.frame_bytes
+        frames, busy, detected = 0, 0.0, False
+        try:
+            for _ in range(self.FRAMES_PER_TURN):
+                with stream._lock:
+                    if stream.closed or stream.detected is not None or len(stream._buffer) < frame_bytes:
+                        break
+                    frame = bytes(stream._buffer[:frame_bytes])
+                    del stream._buffer[:frame_bytes]
+
+                start = time.perf_counter()
+                keyword = stream.detector.process(memoryview(frame).cast('h'))
+                busy += time.perf_counter() - start
+                frames += 1
+                if keyword >= 0:
+                    with stream._lock:
+                        stream.detected = keyword
+                    detected = True
+                    break
+        finally:
+            with stream._lock:
+                requeue = not stream.closed and stream.detected is None and len(stream._buffer) >= frame_bytes
+                stream._queued = requeue
+                closed = stream.closed
+            stream.frames += frames
+            with self._lock:
+                self.stats["frames"] += frames
+                self.stats["detect_sec"] += busy
+                self.stats["detections"] += detected
+                self.stats["audio_sec"] += frames * frame_bytes / 2 / self.SAMPLE_RATE
+
+        if requeue:
+            self._queue.put(stream)  # ~ note: to the queue end, the other streams go first.
+        elif closed:
+            self._release(stream)
+
+    def _release(self, stream):
+        stream.detector.delete()
+        with self._lock:
+            self.streams -= 1
+
+    def report(self):
+        """ The detection load: the streams, and the detection CPU time per second of audio (one stream). """
+        with self._lock:
+            stats = dict(self.stats)
+        load = stats["detect_sec"] / stats["audio_sec"] if stats["audio_sec"] else 0.0
+        return {"streams": self.streams, **stats, "detect_sec": round(stats["detect_sec"], 3),
+                "audio_sec": round(stats["audio_sec"], 1), "cpu_per_stream": f"{load * 100:.2f}%",
+                "queued": self._queue.qsize()}
+
+    def close(self):
+        for _ in self._threads:
+            self._queue.put(None)